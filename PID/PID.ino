@@ -1,8 +1,10 @@
 #include <Wire.h>
 #include <Adafruit_MCP4725.h>
 #include <Adafruit_MAX31865.h>
+#include <util/crc16.h>
 
-#define BAUD 115200
+#define BAUD 115200           // Baud rate after a reset (the host can change it with set_baud)
+#define BAUD_CONFIRM_TIME 1000 // Time (ms) the host has to send a command at a new baud rate before we go back
 #define POLARITY_PIN  6
 
 #define RREF      4300.0  // The value of the Rref resistor in the RTD package.
@@ -24,8 +26,8 @@ double t_derivative;   // Derivative time
 unsigned int period;   // Control period (in milliseconds)
 double dt;             // Time step between temperature measurements used in the control loop
  
-double time_control; // Time of the temperature measurement last used to update the control function   
-double time_recent ; // Time of the most recently taken temperature measurement
+unsigned long time_control; // millis() of the temperature measurement last used to update the control function   
+unsigned long time_recent ; // millis() of the most recently taken temperature measurement (sent with get_all_variables)
 
 /** Setup the external DAC **/
 Adafruit_MCP4725 dac;    // New DAC object
@@ -41,6 +43,41 @@ char temp_data    [data_size];    // Temporary array for use when parsing
 char functionCall[20]  = {0};     //
 boolean newData = false;          // Flag used to indicate if new data has been found on the serial line
 char * strtok_index;              // Used by strtok() as an index
+int reply_tag   = -1;             // Sequence tag of the command being processed (-1 if untagged)
+boolean replied = false;          // Whether a reply to the current command has been started
+
+/** Baud rate **/
+unsigned long baud          = BAUD; // Baud rate in use
+unsigned long baud_previous = 0;    // Baud rate to go back to if the current one is not confirmed (0 if confirmed)
+unsigned long baud_time     = 0;    // millis() of the last baud rate change
+
+/** Telemetry format **/
+boolean binary_telemetry = false; // If true, get_all_variables replies with a binary frame (see send_frame())
+const byte FRAME_START   = 0xA5;  // First byte of every binary frame
+
+struct __attribute__((packed)) telemetry_frame { // Little-endian payload of the binary get_all_variables reply
+  float    temperature;
+  float    setpoint;
+  int16_t  dac;
+  float    band;
+  float    t_integral;
+  float    t_derivative;
+  uint16_t period;
+  uint32_t time_recent;
+};
+
+/** Sample history (see get_history in parseData()) **/
+#define HISTORY_SIZE  32          // Number of RTD readings kept
+#define HISTORY_REPLY 25          // Most readings per get_history reply (a binary frame holds at most 255 bytes)
+
+struct __attribute__((packed)) history_sample { // One RTD reading, as sent in binary get_history replies
+  uint32_t time;                  // millis() of the reading
+  float    temperature;
+  int16_t  dac;                   // dac output at the time
+};
+
+history_sample history[HISTORY_SIZE]; // Circular buffer of the most recent readings
+unsigned long history_count = 0;      // Sequence number of the next reading (readings since reset)
 
 /** Control Modes **/
 enum MODES{OPEN_LOOP,CLOSED_LOOP};
@@ -80,7 +117,7 @@ void initialize(){
 }
 
 void setup() {
-  Serial.begin(BAUD);               
+  Serial.begin(baud);               
   if(ENABLE_OUTPUT)
   {
     pinMode(POLARITY_PIN, OUTPUT);    // Enable Polarity pin
@@ -92,17 +129,28 @@ void setup() {
   
   rtd.begin(MAX31865_3WIRE);          // Begin SPI communcation with the MAX 31865 chip
   initialize();                       // Initialize relevant variables 
+  Serial.println("READY");            // Tell the host we are ready for commands (see pid_api.handshake())
 }
 
 void loop() {
   receive_data();                       /* Look for and grab data on the serial line. */
                                         /* If new data is found, the newData flag will be set */ 
 
-  if (newData == true) {
+  while (newData == true) {             /* Handle every queued command before the slow temperature read, */
+                                        /* so pipelined commands do not overflow the serial buffer       */
       strcpy(temp_data, received_data); /* this temporary copy is necessary to protect the original data    */
                                         /* because strtok() used in parseData() replaces the commas with \0 */
+      baud_previous = 0;                // A command got through, so the baud rate is fine
+      begin_command();                  // Strip the sequence tag, if any
       parseData();                      // Parse the data for commands
+      end_command();                    // Acknowledge tagged commands without a reply
       newData = false;                  // Reset newData flag
+      receive_data();                   // Look for the next command
+  }
+  
+  if (baud_previous != 0 && millis() - baud_time > BAUD_CONFIRM_TIME) { /* Nothing heard at the new baud rate, */
+    set_baud(baud_previous);                                            /* so go back to the old one          */
+    baud_previous = 0;
   }
   
   read_temperature();                  
@@ -118,6 +166,12 @@ void read_temperature(){
   temperature             = rtd.temperature(RNOMINAL, RREF); // One shot temperature measurement of the rtd 
   error                   = temperature - setpoint;          // Compute the temperature error.
   time_recent = millis();                                    // Update the time that this measurement was taken
+  
+  history_sample *sample = &history[history_count % HISTORY_SIZE]; // Keep it for get_history
+  sample->time           = time_recent;
+  sample->temperature    = temperature;
+  sample->dac            = dac_output;
+  history_count++;
 }
 
 ISR(TIMER1_COMPA_vect){ 
@@ -131,7 +185,7 @@ ISR(TIMER1_COMPA_vect){
  */
   
   if(mode == CLOSED_LOOP){
-    dt = time_recent - time_control; // Update the time differential
+    dt = time_recent - time_control; // Update the time differential (unsigned, so correct across millis() overflow)
     time_control = time_recent;      // Update the time of the temperature measurement used in the control loop
   
     interrupts(); /* Re-enable interrupts (allowing nested interrupts) */
@@ -61,6 +61,17 @@ void set_dac(int voltage_12bit){
   dac_output = voltage_12bit;
 }
 
+void set_baud(unsigned long _baud){
+/*
+ * Restarts the serial port at a new baud rate, once everything already
+ * queued has been sent at the old one.
+ */
+  Serial.flush();
+  Serial.end();
+  Serial.begin(_baud);
+  baud = _baud;
+}
+
 void set_mode(MODES _mode){
     mode = _mode;
 }
@@ -40,6 +40,47 @@ void receive_data() {
   }
 }
 
+void begin_command() {
+  /*
+   * A command may be prefixed with a sequence tag, e.g. <#12;get_period>.
+   * Strip the tag from temp_data and remember it, so every reply to this
+   * command can be prefixed with the same tag.
+   */
+  reply_tag = -1;
+  replied   = false;
+  
+  if (temp_data[0] == '#') {
+    char *separator = strchr(temp_data, ';');
+    if (separator != NULL) {
+      reply_tag = atoi(temp_data + 1);
+      memmove(temp_data, separator + 1, strlen(separator + 1) + 1);
+    }
+  }
+}
+
+void begin_reply() {
+  /*
+   * Call before sending a reply. Prints the tag of the current command, if any.
+   */
+  if (reply_tag >= 0 && !replied) {
+    Serial.print('#');
+    Serial.print(reply_tag);
+    Serial.print(';');
+  }
+  replied = true;
+}
+
+void end_command() {
+  /*
+   * Acknowledge tagged commands that produced no reply with an empty line,
+   * so the host knows they have been processed.
+   */
+  if (reply_tag >= 0 && !replied) {
+    begin_reply();
+    Serial.println();
+  }
+}
+
 void parseData() {      
    strtok_index = strtok(temp_data,",");   // Get the first part - the string
    strcpy(functionCall, strtok_index);     // Copy it to function_call
@@ -64,6 +105,7 @@ void parseData() {
       set_dac(voltage_12bit);
       return;
     }
+    begin_reply();
     Serial.println("Arduino must be in OPEN_LOOP mode in order to directly manipulate the dac output.");
   }
   
@@ -76,6 +118,7 @@ void parseData() {
       set_mode(CLOSED_LOOP);
     }
     else{
+      begin_reply();
       Serial.println("Invaild Mode.");
       return;
     }
@@ -90,10 +133,12 @@ void parseData() {
   }
   
   if(strcmp(functionCall,"get_dac")         == 0){ 
+      begin_reply();
       Serial.println(get_dac());
   }
   
   if(strcmp(functionCall,"get_mode")        == 0){ 
+    begin_reply();
     MODES _mode = get_mode();
     if(_mode == CLOSED_LOOP){
       Serial.println("CLOSED_LOOP");        
@@ -105,10 +150,12 @@ void parseData() {
   
   if(strcmp(functionCall,"get_temperature") == 0){
     float _temperature = get_temperature();
+    begin_reply();
     Serial.println(_temperature,2);
   }
   
   if(strcmp(functionCall,"get_parameters")  == 0){
+    begin_reply();
     Serial.print(band,4);
     Serial.print(',');
     Serial.print(t_integral,4);
@@ -117,14 +164,66 @@ void parseData() {
   }
   
   if(strcmp(functionCall,"get_setpoint")    == 0){ 
+    begin_reply();
     Serial.println(get_setpoint(),4);    
   }
   
   if(strcmp(functionCall,"get_period")    == 0){ 
+    begin_reply();
     Serial.println(get_period());    
   }
 
-  if(strcmp(functionCall,"get_all_variables") == 0){
+  if(strcmp(functionCall,"set_baud")        == 0){
+    begin_reply();
+    long _baud = (strtok_index == NULL) ? 0 : atol(strtok_index);
+    if(_baud <= 0){
+      Serial.println(baud);           // No (valid) argument: just report the baud rate
+      return;
+    }
+    Serial.println(_baud);            // Confirm at the old baud rate, then switch. If no command arrives
+    baud_previous = baud;             // within BAUD_CONFIRM_TIME, loop() switches back.
+    baud_time     = millis();
+    set_baud(_baud);
+    return;
+  }
+
+  if(strcmp(functionCall,"get_history")     == 0){
+    unsigned long first = (strtok_index == NULL) ? 0 : strtoul(strtok_index, NULL, 10);
+    
+    if(first > history_count)                first = history_count;                // Nothing new
+    if(history_count - first > HISTORY_SIZE) first = history_count - HISTORY_SIZE; // Older readings are overwritten
+    byte count = min(history_count - first, HISTORY_REPLY);
+    
+    begin_reply();
+    send_history(first, count);
+  }
+
+  if(strcmp(functionCall,"set_format")      == 0){
+    if(strtok_index == NULL)                        ; // No argument: just report the format
+    else if(strcmp(strtok_index,"BINARY") == 0)     binary_telemetry = true;
+    else if(strcmp(strtok_index,"ASCII")  == 0)     binary_telemetry = false;
+    
+    begin_reply();
+    Serial.println(binary_telemetry ? "BINARY" : "ASCII"); // Confirm the format now in use
+  }
+
+  if(strcmp(functionCall,"get_all_variables") == 0 && binary_telemetry){
+    telemetry_frame frame;
+    frame.temperature  = get_temperature();
+    frame.setpoint     = get_setpoint();
+    frame.dac          = get_dac();
+    frame.band         = band;
+    frame.t_integral   = t_integral;
+    frame.t_derivative = t_derivative;
+    frame.period       = get_period();
+    frame.time_recent  = time_recent;
+    
+    begin_reply();
+    send_frame((byte *) &frame, sizeof(frame));
+  }
+  
+  else if(strcmp(functionCall,"get_all_variables") == 0){
+    begin_reply();
     Serial.print(get_temperature(),2);
     Serial.print(',');
     Serial.print(get_setpoint(),4);
@@ -137,6 +236,59 @@ void parseData() {
     Serial.print(',');
     Serial.print(t_derivative,4); 
     Serial.print(',');
-    Serial.println(get_period()); 
+    Serial.print(get_period()); 
+    Serial.print(',');
+    Serial.println(time_recent);  // millis() of the temperature measurement
+  }
+}
+
+void send_frame(const byte *payload, byte length) {
+  /*
+   * Send a binary frame: FRAME_START, payload length, payload, and a
+   * CRC-8 (polynomial 0x07) computed over the length byte and the payload.
+   */
+  Serial.write(FRAME_START);
+  Serial.write(length);
+  byte crc = write_crc(payload, length, _crc8_ccitt_update(0, length));
+  Serial.write(crc);
+}
+
+byte write_crc(const byte *data, byte length, byte crc) {
+  /*
+   * Write part of a frame payload, and return the CRC-8 updated with it.
+   */
+  for (byte i = 0; i < length; i++) crc = _crc8_ccitt_update(crc, data[i]);
+  Serial.write(data, length);
+  return crc;
+}
+
+void send_history(unsigned long first, byte count) {
+  /*
+   * Send count readings from the history, starting with sequence number first.
+   * 
+   * ASCII:  first;time,temperature,dac;time,temperature,dac;...
+   * Binary: a frame with first (uint32_t) followed by count history_samples,
+   *         written straight from the circular buffer.
+   */
+  if (binary_telemetry) {
+    byte length = sizeof(first) + count*sizeof(history_sample);
+    Serial.write(FRAME_START);
+    Serial.write(length);
+    byte crc = write_crc((byte *) &first, sizeof(first), _crc8_ccitt_update(0, length));
+    for (byte i = 0; i < count; i++) crc = write_crc((byte *) &history[(first+i) % HISTORY_SIZE], sizeof(history_sample), crc);
+    Serial.write(crc);
+    return;
+  }
+  
+  Serial.print(first);
+  for (byte i = 0; i < count; i++) {
+    history_sample *sample = &history[(first+i) % HISTORY_SIZE];
+    Serial.print(';');
+    Serial.print(sample->time);
+    Serial.print(',');
+    Serial.print(sample->temperature,2);
+    Serial.print(',');
+    Serial.print(sample->dac);
   }
+  Serial.println();
 }
@@ -1,10 +1,20 @@
-import mcphysics   as _mp
 import spinmob.egg as _egg
 import traceback   as _traceback
 import spinmob     as _s
 import time        as _time
+import numpy       as _n
+import queue       as _queue
+import threading   as _threading
 
-from pid_controller_api import pid_api
+import pid_controller_api       as _api
+import pid_controller_discovery as _discovery
+import pid_controller_autotune  as _autotune
+import pid_controller_export    as _export
+
+from pid_controller_api       import pid_api
+from pid_controller_coalescer import pid_coalescer
+from pid_controller_buffer  import ring_buffer
+from pid_controller_session import binary_session_logger, session_reader
 
 try: from serial.tools.list_ports import comports as _comports
 except: _comports = None
@@ -17,6 +27,15 @@ _dac_voltage   = 5.
 
 _debug_enabled = True
 
+# Columns of the live data buffer (and the plot)
+_buffer_columns = ['Time (s)', 'Temperature (C)', 'Temperature Error (C)', 'DAC Voltage (%)', 'Setpoint (C)']
+
+# Baud rates offered; the fast ones are negotiated after connecting (see pid_api.set_baudrate())
+_baudrates      = ['1200','2400','4800', '9600', '19200', '38400', '57600', '115200', '250000', '500000', '1000000']
+
+# Most points drawn per curve, however long the run (roughly the plot width in pixels)
+_plot_points    = 2000
+
 # Dark theme
 _s.settings['dark_theme_qt'] = True
 
@@ -51,10 +70,29 @@ class pid_controller(_g.BaseObject):
         
     window_size=[1,1] : list
         Dimensions of the window.
+    
+    buffer_capacity=100000 : int
+        Number of samples kept in memory for plotting.
+    
+    spill=True : bool
+        Whether to save samples that no longer fit in memory to a CSV file
+        named after the window and the time of connection.
+    
+    log_format='.pidbin' : str
+        Format of the files written by the Log button: binary session files
+        ('.pidbin'), or Parquet ('.parquet') or HDF5 ('.h5') files with the
+        port, baud rate and mode in their metadata (see 
+        pid_controller_export).
     """
-    def __init__(self, name='Arduino_PID', api_class = pid_api, temperature_limit=100, show=True, block=False, window_size=None):
+    def __init__(self, name='Arduino_PID', api_class = pid_api, temperature_limit=100, show=True, block=False, window_size=None, buffer_capacity=100000, spill=True,
+                 log_format='.pidbin'):
+        
+        # Live data buffer settings
+        self._buffer_capacity = buffer_capacity
+        self._spill           = spill
+        self._log_format      = log_format
         
-        if not _mp._serial: _s._warn('You need to install pyserial to use the Arduino based PID temperature controller.')
+        if not _api._serial: _s._warn('You need to install pyserial to use the Arduino based PID temperature controller.')
         
         # Remebmer the name.
         self.name = name
@@ -66,39 +104,30 @@ class pid_controller(_g.BaseObject):
         # Where the actual api will live after we connect.
         self.api = None
         self._api_class = api_class
+        
+        # Coalesces the number box writes to the api (see pid_coalescer)
+        self.coalescer = None
 
         # Create GUI window
         self.window   = _g.Window(self.name, autosettings_path=name+'.window',event_close = self._window_close)
         
-       # Get all the available ports
-        self._ports = [] # Actual port names for connecting
-        ports       = [] # Pretty port names for combo box
-        
-        default_port = None
-        
-        if _comports:
-            for inx, p in enumerate(_comports()):
-                self._ports.append(p.device)
-                ports      .append(p.description)
-                
-                if 'Arduino' in p.description:
-                    default_port = inx
-                    
-
-        # Append simulation port
-        ports      .append('Simulation')
-        self._ports.append('Simulation')
-        
-        # Append refresh port
-        ports      .append('Refresh - Update Ports List')
-        self._ports.append('Refresh - Update Ports List')
+        # Get all the available ports
+        self._ports, ports, default_port = self._list_ports()
         
         # Populate the GUI window 
         self.populate_window(ports, default_port, temperature_limit, show, block)
         
-        # Create Timer for collecting data 
-        self.timer = _g.Timer(interval_ms=1000, single_shot=False)
+        # Create Timer for updating the GUI from the streamed data
+        self.timer = _g.Timer(interval_ms=50, single_shot=False)
         self.timer.signal_tick.connect(self._timer_tick)
+        
+        # Find out which ports really are controllers, in the background
+        self._discovery_thread  = None
+        self._discovery_results = _queue.Queue()
+        self._discovery_found   = False # Whether discovery has picked a port yet
+        self.timer_discovery    = _g.Timer(interval_ms=100, single_shot=False)
+        self.timer_discovery.signal_tick.connect(self._timer_discovery_tick)
+        self._start_discovery()
 
         # Show the GUI!
         self.window.show(block)
@@ -110,8 +139,8 @@ class pid_controller(_g.BaseObject):
         Updates the temperature setpoint on the arduino.
         
         """
-        # Set the temperature setpoint
-        self.api.set_temperature_setpoint(self.number_setpoint.get_value())
+        # Set the temperature setpoint (sent by the coalescer)
+        self.coalescer.set_temperature_setpoint(self.number_setpoint.get_value())
     
     
     def _number_dac_changed(self):
@@ -131,7 +160,7 @@ class pid_controller(_g.BaseObject):
         # Convert floating point number into closest integer using _dac_bit_depth 
         bit_voltage = round( (2**_dac_bit_depth-1)*voltage/5.)
         
-        self.api.set_dac(bit_voltage)
+        self.coalescer.set_dac(bit_voltage)
         
         
     def _number_parameter_changed(self):
@@ -145,7 +174,7 @@ class pid_controller(_g.BaseObject):
         t_i  = self.number_integral    .get_value()
         t_d  = self.number_derivative  .get_value()
         
-        self.api.set_parameters(band, t_i, t_d)
+        self.coalescer.set_parameters(band, t_i, t_d)
 
 
     def _number_period_changed(self):
@@ -156,39 +185,42 @@ class pid_controller(_g.BaseObject):
         """
         _period = self.number_period.get_value()
         
-        self.api.set_period(_period)
+        self.coalescer.set_period(_period)
         
         
     def _timer_tick(self, *a):
         """
         Called whenever the timer ticks. 
-        Updates all parameters and the plot and saves the latest data.
+        Drains the samples collected by the api's streaming thread and
+        updates all parameters and the plot. Never waits on the serial line.
         
         """
+        samples = self.api.get_samples()
+        if not len(samples): return
         
-        t                        = _time.time()-self.t0
-        T, S, dac_level, P, I, D, period = self.api.get_all_variables()
-        
-        # Convert dac_level to a fraction (based on DAC bit depth)
-        output_fraction = dac_level/(2**_dac_bit_depth-1)
+        for x in samples:
+            
+            # Convert dac_level to a fraction (based on DAC bit depth)
+            output_fraction = x.dac/(2**_dac_bit_depth-1)
+            
+            # Append this to the live data buffer
+            self.buffer.append([x.time-self.t0, x.temperature, x.temperature-x.setpoint, 100*output_fraction, x.setpoint])
         
         # Compute the dac output voltage
         dac_voltage = _dac_voltage*output_fraction
         
         # Update the temperature, dac voltage, and setpoint
-        self.number_temperature.set_value(T)
+        self.number_temperature.set_value(x.temperature)
         self.number_dac        .set_value(dac_voltage, block_signals=True)
-        self.number_setpoint   .set_value(S, block_signals=True)
+        self.number_setpoint   .set_value(x.setpoint, block_signals=True)
         
         # Update control parameters
-        self.number_proportional.set_value(P, block_signals=True)
-        self.number_integral    .set_value(I, block_signals=True)
-        self.number_derivative  .set_value(D, block_signals=True)
-        self.number_period      .set_value(period, block_signals=True)
-                
-        # Append this to the databox
-        self.plot.append_row([t, T, T-S, 100*output_fraction], ckeys=['Time (s)', 'Temperature (C)', 'Temperature Error (C)', 'DAC Voltage (%)'],)
-        self.plot.plot()        
+        self.number_proportional.set_value(x.band, block_signals=True)
+        self.number_integral    .set_value(x.t_i, block_signals=True)
+        self.number_derivative  .set_value(x.t_d, block_signals=True)
+        self.number_period      .set_value(x.period, block_signals=True)
+        
+        self._update_plot()
 
         # Update GUI
         self.window.process_events()
@@ -204,11 +236,31 @@ class pid_controller(_g.BaseObject):
 
         # If we checked it, open the connection and start the timer.
         if self.button_connect.is_checked():
+            
+            # Let any discovery probes release the ports
+            if self._discovery_thread is not None: self._discovery_thread.join()
+            
+            # Forget any replayed session
+            if self.session is not None:
+                self.session = None
+                self.buffer  = None
+                self.t0      = None
+                self._plot_window = (None, None)
+            self.button_load.disable()
+            
             port = self.get_selected_port()
             self.api = self._api_class(
                     port=port,
                     baudrate=int(self.combo_baudrates.get_text()),
                     timeout=self.number_timeout.get_value())
+            if self.button_stats.is_checked(): self.api.enable_stats()
+            
+            # Show the rate actually negotiated
+            if str(self.api.baudrate) in _baudrates:
+                self.combo_baudrates.set_index(_baudrates.index(str(self.api.baudrate)), block_signals=True)
+            
+            # Number box changes go through here, so dragging them does not flood the serial line
+            self.coalescer = pid_coalescer(self.api)
             
             # If we're in simulation mode
             if self.api.simulation:
@@ -218,28 +270,35 @@ class pid_controller(_g.BaseObject):
             else:
                 # Display connection status to user
                 self.label_status.set_text('Connected').set_colors('white' if _s.settings['dark_theme_qt'] else 'blue')
-                
-                self.button_open_loop  .enable()
-                self.button_closed_loop.enable()
-                
-                # Get temperature and parameter data currently on the arduino
-                T            = self.api.get_temperature()
-                S            = self.api.get_temperature_setpoint()
-                period       = self.api.get_period()
-                P, I, D      = self.api.get_parameters()
-                dac_output   = self.api.get_dac()
-                
-                # Update the temperature, setpoint, and parameter tabs
-                self.number_temperature(T)
-                self.number_setpoint    .set_value(S,          block_signals=True)
-                self.number_period      .set_value(period,     block_signals=True)
-                self.number_proportional.set_value(P,          block_signals=True)
-                self.number_integral    .set_value(I,          block_signals=True)
-                self.number_derivative  .set_value(D,          block_signals=True)
-                self.number_dac         .set_value(dac_output, block_signals=True)
+            
+            # The simulator streams and tunes like a real arduino
+            self.button_open_loop  .enable()
+            self.button_closed_loop.enable()
+            self.button_log        .enable()
+            self.button_autotune   .enable()
+            
+            # Get temperature and parameter data currently on the arduino (one round trip)
+            T, S, dac_output, P, I, D, period = self.api.get_all_variables()[:7]
+            
+            # Update the temperature, setpoint, and parameter tabs
+            self.number_temperature(T)
+            self.number_setpoint    .set_value(S,          block_signals=True)
+            self.number_period      .set_value(period,     block_signals=True)
+            self.number_proportional.set_value(P,          block_signals=True)
+            self.number_integral    .set_value(I,          block_signals=True)
+            self.number_derivative  .set_value(D,          block_signals=True)
+            self.number_dac         .set_value(_dac_voltage*dac_output/(2**_dac_bit_depth-1), block_signals=True)
+            
+            # Don't resend what the arduino already has
+            self.coalescer.refresh([T, S, dac_output, P, I, D, period])
 
             # Record the time if it's not already there.
             if self.t0 is None: self.t0 = _time.time()
+            
+            # Create the live data buffer if it's not already there.
+            if self.buffer is None: 
+                self.buffer = ring_buffer(_buffer_columns, self._buffer_capacity, 
+                    spill_path = self.name+_time.strftime('_%Y-%m-%d_%H-%M-%S.csv') if self._spill else None)
 
             # Enable the grid
             self.grid_bot.enable()
@@ -260,10 +319,17 @@ class pid_controller(_g.BaseObject):
             if self.button_closed_loop.is_checked(): self.button_closed_loop.click()
             
                             
+            # Stop logging and autotuning
+            if self.button_log.is_checked(): self.button_log.click()
+            if self.autotune is not None: self.autotune.stop()
+            
             self.button_open_loop  .disable()
             self.button_closed_loop.disable()
+            self.button_log        .disable()
+            self.button_autotune   .disable()
             
-            # Disconnect the API
+            # Send any pending changes and disconnect the API
+            self.coalescer.close()
             self.api.disconnect()
             
             #
@@ -274,6 +340,7 @@ class pid_controller(_g.BaseObject):
             self.grid_bot.disable()
 
             # Re-enable other controls
+            self.button_load.enable()
             self.combo_baudrates.enable()
             self.combo_ports.enable()
             self.number_timeout.enable()
@@ -282,6 +349,160 @@ class pid_controller(_g.BaseObject):
             self.label_status.set_text('Disconnected').set_colors('white' if _s.settings['dark_theme_qt'] else 'blue')
     
     
+    def _button_log_toggled(self, *a):
+        """
+        Called when the log button is toggled in the GUI.
+        Starts or stops streaming samples to disk.
+        """
+        if self.button_log.is_checked():
+            path = self.name+_time.strftime('_%Y-%m-%d_%H-%M-%S')
+            if self._log_format == '.pidbin': self.logger = binary_session_logger(path)
+            else: self.logger = _export.columnar_session_logger(path, self._log_format, metadata=dict(
+                    port=self.get_selected_port(), baudrate=self.api.baudrate, mode=self.api.get_mode()))
+            self.api.add_listener(self.logger.log)
+            self.button_log.set_colors(text='white', background='blue')
+        
+        elif self.logger is not None:
+            self.api.remove_listener(self.logger.log)
+            self.logger.close()
+            self.logger = None
+            self.button_log.set_colors(background='')
+    
+    
+    def _button_load_clicked(self, *a):
+        """
+        Called when the load session button is clicked in the GUI.
+        Replays a binary session file in the plot. Only the newest
+        buffer_capacity samples are loaded into memory; zooming in on older 
+        data reads just the visible window from the (memory-mapped) file.
+        """
+        path = _s.dialogs.load('*.pidbin', text='Load a session')
+        if path is None: return
+        
+        session = session_reader(path)
+        _debug('Loading %d samples from %s'%(len(session), path))
+        
+        def history(t0, t1, points):
+            records = session.slice(t0+session.start_time, t1+session.start_time)
+            if len(records) > points: return None
+            return _session_rows(records, session.start_time)
+        
+        # Summarize the whole session, keeping the newest part in memory
+        self.session = session
+        self.t0      = session.start_time
+        self.buffer  = ring_buffer(_buffer_columns, self._buffer_capacity, history=history)
+        for n in range(0, len(session), self._buffer_capacity):
+            self.buffer.extend(_session_rows(session.records[n:n+self._buffer_capacity], session.start_time))
+        
+        self.label_status.set_text('Replay: '+path).set_colors('white' if _s.settings['dark_theme_qt'] else 'blue')
+        self.grid_bot.enable()
+        self._plot_window = (None, None)
+        self._update_plot()
+    
+    
+    def _button_autotune_clicked(self, *a):
+        """
+        Called when the autotune button is clicked in the GUI. Runs a relay
+        autotune (see pid_controller_autotune) around the current setpoint
+        in a background thread, in OPEN_LOOP mode so the oscillation is 
+        plotted live. Clicking again while it runs stops it.
+        """
+        if self.autotune is not None:
+            self.autotune.stop()
+            return
+        
+        # Stream data in OPEN_LOOP mode while tuning
+        if not self.button_open_loop.is_checked(): self.button_open_loop.click()
+        self.number_dac.disable()
+        
+        self.autotune = _autotune.relay_autotune(self.api, setpoint=self.number_setpoint.get_value())
+        self._autotune_thread = _threading.Thread(target=self._autotune_run, daemon=True)
+        self._autotune_thread.start()
+        self.timer_autotune.start()
+        
+        self.button_autotune.set_text('Stop Autotune').set_colors(text='white', background='purple')
+        self.label_status.set_text('Autotuning...')
+    
+    
+    def _autotune_run(self):
+        """
+        Body of the autotune thread. The new parameters go through the
+        coalescer, so it knows what the arduino has.
+        """
+        tune = self.autotune
+        try:
+            tune.run()
+            self.coalescer.set_parameters(tune.band, tune.t_i, tune.t_d)
+            self.coalescer.flush()
+        except Exception as e: self._autotune_error = e
+        finally:
+            # The relay moved the dac (and mode) behind the coalescer's back
+            try:    self.coalescer.refresh()
+            except: self.coalescer.forget()
+    
+    
+    def _timer_autotune_tick(self, *a):
+        """
+        Called whenever the autotune timer ticks. Shows the new parameters 
+        once the autotune thread is done.
+        """
+        if self._autotune_thread.is_alive(): return
+        self.timer_autotune.stop()
+        
+        tune = self.autotune
+        self.autotune = None
+        self.button_autotune.set_text('Autotune').set_colors(background='')
+        if self.button_open_loop.is_checked(): self.number_dac.enable()
+        
+        if self._autotune_error is not None:
+            self.label_status.set_text('Autotune failed: '+str(self._autotune_error))
+            self._autotune_error = None
+            return
+        
+        self.number_proportional.set_value(tune.band, block_signals=True)
+        self.number_integral    .set_value(tune.t_i,  block_signals=True)
+        self.number_derivative  .set_value(tune.t_d,  block_signals=True)
+        self.label_status.set_text('Autotuned: Ku = %.4g, Pu = %.3g s'%(tune.ku, tune.pu))
+    
+    
+    def _button_stats_toggled(self, *a):
+        """
+        Called when the stats button is toggled in the GUI. Turns the api's
+        per-command instrumentation on or off, and shows it in the stats
+        panel (see _timer_stats_tick()).
+        """
+        if self.button_stats.is_checked():
+            if self.api is not None: self.api.enable_stats()
+            self.grid_stats.show()
+            self.timer_stats.start()
+            self._timer_stats_tick()
+            self.button_stats.set_colors(text='white', background='blue')
+        
+        else:
+            if self.api is not None: self.api.enable_stats(False)
+            self.timer_stats.stop()
+            self.grid_stats.hide()
+            self.button_stats.set_colors(background='')
+    
+    
+    def _button_reset_stats_clicked(self, *a):
+        """
+        Called when the reset stats button is clicked in the GUI.
+        """
+        if self.api is not None: self.api.reset_stats()
+        self._timer_stats_tick()
+    
+    
+    def _timer_stats_tick(self, *a):
+        """
+        Called whenever the stats timer ticks. Shows the api's counters.
+        """
+        if self.api is None: self.label_stats.set_text('Not connected.')
+        else:                self.label_stats.set_text(_format_stats(self.api.get_stats()) + 
+                                                       '\nStreaming: %d missed polls, %d errors'%(self.api.missed_ticks, self.api.stream_errors) +
+                                                       '\nWrites: %(sent)d sent, %(coalesced)d coalesced, %(skipped)d skipped, %(errors)d errors'%self.coalescer.get_stats())
+    
+    
     def _button_closed_loop_toggled(self):
         """
         Called when the closed loop button is toggled in the GUI.
@@ -311,12 +532,12 @@ class pid_controller(_g.BaseObject):
                 self.api.set_mode("CLOSED_LOOP")
 
                 # Verify the arduino has changed mode
-                if( self.api.get_mode() != "CLOSED_LOOP"):
+                if( self.api.get_mode(fresh=True) != "CLOSED_LOOP"):
                     print("problem...")
                     raise Exception("Arduino failed to change mode to CLOSED_LOOP.")
                     
-                # Start data collection timer
-                self.timer.start()
+                # Start data collection
+                self._start_acquisition()
                 
                 # Enable access to PID variables in the GUI
                 self.number_proportional.enable()
@@ -336,8 +557,8 @@ class pid_controller(_g.BaseObject):
                 
 
         else:
-            # Stop the data collection timer
-            self.timer.stop()
+            # Stop data collection
+            self._stop_acquisition()
             
             # Disable access to PID variables in the GUI
             self.number_proportional.disable()
@@ -376,13 +597,16 @@ class pid_controller(_g.BaseObject):
                 # Set the arduino to closed loop mode
                 self.api.set_mode("OPEN_LOOP")
                 
+                # The control loop may have moved the dac since it was last set
+                self.coalescer.forget('set_dac')
+                
                 # Verify the arduino has changed mode
-                if( self.api.get_mode() != "OPEN_LOOP"):
+                if( self.api.get_mode(fresh=True) != "OPEN_LOOP"):
                     print("problem...")
                     raise Exception("Arduino failed to change mode to OPEN_LOOP.")
                 
-                # Start data collection timer
-                self.timer.start()
+                # Start data collection
+                self._start_acquisition()
                 
                 # Disable access to manual control variables in the GUI
                 self.number_dac.enable()
@@ -397,8 +621,8 @@ class pid_controller(_g.BaseObject):
                 self.label_status.set_text('Could not get temperature.').set_colors('pink' if _s.settings['dark_theme_qt'] else 'red')
         else:
             
-            # Stop data collection timer
-            self.timer.stop()
+            # Stop data collection
+            self._stop_acquisition()
             
             # Disable access to manual control variables in the GUI
             self.number_dac.disable()
@@ -408,52 +632,185 @@ class pid_controller(_g.BaseObject):
             
             _debug('Open loop mode disabled.')
 
+    def _start_acquisition(self):
+        """
+        Starts the api's streaming thread and the GUI update timer.
+        """
+        self.api.start_streaming(rate=self.number_rate.get_value())
+        self.timer.start()
+
+
+    def _stop_acquisition(self):
+        """
+        Stops the GUI update timer and the api's streaming thread, then
+        plots whatever samples were still waiting.
+        """
+        self.timer.stop()
+        self.api.stop_streaming()
+        self._timer_tick()
+
+
+    def _number_rate_changed(self, *a):
+        """
+        Called when someone changes the acquisition rate in the GUI.
+        Restarts streaming at the new rate if it is running.
+        """
+        if self.api is not None and self.api.is_streaming():
+            self.api.start_streaming(rate=self.number_rate.get_value())
+
+
     def _ports_changed(self):
         """
-        Refreshes the list of availible serial ports in the GUI.
+        Refreshes the list of availible serial ports in the GUI. Only ports
+        that appeared or disappeared are changed, then the new list is 
+        probed for controllers.
 
         """
         if self.get_selected_port() == 'Refresh - Update Ports List':
             
-            len_ports = len(self.combo_ports.get_all_items())
+            devices, labels, default_port = self._list_ports()
+            items = self.combo_ports.get_all_items()
+            
+            # Remove the ports that went away
+            for n in range(len(self._ports)-1, -1, -1):
+                if self._ports[n] not in devices:
+                    items.pop(n)
+                    self._ports.pop(n)
+            
+            # Add the new ones, before Simulation
+            for device, label in zip(devices, labels):
+                if device not in self._ports:
+                    n = len(self._ports)-2
+                    items.insert(n, label)
+                    self._ports.insert(n, device)
+            
+            self._set_port_items(items)
             
-            # Clear existing ports
-            if(len_ports > 1): # Stop recursion!
-                for n in range(len_ports):
-                    self.combo_ports.remove_item(0)
-            else:
-                return
-                self.combo_ports.remove_item(0)
-                 
-            self._ports = [] # Actual port names for connecting
-            ports       = [] # Pretty port names for combo box
-                
-            default_port = 0
-             
-            # Get all the available ports
-            if _comports:
-                for inx, p in enumerate(_comports()):
-                    self._ports.append(p.device)
-                    ports      .append(p.description)
-                    
-                    if 'Arduino' in p.description:
-                        default_port = inx
-                        
-            # Append simulation port
-            ports      .append('Simulation')
-            self._ports.append('Simulation')
-            
-            # Append refresh port
-            ports      .append('Refresh - Update Ports List')
-            self._ports.append('Refresh - Update Ports List')
-             
-            # Add the new list of ports
-            for item in ports:
-                self.combo_ports.add_item(item)
-             
             # Set the new default port
-            self.combo_ports.set_index(default_port)
+            self.combo_ports.set_index(self._ports.index(devices[default_port or 0]), block_signals=True)
+            
+            self._discovery_found = False
+            self._start_discovery()
+    
+    
+    def _set_port_items(self, items):
+        """
+        Replaces the labels of the port list, keeping the selected index. The
+        egg ComboBox can only add items at the end, so the list is rebuilt.
+        """
+        index = self.combo_ports.get_index()
+        self.combo_ports.block_signals()
+        self.combo_ports.clear()
+        for item in items: self.combo_ports.add_item(item)
+        self.combo_ports.set_index(index)
+        self.combo_ports.unblock_signals()
+    
+    
+    def _list_ports(self):
+        """
+        Returns the port names (for connecting), their descriptions (for the
+        combo box) and the index of the default port, a likely arduino.
+        """
+        devices      = []
+        labels       = []
+        default_port = None
+        
+        if _comports:
+            for inx, p in enumerate(_comports()):
+                devices.append(p.device)
+                labels .append(p.description)
+                
+                if 'Arduino' in p.description:
+                    default_port = inx
+        
+        # Append simulation and refresh ports
+        devices += ['Simulation', 'Refresh - Update Ports List']
+        labels  += ['Simulation', 'Refresh - Update Ports List']
+        
+        return devices, labels, default_port
+    
+    
+    def _start_discovery(self):
+        """
+        Probes the serial ports for controllers in a background thread (see
+        pid_controller_discovery.discover()). Results are shown by
+        _timer_discovery_tick() as they arrive.
+        """
+        if not _comports or (self._discovery_thread is not None and self._discovery_thread.is_alive()): return
         
+        self._discovery_thread = _threading.Thread(target=_discovery.discover, daemon=True, kwargs=dict(
+            baudrate = min(int(self.combo_baudrates.get_text()), _api._baudrates[0]),
+            callback = lambda device, result: self._discovery_results.put((device, result))))
+        self._discovery_thread.start()
+        self.timer_discovery.start()
+    
+    
+    def _timer_discovery_tick(self, *a):
+        """
+        Called whenever the discovery timer ticks. Marks the ports found to
+        be controllers, and selects the first one unless we are connected.
+        """
+        while True:
+            try:                 device, result = self._discovery_results.get_nowait()
+            except _queue.Empty: break
+            
+            if device not in self._ports or not result['controller']: continue
+            n     = self._ports.index(device)
+            items = self.combo_ports.get_all_items()
+            items[n] = result['description']+' (PID controller)'
+            self._set_port_items(items)
+            
+            if not self._discovery_found and not self.button_connect.is_checked():
+                self.combo_ports.set_index(n, block_signals=True)
+                self._discovery_found = True
+        
+        if not self._discovery_thread.is_alive() and self._discovery_results.empty(): self.timer_discovery.stop()
+    
+    
+    def _update_plot(self):
+        """
+        Shows the visible part of the live data buffer, decimated to at most
+        _plot_points points per curve (full resolution when zoomed in far
+        enough), so drawing time does not grow with the length of the run.
+        """
+        data = self.buffer.plot_data(*self._plot_window, points=_plot_points)
+        for n, k in enumerate(self.buffer.columns): self.plot[k] = data[:,n]
+        
+        self._plotting = True
+        self.plot.plot()
+        self._plotting = False
+        
+        # Watch for zooming on any new plot widgets
+        for w in self.plot.plot_widgets:
+            if w not in self._zoom_widgets:
+                w.getViewBox().sigXRangeChanged.connect(self._plot_range_changed)
+                self._zoom_widgets.append(w)
+    
+    
+    def _plot_range_changed(self, viewbox, x_range):
+        """
+        Called when someone zooms or pans the plot. Reloads the plot with
+        only the visible time window, at the best resolution available. A 
+        window reaching the newest data keeps following it.
+        """
+        if self._plotting or self.buffer is None or not len(self.buffer): return
+        
+        t0, t1 = x_range
+        if t1 >= self.buffer.view()[-1,0]: t1 = None
+        self._plot_window = (t0, t1)
+        
+        self._update_plot()
+    
+    
+    def _plot_cleared(self, *a):
+        """
+        Called when the plot's clear button is clicked. Empties the live
+        data buffer too, so the cleared data does not come back.
+        """
+        if self.buffer is not None: self.buffer.clear()
+        self._plot_window = (None, None)
+    
+    
     def _new_exception(self, a):
         """
         Just updates the status with the exception.
@@ -493,6 +850,9 @@ class pid_controller(_g.BaseObject):
         self.window.new_autorow()
         self.grid_mid = self.window.place_object(_g.GridLayout(margins=False),0,1,alignment=1,column_span=1) 
         
+        self.window.new_autorow()
+        self.grid_stats = self.window.place_object(_g.GridLayout(margins=False),0,2,alignment=1,column_span=2)
+        
         self.window.new_autorow()
         self.grid_temperature = self.window.place_object(_g.GridLayout(margins=False),0,3,alignment=1,column_span=1)
         
@@ -515,7 +875,7 @@ class pid_controller(_g.BaseObject):
         # Add BAUD selector to GUI 
         self.grid_top.add(_g.Label('Baud:'))
         self.combo_baudrates = self.grid_top.add(
-            _g.ComboBox(['1200','2400','4800', '9600', '19200', '38400', '57600', '115200'],default_index=7,autosettings_path=
+            _g.ComboBox(_baudrates,default_index=7,autosettings_path=
                         self.name+'.combo_baudrates'))
 
         # Add Timeout selector to GUI 
@@ -524,6 +884,12 @@ class pid_controller(_g.BaseObject):
             _g.NumberBox(500, dec=True, bounds=(1, None), suffix=' ms',
                          tip='How long to wait for an answer before giving up (ms).', autosettings_path=self.name+'.number_timeout')).set_width(100)
 
+        # Add acquisition rate selector to GUI
+        self.grid_top.add(_g.Label('Rate:'))
+        self.number_rate = self.grid_top.add(
+            _g.NumberBox(10, bounds=(0.1, 50), suffix=' Hz', signal_changed=self._number_rate_changed,
+                         tip='How often to poll the arduino for new data (Hz).', autosettings_path=self.name+'.number_rate')).set_width(100)
+
         # Add a button to connect to serial port to GUI
         self.button_connect  = self.grid_top.add(_g.Button('Connect', checkable=True,tip='Connect to the selected serial port.'))
         self.button_connect.signal_toggled.connect(self._button_connect_toggled)
@@ -539,6 +905,30 @@ class pid_controller(_g.BaseObject):
         self.button_closed_loop = self.grid_mid.add(_g.Button('Closed Loop',checkable=True, tip='Enable PID temperature control.')).disable()
         self.button_closed_loop.signal_toggled.connect(self._button_closed_loop_toggled)
         
+        # Stream every sample to disk
+        self.button_log = self.grid_mid.add(_g.Button('Log to Disk', checkable=True, tip='Stream every sample to rotating binary session files named after this window.')).disable()
+        self.button_log.signal_toggled.connect(self._button_log_toggled)
+        
+        # Relay autotune
+        self.button_autotune = self.grid_mid.add(_g.Button('Autotune', tip='Find band, t_i and t_d from a relay experiment around the setpoint.')).disable()
+        self.button_autotune.signal_clicked.connect(self._button_autotune_clicked)
+        
+        # Replay a logged session
+        self.button_load = self.grid_mid.add(_g.Button('Load Session', tip='Replay a binary session file in the plot.'))
+        self.button_load.signal_clicked.connect(self._button_load_clicked)
+        
+        # Serial statistics panel (hidden until the stats button is checked)
+        self.button_stats = self.grid_mid.add(_g.Button('Stats', checkable=True, tip='Show per-command serial latency, traffic and error counts.'))
+        self.button_stats.signal_toggled.connect(self._button_stats_toggled)
+        
+        self.button_reset_stats = self.grid_stats.add(_g.Button('Reset', tip='Zero the serial statistics.'), alignment=1)
+        self.button_reset_stats.signal_clicked.connect(self._button_reset_stats_clicked)
+        self.label_stats = self.grid_stats.add(_g.Label(''), alignment=1).set_style('font-family: monospace; font-size: 9pt')
+        self.grid_stats.hide()
+        
+        self.timer_stats = _g.Timer(interval_ms=1000, single_shot=False)
+        self.timer_stats.signal_tick.connect(self._timer_stats_tick)
+        
         
         # Status
         self.label_status = self.grid_top.add(_g.Label(''))
@@ -552,7 +942,23 @@ class pid_controller(_g.BaseObject):
 
 
         # Other data
-        self.t0 = None
+        self.t0      = None
+        self.buffer  = None
+        self.logger  = None
+        self.session = None # session_reader being replayed, if any
+        
+        # Autotune in progress, if any
+        self.autotune         = None
+        self._autotune_thread = None
+        self._autotune_error  = None
+        self.timer_autotune   = _g.Timer(interval_ms=500, single_shot=False)
+        self.timer_autotune.signal_tick.connect(self._timer_autotune_tick)
+        
+        # Visible time window of the plot (None means the start or end of 
+        # the data) and plot widgets we listen to for zooming
+        self._plot_window  = (None, None)
+        self._plotting     = False
+        self._zoom_widgets = []
 
         # Run the base object stuff and autoload settings
         _g.BaseObject.__init__(self, autosettings_path=self.name)
@@ -633,12 +1039,36 @@ class pid_controller(_g.BaseObject):
             file_type='*.csv',
             autosettings_path=self.name+'.plot',
             delimiter=',', show_logger=True), alignment=0, column_span=10)
+        self.plot.button_clear.signal_clicked.connect(self._plot_cleared)
 
         # Bottom log file controls
         self.grid_bot.new_autorow()
         
         
 
+def _session_rows(records, start_time):
+    """
+    Converts session file records (see pid_controller_session) into rows
+    of the live data buffer.
+    """
+    return _n.column_stack([records['time']-start_time, records['temperature'], records['temperature']-records['setpoint'],
+                            100*records['dac']/(2**_dac_bit_depth-1), records['setpoint']])
+
+def _format_stats(stats):
+    """
+    Formats a pid_api.get_stats() snapshot for the stats panel.
+    """
+    def ms(x): return '     -' if x is None else '%6.1f'%x
+    
+    lines = ['%.0f s: %d commands, %.1f kB out, %.1f kB in, %d timeouts, %d parse failures'%(
+             stats['duration'], stats['count'], stats['bytes_out']/1e3, stats['bytes_in']/1e3, stats['timeouts'], stats['parse_failures'])]
+    
+    for name, c in sorted(stats['commands'].items()):
+        lines.append('%-18s %7d  mean %s  p50 %s  p99 %s  max %s ms  %d timeouts  %d parse failures'%(
+                     name, c['count'], ms(c['mean']), ms(c['p50']), ms(c['p99']), ms(c['max']), c['timeouts'], c['parse_failures']))
+    
+    return '\n'.join(lines)
+
 def _debug(*a):
     if _debug_enabled:
         s = []
@@ -1,5 +1,13 @@
-import mcphysics   as _mp
-import time as _time
+import time        as _time
+import threading   as _threading
+import collections as _collections
+import struct      as _struct
+import bisect      as _bisect
+
+# Only pyserial is needed to talk to the hardware. The simulator (and with 
+# it NumPy) is imported when a simulation is first started.
+try:    import serial as _serial
+except: _serial = None
 
 
 _serial_left_marker  = '<'
@@ -7,6 +15,377 @@ _serial_right_marker = '>'
 
 _debug_enabled       = True 
 
+# Banner the firmware prints at the end of setup(), and how long a reset
+# arduino may take to get there (bootloader + setup) before we start probing.
+_ready_banner        = 'READY'
+_boot_time           = 2.0
+_probe_interval      = 0.5
+
+# Baud rates the firmware can start at (BAUD in PID.ino), tried in this order
+# by detect_baudrate(). Faster rates are only reached with set_baudrate().
+_baudrates           = [115200, 57600, 38400, 19200, 9600, 4800, 2400, 1200]
+_detect_timeout      = 1200
+
+# Rates an arduino at 16 MHz generates exactly, for set_baudrate(), and how
+# long (ms) the firmware waits for a command at a new rate before going back.
+_high_baudrates      = [250000, 500000, 1000000]
+_baud_confirm_time   = 1000
+
+# Size of the arduino's serial receive buffer. Pipelined commands are sent
+# so that no more than this many bytes are ever waiting to be processed.
+_rx_window           = 64
+
+# Binary telemetry frames (see set_telemetry_format()): start byte, payload
+# length, little-endian payload, CRC-8 (polynomial 0x07) of length+payload.
+_frame_start       = 0xA5
+_telemetry_struct  = _struct.Struct('<ffhfffHI') # temperature, setpoint, dac, band, t_i, t_d, period, time_recent
+_legacy_struct     = _struct.Struct('<ffhfffH')  # Same, from firmware without time_recent
+
+def _make_crc8_table(polynomial=0x07):
+    table = []
+    for n in range(256):
+        crc = n
+        for i in range(8): crc = ((crc << 1) ^ polynomial) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+_crc8_table = _make_crc8_table()
+
+def _crc8(data):
+    """
+    CRC-8 with polynomial 0x07 and zero initial value, matching avr-libc's
+    _crc8_ccitt_update() used by the firmware.
+    """
+    crc = 0
+    for b in data: crc = _crc8_table[crc ^ b]
+    return crc
+
+# One telemetry sample, as produced by the streaming acquisition thread.
+# time is the host time.time() of the measurement, device_time the
+# arduino's millis() when it was taken (nan for older firmware), and missed
+# the number of scheduled polls skipped just before this one.
+sample = _collections.namedtuple('sample', ['time', 'temperature', 'setpoint', 'dac', 'band', 't_i', 't_d', 'period', 'device_time', 'missed'])
+
+def _parse_floats(reply):
+    """
+    Converts a comma-separated reply into a tuple of floats.
+    """
+    return tuple(float(x) for x in reply.split(','))
+
+def _parse_all_variables(reply):
+    """
+    Converts an ASCII get_all_variables reply into a tuple of 8 floats. 
+    Older firmware sends no time_recent; it is returned as nan.
+    """
+    values = _parse_floats(reply)
+    if len(values) == 7: return values + (float('nan'),)
+    if len(values) != 8: raise ValueError('Expected 8 values, got %r.'%reply)
+    return values
+
+def _parse_frame(payload):
+    """
+    Unpacks a binary get_all_variables frame payload, like 
+    _parse_all_variables().
+    """
+    if len(payload) == _legacy_struct.size: return _legacy_struct.unpack(payload) + (float('nan'),)
+    return _telemetry_struct.unpack(payload)
+
+# Value of the state mirror (see pid_api.get_state()) each setter changes
+_setter_state = {'set_setpoint': 'setpoint', 'set_parameters': 'parameters', 'set_period': 'period', 'set_mode': 'mode'}
+
+# Readings kept by the arduino (see pid_api.get_history()): HISTORY_REPLY,
+# the most readings per reply. The dtypes of the readings need NumPy, so
+# they are only built when history is first downloaded (_history_dtypes()).
+_history_reply = 25
+_history_types = None
+
+def _history_dtypes():
+    """
+    Returns the dtype of one reading of a binary get_history reply, and 
+    that of the readings returned by pid_api.get_history().
+    """
+    global _history_types
+    if _history_types is None:
+        import numpy as _n
+        _history_types = (_n.dtype([('device_time', '<u4'), ('temperature', '<f4'), ('dac', '<i2')]),
+                          _n.dtype([('seq', '<u4'), ('time', '<f8'), ('device_time', '<u4'), ('temperature', '<f4'), ('dac', '<i2')]))
+    return _history_types
+
+def _parse_history(reply):
+    """
+    Converts an ASCII get_history reply (first;time,temperature,dac;...)
+    into the sequence number of the first reading and an array of 
+    readings (see _history_dtypes()), in one pass over the numbers.
+    """
+    import numpy as _n
+    
+    head, _, rest = reply.partition(';')
+    values = _n.array(rest.replace(';', ',').split(','), dtype=float) if len(rest) else _n.zeros(0)
+    if len(values) % 3: raise ValueError('Malformed get_history reply %r.'%reply)
+    
+    values   = values.reshape(-1, 3)
+    readings = _n.zeros(len(values), _history_dtypes()[0])
+    readings['device_time'], readings['temperature'], readings['dac'] = values.T
+    return int(head), readings
+
+def _parse_history_frame(payload):
+    """
+    Unpacks a binary get_history frame payload, like _parse_history().
+    """
+    import numpy as _n
+    
+    reading = _history_dtypes()[0]
+    if len(payload) < 4 or (len(payload)-4) % reading.itemsize: 
+        raise ValueError('Binary get_history frame of %d bytes.'%len(payload))
+    return _struct.unpack_from('<I', payload)[0], _n.frombuffer(payload, reading, offset=4)
+
+def _parse_ack(reply):
+    """
+    Setters answer a tagged command with an empty line, or with an error
+    message if they refused it. Returns True if the command was accepted.
+    """
+    if len(reply): print(reply)
+    return not len(reply)
+
+def _parse_tag(raw):
+    """
+    Returns the sequence number of a tagged reply's prefix (raw ends with 
+    the ';' of #N;), or None if the last line read is not a tag, e.g. an
+    untagged reply that happens to contain ';'. Earlier lines are strays.
+    """
+    line = raw[raw.rfind(b'\n')+1:]
+    if not line.startswith(b'#'): return None
+    try:               return int(line[1:-1])
+    except ValueError: return None
+
+def _handshake(serial, timeout=5000, reset=True):
+    """
+    Body of pid_api.handshake(), for any open serial port.
+    """
+    t0          = _time.monotonic()
+    deadline    = t0 + timeout/1000
+    probe_time  = t0 + (_boot_time if reset else 0)
+    serial_time = serial.timeout
+    probes      = 0 # Probes not answered yet
+    
+    try:
+        while _time.monotonic() < deadline:
+            
+            # Probe if the banner is late
+            if _time.monotonic() >= probe_time:
+                serial.write((_serial_left_marker+'get_mode'+_serial_right_marker).encode())
+                probes    += 1
+                probe_time = _time.monotonic() + _probe_interval
+            
+            # Wait for a line, until the next probe at most
+            serial.timeout = max(0, min(probe_time, deadline) - _time.monotonic())
+            line = serial.readline().decode(errors='replace').strip()
+            if line not in [_ready_banner, 'OPEN_LOOP', 'CLOSED_LOOP']: continue
+            
+            _debug('Arduino on %s ready after %.0f ms (%s).'%(serial.port, 1000*(_time.monotonic()-t0), line))
+            
+            # Collect the answers to any other probes still on their way
+            if line != _ready_banner: probes -= 1
+            serial.timeout = _probe_interval
+            while probes > 0 and len(serial.readline()): probes -= 1
+            return True
+        
+        return False
+    
+    finally: serial.timeout = serial_time
+
+
+class clock_sync():
+    """
+    Online estimate of the mapping from the arduino's millis() clock to the
+    host's monotonic clock,
+    
+        host = device + offset + skew*device     (s)
+    
+    from pairs of (host time a reply arrived, device timestamp in it). The
+    device stamps its data before the reply is received, so every pair 
+    bounds offset from above, and the pairs with the least delay are the
+    best. The smallest host-device difference in each block of device time
+    is kept, and a least-squares line through these minima over the last
+    few blocks gives offset and skew. millis() wrapping around (every 49.7
+    days) is unwrapped, and the arduino restarting resets the estimate.
+    
+    Parameters
+    ----------
+    block=10 : float
+        Length of the blocks (s of device time).
+    
+    blocks=60 : int
+        Number of blocks in the fit.
+    """
+    def __init__(self, block=10, blocks=60):
+        self.block  = block
+        self._mins  = _collections.deque(maxlen=blocks) # (block number, device time, host-device)
+        self._wraps = 0
+        self._last  = None
+        self.reset()
+    
+    def reset(self):
+        """
+        Forgets everything, e.g. after the arduino restarted.
+        """
+        self._mins.clear()
+        self._wraps = 0
+        self._last  = None
+        self.offset = None
+        self.skew   = 0.0
+    
+    def _unwrap(self, device_ms):
+        """
+        Returns the device time (s) since boot, undoing millis() wraparound.
+        """
+        if self._last is not None and device_ms < self._last:
+            if self._last - device_ms > 2**31: self._wraps += 1
+            else:
+                _debug('Arduino clock went backwards; restarting clock sync.')
+                self.reset()
+        self._last = device_ms
+        return (device_ms + self._wraps*2**32)/1000
+    
+    def update(self, host, device_ms):
+        """
+        Adds a pair: the host monotonic time (s) a reply arrived, and the 
+        device millis() it carried. Returns the device time mapped onto 
+        the host clock (s).
+        """
+        d = self._unwrap(device_ms)
+        y = host - d
+        k = int(d // self.block)
+        
+        if len(self._mins) and self._mins[-1][0] == k:
+            if y < self._mins[-1][2]: self._mins[-1] = (k, d, y)
+        else: self._mins.append((k, d, y))
+        
+        # Least-squares line through the minima of the finished blocks, once
+        # there are enough of them; until then just the smallest difference
+        done = list(self._mins)[:-1]
+        n    = len(done)
+        if n < 3: self.offset, self.skew = min(x[2] for x in self._mins), 0.0
+        else:
+            dm  = sum(x[1] for x in done)/n
+            ym  = sum(x[2] for x in done)/n
+            sdd = sum((x[1]-dm)**2 for x in done)
+            self.skew   = sum((x[1]-dm)*(x[2]-ym) for x in done)/sdd if sdd else 0.0
+            self.offset = ym - self.skew*dm
+        
+        return d + self.offset + self.skew*d
+    
+    def to_host(self, device_ms):
+        """
+        Maps a device millis() onto the host monotonic clock (s), with the
+        current estimate.
+        """
+        d = (device_ms + self._wraps*2**32)/1000
+        return d + self.offset + self.skew*d
+
+
+# Latency histogram bins of pid_stats (ms): 5 per decade from 10 us to 10 s
+_stats_edges = [10**(k/5) for k in range(-10, 21)]
+
+class pid_stats():
+    """
+    Counters kept by a pid_api with instrumentation enabled (see 
+    pid_api.enable_stats()). For each command: how many were sent, the
+    bytes out and in, timeouts (replies that did not arrive in time), 
+    parse failures (replies that could not be understood) and a histogram 
+    of round-trip latencies. Only the histogram is kept, so the cost per 
+    command is a few dictionary updates whatever the length of the run.
+    """
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        """
+        Zeroes all the counters.
+        """
+        self.start_time = _time.time()
+        self.commands   = dict()
+    
+    def _get(self, name):
+        c = self.commands.get(name)
+        if c is None:
+            c = self.commands[name] = dict(count=0, bytes_out=0, bytes_in=0, timeouts=0, parse_failures=0, 
+                                           latency_sum=0.0, latency_max=0.0, histogram=[0]*(len(_stats_edges)+1))
+        return c
+    
+    def sent(self, name, size):
+        """
+        Counts a command and the bytes it took.
+        """
+        c = self._get(name)
+        c['count']     += 1
+        c['bytes_out'] += size
+    
+    def received(self, name, size, timeout=False):
+        """
+        Counts bytes received in reply to a command, and whether the reply
+        timed out.
+        """
+        c = self._get(name)
+        c['bytes_in'] += size
+        if timeout: c['timeouts'] += 1
+    
+    def latency(self, name, seconds):
+        """
+        Adds a round-trip time (s) to a command's histogram.
+        """
+        c  = self._get(name)
+        ms = 1000*seconds
+        c['latency_sum'] += ms
+        if ms > c['latency_max']: c['latency_max'] = ms
+        c['histogram'][_bisect.bisect(_stats_edges, ms)] += 1
+    
+    def parse_failure(self, name):
+        self._get(name)['parse_failures'] += 1
+    
+    def snapshot(self):
+        """
+        Returns a copy of the counters.
+        
+        Returns
+        -------
+        dict
+            'duration' (s since the last reset), 'histogram_edges' (ms), 
+            totals of 'count', 'bytes_out', 'bytes_in', 'timeouts' and
+            'parse_failures', and 'commands': for each command, those 
+            counters, its 'histogram' (counts below, between and above the
+            edges), and its latency 'mean', 'max', 'p50', 'p90' and 'p99' 
+            (ms; percentiles are the upper edge of the histogram bin they
+            fall in, at most the max).
+        """
+        totals   = dict(count=0, bytes_out=0, bytes_in=0, timeouts=0, parse_failures=0)
+        commands = dict()
+        for name, c in list(self.commands.items()):
+            x = dict(c, histogram=list(c['histogram']))
+            n = sum(x['histogram'])
+            
+            total, peak = x.pop('latency_sum'), x.pop('latency_max')
+            x['mean']   = total/n if n else None
+            x['max']    = peak    if n else None
+            for q in [50, 90, 99]: x['p%d'%q] = min(_histogram_percentile(x['histogram'], q), peak) if n else None
+            
+            for k in totals: totals[k] += x[k]
+            commands[name] = x
+        
+        return dict(totals, duration=_time.time()-self.start_time, histogram_edges=list(_stats_edges), commands=commands)
+
+def _histogram_percentile(histogram, q):
+    """
+    Returns the upper edge (ms) of the pid_stats histogram bin holding the 
+    q-th percentile, or None if the histogram is empty.
+    """
+    n = sum(histogram)
+    if not n: return None
+    
+    total = 0
+    for k, count in enumerate(histogram):
+        total += count
+        if total >= q/100*n: return _stats_edges[k] if k < len(_stats_edges) else float('inf')
+
 
 class pid_api():
     """
@@ -18,23 +397,99 @@ class pid_api():
     port='COM3' : str
         Name of the port to connect to.
         
-    baudrate=9600 : int
-        Baud rate of the connection. Must match the instrument setting.
+    baudrate=115200 : int
+        Baud rate of the connection. Rates above the one the firmware 
+        starts at (e.g. those in _high_baudrates) are negotiated after 
+        connecting, see set_baudrate().
         
     timeout=3000 : number
         How long to wait for responses before giving up (ms). 
         
     temperature_limit=85 : float
         Upper limit on the temperature setpoint (C).
+    
+    binary_telemetry=False : bool
+        If True, ask the arduino to send get_all_variables() replies as
+        compact binary frames (see set_telemetry_format()).
+    
+    simulation_speed=1 : float
+        In simulation mode, how many simulated seconds pass per second of
+        wall-clock time (see pid_controller_simulation.pid_simulator).
+    
+    reset=True : bool
+        Whether opening the port resets the arduino (the usual auto-reset
+        through DTR). If False, DTR is kept low so a running arduino keeps
+        its state, and it is probed right away instead of waiting for it to
+        boot.
+    
+    ready_timeout=5000 : number
+        How long to wait for the arduino to answer after opening the port
+        (ms), see handshake().
+    
+    stats=False : bool
+        Whether to collect per-command statistics from the start (see
+        enable_stats()).
+    
+    cache_age=0 : number
+        How old (ms) the mirrored mode, setpoint, parameters and period may
+        be for their getters to answer without asking the arduino (see
+        get_state()). 0 means always ask.
+    
+    auto_baud=True : bool
+        If the arduino does not answer at baudrate, look for it at the 
+        other rates (see detect_baudrate()). Rates it cannot start at
+        are reached by connecting at _baudrates[0] and then switching both
+        ends with set_baudrate(). self.baudrate is the rate in use.
         
     """
-    def __init__(self, port='COM3', baudrate=9600, timeout=3000, temperature_limit=80):
+    def __init__(self, port='COM3', baudrate=115200, timeout=3000, temperature_limit=80, binary_telemetry=False, simulation_speed=1,
+                 reset=True, ready_timeout=5000, stats=False, cache_age=0, auto_baud=True):
+
+        self._temperature_limit = temperature_limit
+
+        # Serializes access to the serial line (GUI thread vs. streaming thread)
+        self._lock = _threading.RLock()
+
+        # Streaming acquisition (see start_streaming())
+        self._stream_thread  = None
+        self._stream_stop    = _threading.Event()
+        self._stream_samples = _collections.deque()
+        self._listeners      = []
+        self.stream_errors   = 0
+        self.missed_ticks    = 0
+
+        # Maps the arduino's timestamps onto host time (see make_sample())
+        self.clock  = clock_sync()
+        self._epoch = _time.time() - _time.monotonic()
+
+        # Format of get_all_variables() replies
+        self.telemetry_format = 'ASCII'
+
+        # Sequence tag of the last pipelined command (see execute())
+        self._tag = 0
+
+        # Instrumentation (see enable_stats()): self.stats is None when off,
+        # and _last_command is the command the next reply read belongs to
+        self._counters     = pid_stats()
+        self.stats         = self._counters if stats else None
+        self._last_command = None
+
+        # Sequence number of the next reading to download, and how many were
+        # overwritten before they could be (see get_history())
+        self.history_seq  = 0
+        self.history_lost = 0
 
-        self._temperature_limit = temperature_limit        
+        # Last confirmed device state, name: (value, monotonic time) (see get_state())
+        self.cache_age = cache_age
+        self._state    = dict()
+
+        # Rate in use, and the one the arduino can start at
+        self.baudrate = baudrate
+        boot_rate     = baudrate if baudrate in _baudrates or not auto_baud else _baudrates[0]
 
         # Check for installed libraries
-        if not _mp._serial:
-            _s._warn('You need to install pyserial to use the Arduino based PID temperature controller.')
+        if not _serial:
+            print('You need to install pyserial to use the Arduino based PID temperature controller.')
             self.simulation = True
             _debug('Simulation enabled.')
 
@@ -44,7 +499,6 @@ class pid_api():
         # If the port is "Simulation"
         if port=='Simulation': 
             self.simulation      = True
-            self.simulation_mode = "OPEN_LOOP" 
             _debug('Simulation enabled.')
 
         # If we have all the libraries, try connecting.
@@ -53,10 +507,26 @@ class pid_api():
             
             try:
                 # Create the instrument and ensure the settings are correct.
-                self.serial = _mp._serial.Serial(port=port, baudrate=baudrate, timeout=timeout/1000)
+                self.serial = _serial.Serial(baudrate=boot_rate, timeout=timeout/1000)
+                self.serial.port = port
+                if not reset: self.serial.dtr = False
+                self.serial.open()
+                self.baudrate = boot_rate
                 
                 _debug("Serial communication to port %s enabled.\n"%port)
                 
+                # Wait for the arduino to run its setup loop
+                if self.handshake(ready_timeout, reset): ready = True
+                elif auto_baud: 
+                    # Without a reset, it may still be at a rate negotiated earlier
+                    rates = [baudrate] + _baudrates + _high_baudrates
+                    ready = self.detect_baudrate([b for n, b in enumerate(rates) if b != boot_rate and b not in rates[:n]]) is not None
+                else:           ready = False
+                if not ready: print('No answer from the arduino on '+port+' after %g ms. Carrying on anyway.'%ready_timeout)
+                
+                # Ask for a faster link if that's what we came for
+                elif auto_baud and baudrate > self.baudrate: self.set_baudrate(baudrate)
+                
 
             # Something went wrong. Go into simulation mode.
             except Exception as e:
@@ -65,49 +535,192 @@ class pid_api():
                 self.serial = None
                 self.simulation = True
         
-        # Give the arduino time to run setup loop!
-        _time.sleep(2)
+        # Simulated arduino and thermal plant
+        if self.simulation:
+            import pid_controller_simulation as _simulation
+            self.simulator = _simulation.pid_simulator(speed=simulation_speed)
+
+        if binary_telemetry and not self.simulation: self.set_telemetry_format('BINARY')
                                 
+    def handshake(self, timeout=5000, reset=True):
+        """
+        Waits until the arduino is ready for commands, instead of sleeping
+        for a fixed time. A freshly reset arduino announces itself with a
+        READY line at the end of setup(). If none has arrived after 
+        _boot_time (right away if reset is False, or for firmware without 
+        the banner), a get_mode probe is sent every _probe_interval until
+        one is answered.
+        
+        Parameters
+        ----------
+        timeout=5000 : number
+            Longest time to wait (ms).
+        
+        reset=True : bool
+            Whether the arduino was just reset by opening the port.
+        
+        Returns
+        -------
+        bool
+            True if the arduino answered in time.
+        """
+        self.invalidate()
+        with self._lock: return _handshake(self.serial, timeout, reset)
+    
+    def detect_baudrate(self, baudrates=None, timeout=_detect_timeout):
+        """
+        Looks for the arduino at each baud rate in turn, probing it as in
+        handshake(), and leaves the port at the first rate it answers.
+        
+        Parameters
+        ----------
+        baudrates=None : list or None
+            Rates to try. None means _baudrates.
+        
+        timeout=_detect_timeout : number
+            How long to probe each rate (ms).
+        
+        Returns
+        -------
+        int or None
+            The rate found, or None (the port is then back at its original
+            rate).
+        """
+        if self.simulation: return self.baudrate
+        if baudrates is None: baudrates = _baudrates
+        
+        with self._lock:
+            previous = self.serial.baudrate
+            for baudrate in baudrates:
+                self.serial.baudrate = baudrate
+                self.serial.reset_input_buffer()
+                if _handshake(self.serial, timeout, reset=False):
+                    _debug('Found the arduino at %d baud.'%baudrate)
+                    self.baudrate = baudrate
+                    return baudrate
+            
+            self.serial.baudrate = previous
+            return None
+    
+    def set_baudrate(self, baudrate, timeout=1000):
+        """
+        Switches the arduino and the port to a new baud rate, e.g. one of 
+        _high_baudrates. The arduino confirms the request at the current
+        rate, and the new rate is then verified with a handshake. If that
+        fails, both ends go back to the current rate: the arduino does so 
+        by itself when it hears no command within _baud_confirm_time.
+        
+        Parameters
+        ----------
+        baudrate : int
+            New baud rate.
+        
+        timeout=1000 : number
+            How long to wait for the arduino at the new rate (ms).
+        
+        Returns
+        -------
+        bool
+            True if the link now runs at baudrate.
+        """
+        if self.simulation:
+            self.baudrate = baudrate
+            return True
+        
+        with self._lock:
+            previous = self.serial.baudrate
+            
+            # Older firmware just acknowledges the unknown command
+            try:    reply = self.execute([('set_baud,%d'%baudrate, None, False)])[0]
+            except Exception as e:
+                _debug('Could not ask for %d baud.'%baudrate, e)
+                return False
+            if reply != str(baudrate):
+                _debug('The arduino does not support set_baud,%d.'%baudrate)
+                return False
+            
+            try:
+                self.serial.baudrate = baudrate
+                self.serial.reset_input_buffer()
+                if _handshake(self.serial, timeout, reset=False):
+                    _debug('Link switched to %d baud.'%baudrate)
+                    self.baudrate = baudrate
+                    return True
+            except Exception as e: _debug('Could not use %d baud.'%baudrate, e)
+            
+            # Fall back, once the arduino has given up on the new rate
+            self.serial.baudrate = previous
+            self.serial.reset_input_buffer()
+            if not _handshake(self.serial, _baud_confirm_time+timeout, reset=False):
+                print('The arduino did not come back at %d baud after trying %d baud.'%(previous, baudrate))
+            else: _debug('Could not switch to %d baud; staying at %d baud.'%(baudrate, previous))
+            return False
+    
     def disconnect(self):
         """
         Disconnects.
         """
-        if not self.simulation: 
+        self.stop_streaming()
+
+        if not self.simulation:
             self.serial.close()
             _debug('Serial port closed.')
+    
+    def enable_stats(self, enabled=True):
+        """
+        Turns the per-command instrumentation (see pid_stats) on or off. 
+        When off, each command costs one extra attribute check. Turning it
+        on again keeps the counters collected so far.
+        """
+        self.stats = self._counters if enabled else None
+    
+    def get_stats(self):
+        """
+        Returns a snapshot of the per-command statistics (see 
+        pid_stats.snapshot()).
+        """
+        with self._lock: return self._counters.snapshot()
+    
+    def reset_stats(self):
+        """
+        Zeroes the per-command statistics.
+        """
+        with self._lock: self._counters.reset()
 
     def get_dac(self):
         """
         Gets the current output level of the dac.
         """
-        if self.simulation: return _n.random.randint(0,4095)
+        if self.simulation: return self.simulator.get_dac()
         else:                    
-            self.write('get_dac')
-            return int(self.read())
+            return self.query('get_dac', int)
         
     def get_temperature(self):
         """
         Gets the current temperature in Celcius.
         """
-        if self.simulation: return _n.round(_n.random.rand()+24, 1)
+        if self.simulation: return round(self.simulator.get_temperature(), 2)
         else:
-             self.write('get_temperature')
-             return float(self.read())
+             return self.query('get_temperature', float)
 
-    def get_temperature_setpoint(self):
+    def get_temperature_setpoint(self, fresh=False):
         """
-        Gets the current temperature setpoint in Celcius.
+        Gets the current temperature setpoint in Celcius. Unless fresh is
+        True, a recent enough mirrored value is returned (see get_state()).
         """
-        if self.simulation: return 25.4
-        else:                    
-             self.write('get_setpoint')
-             
-             # Convert to floating point number and return
-             return float(self.read())
+        if self.simulation: return self.simulator.get_setpoint()
+        
+        setpoint = None if fresh else self.get_state('setpoint')
+        if setpoint is not None: return setpoint
+        
+        # Convert to floating point number and return
+        return self.query('get_setpoint', float)
     
-    def get_parameters(self):
+    def get_parameters(self, fresh=False):
         """
-        Get the PID control parameters on the arduino.
+        Get the PID control parameters on the arduino. Unless fresh is
+        True, recent enough mirrored values are returned (see get_state()).
+        
         Returns
         -------
         Band: float
@@ -119,29 +732,34 @@ class pid_api():
         t_d: float
             The derivative time.
         """
-        self.write('get_parameters')  
-        raw_params = self.read().split(',')
+        if self.simulation: return self.simulator.get_parameters()
+        
+        parameters = None if fresh else self.get_state('parameters')
+        if parameters is not None: return parameters
         
         # Convert to floating point numbers
-        band = float(raw_params[0])
-        ti   = float(raw_params[1])
-        td   = float(raw_params[2]) 
+        band, ti, td = self.query('get_parameters', _parse_floats)
         
         return band, ti, td
         
-    def get_mode(self):
+    def get_mode(self, fresh=False):
         """
         Get the current operating mode of the of the arduino temperature controller.
+        Unless fresh is True, a recent enough mirrored mode is returned (see 
+        get_state()).
+        
         Returns
         -------
         str
             The current operating mode.
         """
         if self.simulation:
-            return self.simulation_mode
+            return self.simulator.get_mode()
+        
+        mode = None if fresh else self.get_state('mode')
+        if mode is not None: return mode
         
-        self.write("get_mode")
-        return self.read()
+        return self.query("get_mode")
     
     def set_dac(self,level):
         """
@@ -153,19 +771,26 @@ class pid_api():
             The desired dac level. This number can range from 0 to 
             2**dac_bit_depth - 1. The output voltage will depend on 
             the dac supply voltage. 
+        
+        Returns
+        -------
+        bool
+            True if the arduino accepted the new level.
             
         """
         
-        if self.simulation: return
+        # The arduino refuses (and tells us) unless it is in OPEN_LOOP mode,
+        # so a single tagged command does the job of get_mode + set_dac.
+        if not self.simulation:
+            return self.transaction().set_dac(level).execute()[0]
         
-        # Get the control mode
-        mode = self.get_mode()
-         
         # Check that we are in OPEN_LOOP operation before attempting to set dac voltage
-        if(mode == "OPEN_LOOP"):
-            self.write("set_dac, "+str(level))
+        if(self.get_mode() == "OPEN_LOOP"):
+            self.simulator.set_dac(level)
+            return True
         else:
             print("Doing nothing. DAC output can only be directly controlled in OPEN_LOOP mode!")        
+            return False
     
     def set_temperature_setpoint(self, T=20.0, temperature_limit=None):
         """
@@ -186,8 +811,8 @@ class pid_api():
             print('Setpoint above the limit! Doing nothing.')
             return
         
-        if not self.simulation:
-            self.write('set_setpoint,'+str(T))
+        if self.simulation: self.simulator.set_setpoint(T)
+        else:               self.write('set_setpoint,'+str(T))
     
     def set_parameters(self,band, t_i, t_d):
         """
@@ -204,7 +829,9 @@ class pid_api():
         -------
         None.
         """
-        if self.simulation: return 
+        if self.simulation: 
+            self.simulator.set_parameters(band, t_i, t_d)
+            return
         
         self.write('set_parameters,%.4f,%.4f,%.4f'%(band,t_i,t_d)) 
         
@@ -223,7 +850,7 @@ class pid_api():
             return 
         
         if self.simulation: 
-            self.simulation_mode = mode
+            self.simulator.set_mode(mode)
             return
         
         self.write("set_mode,%s"%mode)
@@ -239,13 +866,15 @@ class pid_api():
 
         """
         if self.simulation:
+            self.simulator.set_period(period)
             return
         
         self.write('set_period,%d'%(period))
     
-    def get_period(self):
+    def get_period(self, fresh=False):
         """
-        Get the control loop period.
+        Get the control loop period. Unless fresh is True, a recent enough
+        mirrored period is returned (see get_state()).
 
         Returns
         -------
@@ -253,10 +882,12 @@ class pid_api():
             Control loop period [milliseconds].
 
         """
+        if self.simulation: return self.simulator.get_period()
         
-        self.write("get_period")
+        period = None if fresh else self.get_state('period')
+        if period is not None: return period
         
-        return int(self.read())
+        return self.query("get_period", int)
         
     def write(self,raw_data):
         """
@@ -273,7 +904,16 @@ class pid_api():
         
         """
         encoded_data = (_serial_left_marker + raw_data + _serial_right_marker).encode()
-        self.serial.write(encoded_data) 
+        with self._lock: 
+            self.serial.write(encoded_data) 
+            
+            if self.stats is not None:
+                self._last_command = raw_data.split(',')[0]
+                self.stats.sent(self._last_command, len(encoded_data))
+            
+            # Untagged setters are silent whether or not they are accepted,
+            # so what they change is unknown until it is read back
+            if raw_data.startswith('set_'): self._update_state(raw_data, None)
     
     def read(self):
         """
@@ -284,7 +924,119 @@ class pid_api():
         str
             Raw data string read from the serial line.
         """
-        return self.serial.read_until(expected = '\r\n'.encode()).decode().strip('\r\n')
+        with self._lock: 
+            raw = self.serial.read_until(expected = '\r\n'.encode())
+            
+            # An incomplete line means read_until() gave up
+            if self.stats is not None: self.stats.received(self._last_command, len(raw), not raw.endswith(b'\r\n'))
+            return raw.decode().strip('\r\n')
+    
+    def query(self, raw_data, parser=None):
+        """
+        Writes a command and reads its reply as one operation, so that
+        another thread cannot slip a command in between the two.
+        
+        Parameters
+        ----------
+        raw_data : str
+            Raw data string to be sent to the arduino.
+        
+        parser=None : function or None
+            Converts the reply, e.g. float. Failures are counted as parse
+            failures (see enable_stats()) and raised.
+        
+        Returns
+        -------
+        str
+            Raw data string read from the serial line, or what parser made 
+            of it.
+        """
+        with self._lock:
+            if self.stats is not None: t0 = _time.perf_counter()
+            self.write(raw_data)
+            reply = self.read()
+            if self.stats is not None: self.stats.latency(self._last_command, _time.perf_counter()-t0)
+            result = self._parse(reply, parser)
+            self._update_state(raw_data, result)
+            return result
+    
+    def _parse(self, reply, parser):
+        """
+        Applies a parser to the reply to _last_command, counting failures.
+        """
+        if parser is None: return reply
+        try: return parser(reply)
+        except Exception:
+            if self.stats is not None: self.stats.parse_failure(self._last_command)
+            raise
+    
+    def _update_state(self, command, result=True):
+        """
+        Updates the state mirror from a command and its parsed reply: the
+        value a getter returned, or the value a setter sent if it was
+        accepted (result True). A setter sent without an acknowledgement
+        (result None) drops the value it may have changed.
+        """
+        name, _, args = command.partition(',')
+        args = args.split(',')
+        now  = _time.monotonic()
+        
+        try:
+            if name.startswith('set_') and result is not True: 
+                if result is None and name in _setter_state: self.invalidate(_setter_state[name])
+                return
+            
+            if   name == 'set_setpoint'     : self._state['setpoint']   = (round(float(args[0]), 4), now)
+            elif name == 'set_parameters'   : self._state['parameters'] = (tuple(round(float(x), 4) for x in args[:3]), now)
+            elif name == 'set_period'       : self._state['period']     = (int(args[0]), now)
+            elif name == 'set_mode'         : self._state['mode']       = (args[0], now)
+            elif name == 'get_setpoint'     : self._state['setpoint']   = (result, now)
+            elif name == 'get_parameters'   : self._state['parameters'] = (tuple(result), now)
+            elif name == 'get_period'       : self._state['period']     = (result, now)
+            elif name == 'get_mode'         : 
+                if result in ['OPEN_LOOP', 'CLOSED_LOOP']: self._state['mode'] = (result, now)
+            elif name == 'get_all_variables':
+                self._state['setpoint']   = (result[1], now)
+                self._state['parameters'] = (tuple(result[3:6]), now)
+                self._state['period']     = (int(result[6]), now)
+        
+        # Don't trust anything about a command we could not make sense of
+        except (ValueError, IndexError, TypeError): self.invalidate()
+    
+    def get_state(self, name, max_age=None):
+        """
+        Returns the mirrored value of 'mode', 'setpoint', 'parameters' or
+        'period', or None if it is unknown or older than max_age.
+        
+        The mirror holds the last value the arduino confirmed: tagged
+        setters (e.g. through transaction()) write through to it when 
+        acknowledged, and getters, including every get_all_variables()
+        reply (e.g. while streaming), refresh it. Untagged setters drop
+        the value, since the arduino may have refused them.
+        
+        Parameters
+        ----------
+        name : str
+            Which value.
+        
+        max_age=None : number or None
+            Oldest acceptable value (ms). None means self.cache_age.
+        """
+        if max_age is None: max_age = self.cache_age
+        if name not in self._state: return None
+        
+        value, t = self._state[name]
+        if _time.monotonic() - t > max_age/1000: return None
+        return value
+    
+    def invalidate(self, name=None):
+        """
+        Forgets the mirrored value of name (see get_state()), or of 
+        everything if None, e.g. after changing the arduino's state by
+        other means.
+        """
+        if name is None: self._state.clear()
+        else:            self._state.pop(name, None)
     
     def get_all_variables(self):
         """
@@ -306,24 +1058,517 @@ class pid_api():
             DESCRIPTION.
         _period : int
             DESCRIPTION.
+        _time_recent : int
+            The arduino's millis() when the temperature was measured (nan 
+            for older firmware).
+
+        """
+        if self.simulation: return self.simulator.get_all_variables()
+
+        if self.telemetry_format == 'BINARY':
+            with self._lock:
+                if self.stats is not None: t0 = _time.perf_counter()
+                self.write('get_all_variables')
+                frame = self.read_frame()
+                if self.stats is not None: self.stats.latency(self._last_command, _time.perf_counter()-t0)
+                values = self._parse(frame, _parse_frame)
+                self._update_state('get_all_variables', values)
+                return values
+
+        _temp, _setpoint, _dac, _band, _ti, _td, _period, _time_recent = self.query('get_all_variables', _parse_all_variables)
+        
+        return _temp, _setpoint, _dac, _band, _ti, _td, _period, _time_recent
 
+    def get_history(self, seq=None):
+        """
+        Downloads the RTD readings the arduino has kept since sequence 
+        number seq, in as few get_history replies as possible. The arduino
+        takes a reading every 100-140 ms and keeps the last 32, so calling
+        this every couple of seconds gets every one of them, whatever the
+        poll rate. Replies come in the telemetry format (see 
+        set_telemetry_format()) and are converted to arrays in one pass.
+        
+        Parameters
+        ----------
+        seq=None : int or None
+            Sequence number of the first reading wanted (readings are 
+            numbered from 0 since the arduino started). None means the one 
+            after the last reading downloaded (self.history_seq).
+        
+        Returns
+        -------
+        array
+            Structured array (see _history_dtypes()) with the fields seq, time 
+            (host time.time() of the reading, mapped with self.clock), 
+            device_time (the arduino's millis()), temperature (C) and dac.
+            Readings overwritten before they could be downloaded are 
+            counted in self.history_lost.
         """
-        self.write('get_all_variables')
-        raw_params = self.read().split(',')
+        import numpy as _n
+        reading, dtype = _history_dtypes()
         
-        _temp      = float(raw_params[0])
-        _setpoint  = float(raw_params[1])
-        _dac       = float(raw_params[2]) 
+        if seq is None: seq = self.history_seq
         
-        _band    = float(raw_params[3])
-        _ti      = float(raw_params[4])
-        _td      = float(raw_params[5]) 
-        _period  = float(raw_params[6])
+        chunks = []
+        while True:
+            if self.simulation:
+                first, rows = self.simulator.get_history(seq)
+                readings    = _n.array(rows, dtype=reading)
+            else:
+                first, readings = self._read_history(seq)
+            received = _time.monotonic()
+            
+            if first > seq:
+                _debug('%d readings were overwritten before they could be downloaded.'%(first-seq))
+                self.history_lost += first-seq
+            elif first < seq: _debug('Arduino history restarted at %d.'%first)
+            
+            history = _n.zeros(len(readings), dtype)
+            if len(readings):
+                self.clock.update(received, int(readings['device_time'][-1]))
+                history['seq']         = first + _n.arange(len(readings))
+                history['time']        = self._epoch + self.clock.to_host(readings['device_time'].astype(float))
+                history['device_time'] = readings['device_time']
+                history['temperature'] = readings['temperature']
+                history['dac']         = readings['dac']
+            chunks.append(history)
+            
+            seq = first + len(readings)
+            if len(readings) < _history_reply: break
         
-        return _temp, _setpoint, _dac, _band, _ti, _td, _period
+        self.history_seq = seq
+        return _n.concatenate(chunks)
+    
+    def _read_history(self, seq):
+        """
+        Sends one get_history command and returns its parsed reply (see
+        _parse_history()).
+        """
+        if self.telemetry_format == 'BINARY':
+            with self._lock:
+                if self.stats is not None: t0 = _time.perf_counter()
+                self.write('get_history,%d'%seq)
+                frame = self.read_frame()
+                if self.stats is not None: self.stats.latency(self._last_command, _time.perf_counter()-t0)
+                return self._parse(frame, _parse_history_frame)
+        
+        return self.query('get_history,%d'%seq, _parse_history)
+    
+    def set_telemetry_format(self, telemetry_format='BINARY'):
+        """
+        Selects how the arduino sends get_all_variables() replies. 'BINARY'
+        frames are about a third the size of the ASCII reply and need no
+        string parsing. If the arduino does not confirm the request (e.g.
+        older firmware), the ASCII format stays in use.
+        
+        Parameters
+        ----------
+        telemetry_format='BINARY' : str
+            Either 'BINARY' or 'ASCII'.
         
+        Returns
+        -------
+        str
+            The format now in use.
+        """
+        if telemetry_format not in ['BINARY', 'ASCII']:
+            print("Telemetry format has not been changed. %s is not a valid format."%telemetry_format)
+            return self.telemetry_format
+        
+        if self.simulation: return self.telemetry_format
+        
+        reply = self.query('set_format,%s'%telemetry_format)
+        if reply in ['BINARY', 'ASCII']: self.telemetry_format = reply
+        else: print('Arduino did not confirm telemetry format %s; using %s.'%(telemetry_format, self.telemetry_format))
+        
+        _debug('Telemetry format: '+self.telemetry_format)
+        return self.telemetry_format
+    
+    def read_frame(self):
+        """
+        Reads one binary frame from the serial line and checks its CRC.
+        
+        Returns
+        -------
+        bytes
+            The frame payload.
+        """
+        with self._lock:
+            
+            try:
+                # Skip anything (e.g. a stray text line) before the start byte
+                while True:
+                    b = self.serial.read(1)
+                    if not len(b):            raise Exception('Timed out waiting for a binary frame.')
+                    if b[0] == _frame_start:  break
+                
+                header = self.serial.read(1)
+                if not len(header): raise Exception('Timed out reading binary frame length.')
+                
+                body = self.serial.read(header[0]+1)
+                if len(body) != header[0]+1: raise Exception('Timed out reading binary frame payload.')
+            
+            except Exception:
+                if self.stats is not None: self.stats.received(self._last_command, 0, True)
+                raise
+            
+            if self.stats is not None: self.stats.received(self._last_command, 2+len(body))
+            
+            if _crc8(header+body[:-1]) != body[-1]:
+                if self.stats is not None: self.stats.parse_failure(self._last_command)
+                raise Exception('Binary frame failed its CRC check.')
+        
+        return body[:-1]
+    
+    def transaction(self):
+        """
+        Returns a new, empty pid_transaction for this api. Queue commands on
+        it and call its execute() to send them all in one burst.
+        """
+        return pid_transaction(self)
+    
+    def execute(self, commands):
+        """
+        Sends several commands in one burst and collects their replies.
+        
+        Each command is tagged with a sequence number (e.g. <#12;get_period>),
+        which the arduino echoes in front of its reply, and setters that
+        normally stay silent answer with an empty line. Replies are matched
+        to commands by tag, so stray lines and late replies to earlier,
+        timed-out commands are discarded rather than desynchronizing the
+        stream. No more than _rx_window bytes are in flight at any time.
+        
+        Parameters
+        ----------
+        commands : list
+            List of (command, parser, binary) tuples. command is the raw
+            command string, parser converts the reply (or None to return
+            the raw string), and binary is True if the reply is a binary
+            frame (see read_frame()).
+        
+        Returns
+        -------
+        list
+            The parsed replies, in the same order as the commands.
+        """
+        results = [None]*len(commands)
+        queue   = list(enumerate(commands))
+        pending = dict() # tag: (index, parser, binary, size, time sent)
+        
+        with self._lock:
+            in_flight = 0
+            while len(queue) or len(pending):
+                
+                # Send as many commands as the window allows in one write
+                burst = b''
+                while len(queue):
+                    n, (command, parser, binary) = queue[0]
+                    
+                    tag  = (self._tag+1) % 1000
+                    data = (_serial_left_marker+'#%d;'%tag+command+_serial_right_marker).encode()
+                    if len(pending) and in_flight+len(data) > _rx_window: break
+                    
+                    self._tag    = tag
+                    pending[tag] = (n, parser, binary, len(data), _time.perf_counter())
+                    in_flight += len(data)
+                    burst     += data
+                    queue.pop(0)
+                    if self.stats is not None: self.stats.sent(command.split(',')[0], len(data))
+                if len(burst): self.serial.write(burst)
+                
+                # Wait for the next tag
+                raw = self.serial.read_until(expected=b';')
+                if not raw.endswith(b';'):
+                    if self.stats is not None:
+                        for x in pending.values(): self.stats.received(commands[x[0]][0].split(',')[0], 0, True)
+                    raise Exception('Timed out waiting for replies to %s.'%', '.join(commands[x[0]][0] for x in pending.values()))
+                
+                # Untagged lines are strays
+                tag = _parse_tag(raw)
+                if tag is None: continue
+                if tag not in pending: 
+                    _debug('Discarding reply to unknown tag %d.'%tag)
+                    continue
+                
+                n, parser, binary, size, t0 = pending.pop(tag)
+                in_flight -= size
+                
+                if self.stats is not None: 
+                    self._last_command = commands[n][0].split(',')[0]
+                    self.stats.received(self._last_command, len(raw))
+                
+                reply = self.read_frame() if binary else self.read()
+                if self.stats is not None: self.stats.latency(self._last_command, _time.perf_counter()-t0)
+                results[n] = self._parse(reply, parser)
+                self._update_state(commands[n][0], results[n])
+        
+        return results
+    
+    def start_streaming(self, rate=20, buffer_size=100000, catch_up=False):
+        """
+        Starts a background thread that polls get_all_variables() at a fixed
+        rate and stores timestamped samples in a thread-safe buffer. Use
+        get_samples() to drain the buffer. Commands sent from other threads
+        while streaming are interleaved safely between polls.
+
+        Parameters
+        ----------
+        rate=20 : float
+            Polling rate (Hz).
+
+        buffer_size=100000 : int
+            Maximum number of unread samples to keep. When full, the oldest
+            samples are discarded.
+        
+        catch_up=False : bool
+            What to do when a poll runs so late that later ones are due. 
+            If False, the overdue polls are skipped, and counted in the 
+            next sample's missed field and in self.missed_ticks. If True,
+            they are run back to back until the schedule is met again.
+        """
+        self.stop_streaming()
+
+        self._stream_samples = _collections.deque(maxlen=buffer_size)
+        self._stream_stop.clear()
+        self._stream_thread = _threading.Thread(target=self._stream_loop, args=(1.0/rate, catch_up), daemon=True)
+        self._stream_thread.start()
+        _debug('Streaming started at %g Hz.'%rate)
+
+    def stop_streaming(self):
+        """
+        Stops the streaming thread, if it is running. Samples that have not
+        been read remain available from get_samples().
+        """
+        if self._stream_thread is None: return
+
+        self._stream_stop.set()
+        self._stream_thread.join()
+        self._stream_thread = None
+        _debug('Streaming stopped.')
+
+    def is_streaming(self):
+        """
+        Returns True if the streaming thread is running.
+        """
+        return self._stream_thread is not None
+
+    def get_samples(self):
+        """
+        Removes and returns all samples collected by the streaming thread
+        since the last call.
+
+        Returns
+        -------
+        list
+            List of sample tuples (time, temperature, setpoint, dac, band,
+            t_i, t_d, period, device_time, missed), oldest first (see 
+            make_sample()).
+        """
+        samples = []
+        while True:
+            try:                samples.append(self._stream_samples.popleft())
+            except IndexError:  return samples
+
+    def add_listener(self, f):
+        """
+        Registers a function to be called by the streaming thread with every
+        new sample, e.g. a logger. It should return quickly.
+        """
+        self._listeners = self._listeners + [f]
+
+    def remove_listener(self, f):
+        """
+        Unregisters a function added with add_listener().
+        """
+        self._listeners = [x for x in self._listeners if x != f]
+
+    def make_sample(self, values, received=None, missed=0):
+        """
+        Builds a sample from get_all_variables() values. Its time is the
+        arduino's time_recent, mapped onto host time by self.clock, i.e. 
+        when the temperature was actually measured, free of the serial
+        round trip's jitter. With older firmware (no time_recent), it is 
+        the time the reply arrived.
+        
+        Parameters
+        ----------
+        values : tuple
+            Reply of get_all_variables().
+        
+        received=None : float or None
+            Host time.monotonic() at which the reply arrived. None means now.
+        
+        missed=0 : int
+            Number of scheduled polls skipped just before this one.
+        """
+        if received is None: received = _time.monotonic()
+        
+        device_time = values[7]
+        if device_time == device_time: t = self._epoch + self.clock.update(received, device_time)
+        else:                          t = self._epoch + received
+        
+        return sample(t, *values, missed)
+    
+    def _stream_loop(self, interval, catch_up=False):
+        """
+        Body of the streaming thread. Poll k is due at t0 + k*interval on
+        the monotonic clock, so neither slow replies nor timer error 
+        accumulate into a drifting sample rate.
+        """
+        t0     = _time.monotonic()
+        k      = 0
+        missed = 0
+        while not self._stream_stop.is_set():
+
+            try:
+                values = self.get_all_variables()
+                x      = self.make_sample(values, _time.monotonic(), missed)
+                self._stream_samples.append(x)
+                for f in self._listeners: f(x)
+                missed = 0
+
+            # Lost or garbled reply; keep going and let the user see the count.
+            except Exception as e:
+                self.stream_errors += 1
+                _debug('Streaming error:', e)
+
+            # Next slot on the absolute schedule. Polls already overdue are
+            # either run right away or skipped and flagged.
+            k   += 1
+            now  = _time.monotonic()
+            late = int((now - t0)/interval) - k
+            if late > 0 and not catch_up:
+                k      += late
+                missed += late
+                self.missed_ticks += late
+            self._stream_stop.wait(t0 + k*interval - now)
+
+class pid_transaction():
+    """
+    Queue of commands for a pid_api, sent in one burst by execute().
+    The queuing methods mirror pid_api and can be chained, e.g.
+    
+        T, (band, t_i, t_d) = api.transaction().get_temperature().get_parameters().execute()
+    
+    In simulation mode the commands are simply run one after the other.
+    
+    Parameters
+    ----------
+    api : pid_api
+        Api to send the commands through.
+    """
+    def __init__(self, api):
+        self.api       = api
+        self._commands = []
+        self._methods  = [] # Equivalent pid_api calls, for simulation mode
+    
+    def add(self, command, parser=None, binary=False, method=None):
+        """
+        Queues a raw command (see pid_api.execute()). method is a function
+        that does the same thing through the pid_api in simulation mode.
+        """
+        self._commands.append((command, parser, binary))
+        self._methods .append(method)
+        return self
+    
+    def execute(self):
+        """
+        Sends all the queued commands and returns their parsed replies,
+        in order. Setters return True if the arduino accepted them.
+        """
+        if self.api.simulation: return [m() for m in self._methods]
+        return self.api.execute(self._commands)
+    
+    def get_dac(self):
+        return self.add('get_dac', int, method=self.api.get_dac)
+    
+    def get_temperature(self):
+        return self.add('get_temperature', float, method=self.api.get_temperature)
+    
+    def get_temperature_setpoint(self):
+        return self.add('get_setpoint', float, method=self.api.get_temperature_setpoint)
+    
+    def get_parameters(self):
+        return self.add('get_parameters', _parse_floats, method=self.api.get_parameters)
+    
+    def get_mode(self):
+        return self.add('get_mode', method=self.api.get_mode)
+    
+    def get_period(self):
+        return self.add('get_period', int, method=self.api.get_period)
+    
+    def get_all_variables(self):
+        if self.api.telemetry_format == 'BINARY':
+            return self.add('get_all_variables', _parse_frame, True, method=self.api.get_all_variables)
+        return self.add('get_all_variables', _parse_all_variables, method=self.api.get_all_variables)
+    
+    def set_dac(self, level):
+        return self.add('set_dac, '+str(level), _parse_ack, method=lambda: self.api.set_dac(level))
+    
+    def set_temperature_setpoint(self, T=20.0):
+        if T > self.api._temperature_limit:
+            raise Exception('Setpoint %g above the limit %g.'%(T, self.api._temperature_limit))
+        return self.add('set_setpoint,'+str(T), _parse_ack, method=lambda: self.api.set_temperature_setpoint(T) or True)
+    
+    def set_parameters(self, band, t_i, t_d):
+        return self.add('set_parameters,%.4f,%.4f,%.4f'%(band,t_i,t_d), _parse_ack, method=lambda: self.api.set_parameters(band, t_i, t_d) or True)
+    
+    def set_mode(self, mode):
+        if mode not in ['OPEN_LOOP', 'CLOSED_LOOP']: raise Exception('%s is not a valid mode.'%mode)
+        return self.add('set_mode,%s'%mode, _parse_ack, method=lambda: self.api.set_mode(mode) or True)
+    
+    def set_period(self, period):
+        return self.add('set_period,%d'%(period), _parse_ack, method=lambda: self.api.set_period(period) or True)
+
 def _debug(*a):
     if _debug_enabled:
         s = []
         for x in a: s.append(str(x))
-        print(', '.join(s))
\ No newline at end of file
+        print(', '.join(s))
+
+if __name__ == '__main__':
+    
+    # Headless acquisition, without the GUI stack, e.g.
+    #   python pid_controller_api.py COM3 --rate 20 --duration 60 --log run
+    import argparse as _argparse
+    
+    parser = _argparse.ArgumentParser(description='Streams samples from an Arduino PID temperature controller as CSV on stdout.')
+    parser.add_argument('port', nargs='?', default='Simulation', help="Serial port, or 'Simulation' (default).")
+    parser.add_argument('--baudrate', type=int,   default=115200, help='Baud rate (default 115200).')
+    parser.add_argument('--rate',     type=float, default=10,     help='Polling rate in Hz (default 10).')
+    parser.add_argument('--duration', type=float, default=None,   help='Seconds to acquire (default: until Ctrl-C).')
+    parser.add_argument('--log',                  default=None,   help='Also stream samples to binary session files with this path.')
+    parser.add_argument('--binary',   action='store_true',        help='Use binary telemetry frames.')
+    parser.add_argument('--no-reset', action='store_true',        help='Do not reset the arduino when opening the port.')
+    parser.add_argument('--verbose',  action='store_true',        help='Print debug messages.')
+    args = parser.parse_args()
+    
+    _debug_enabled = args.verbose
+    
+    # Modules imported from here (e.g. the logger) get this module, rather 
+    # than a second copy of it with its own _debug_enabled
+    import sys as _sys
+    _sys.modules.setdefault('pid_controller_api', _sys.modules[__name__])
+    
+    api = pid_api(args.port, args.baudrate, binary_telemetry=args.binary, reset=not args.no_reset)
+    
+    logger = None
+    if args.log:
+        import pid_controller_session as _session
+        logger = _session.binary_session_logger(args.log)
+        api.add_listener(logger.log)
+    
+    print(','.join(sample._fields))
+    api.add_listener(lambda x: print(','.join(repr(float(v)) for v in x), flush=True))
+    api.start_streaming(args.rate)
+    
+    try:
+        if args.duration is None:
+            while True: _time.sleep(1)
+        else: _time.sleep(args.duration)
+    
+    except KeyboardInterrupt: pass
+    
+    finally:
+        api.disconnect()
+        if logger is not None: logger.close()
@@ -0,0 +1,432 @@
+import asyncio as _asyncio
+
+import pid_controller_api as _api
+
+try:    import serial as _serial
+except: _serial = None
+
+try:    import serial_asyncio as _serial_asyncio
+except: _serial_asyncio = None
+
+
+class async_pid_api():
+    """
+    asyncio counterpart of pid_api. Every command is an awaitable that
+    never blocks the event loop, so many controllers (and anything else,
+    e.g. a web server) can share one loop:
+
+        apis = [async_pid_api(port) for port in ports]
+        await asyncio.gather(*[a.connect() for a in apis])
+        data = await asyncio.gather(*[a.get_all_variables() for a in apis])
+
+    Commands are sent with sequence tags (see pid_api.execute()) and may be
+    issued concurrently; replies are matched to their callers by tag. A
+    call that times out or is cancelled simply drops its late reply, but
+    keeps its share of the arduino's receive buffer until that reply (or
+    the reply to a later command) shows the command has left it.
+
+    Uses pyserial-asyncio if it is installed, and otherwise watches the
+    serial port's file descriptor from the event loop (POSIX only).
+
+    Parameters
+    ----------
+    port='COM3' : str
+        Name of the port to connect to, or 'Simulation'.
+
+    baudrate=115200 : int
+        Baud rate of the connection. Must match the instrument setting.
+
+    timeout=3000 : number
+        Default time to wait for each reply before giving up (ms).
+
+    temperature_limit=80 : float
+        Upper limit on the temperature setpoint (C).
+
+    simulation_speed=1 : float
+        In simulation mode, how many simulated seconds pass per second of
+        wall-clock time.
+    
+    reset=True : bool
+        Whether opening the port resets the arduino (see pid_api). If False,
+        the port is always watched through its file descriptor, since that
+        is the only way to keep DTR low while opening it.
+    
+    ready_timeout=5000 : number
+        How long connect() waits for the arduino to answer (ms).
+    """
+    def __init__(self, port='COM3', baudrate=115200, timeout=3000, temperature_limit=80, simulation_speed=1,
+                 reset=True, ready_timeout=5000):
+
+        self.port               = port
+        self.baudrate           = baudrate
+        self.timeout            = timeout
+        self._temperature_limit = temperature_limit
+        self._simulation_speed  = simulation_speed
+        self.reset              = reset
+        self.ready_timeout      = ready_timeout
+
+        self.simulation         = port == 'Simulation' or not _serial
+        self.telemetry_format   = 'ASCII'
+
+        self.serial         = None
+        self._reader        = None
+        self._writer        = None
+        self._stream_writer = None
+        self._task          = None
+        self._tag           = 0
+        self._pending       = dict() # tag: (future, binary, size), in the order sent
+        self._in_flight     = 0
+        self._window        = None
+        self._error         = None   # Exception that stopped _dispatch()
+
+    async def connect(self):
+        """
+        Opens the connection and starts dispatching replies.
+        """
+        if self.simulation:
+            import pid_controller_simulation as _simulation
+            self.simulator = _simulation.pid_simulator(speed=self._simulation_speed)
+            _api._debug('Simulation enabled.')
+            return
+
+        loop = _asyncio.get_running_loop()
+        self._window = _asyncio.Condition()
+        self._error  = None
+
+        if _serial_asyncio and self.reset:
+            self._reader, self._stream_writer = await _serial_asyncio.open_serial_connection(url=self.port, baudrate=self.baudrate)
+            self._writer = self._stream_writer.write
+
+        else:
+            self.serial      = _serial.Serial(baudrate=self.baudrate, timeout=0)
+            self.serial.port = self.port
+            if not self.reset: self.serial.dtr = False
+            self.serial.open()
+            self._reader = _asyncio.StreamReader()
+            self._writer = self.serial.write
+            loop.add_reader(self.serial.fileno(), self._serial_readable)
+
+        _api._debug('Serial communication to port %s enabled.'%self.port)
+
+        # Wait for the arduino to run its setup loop
+        if not await self._handshake():
+            print('No answer from the arduino on '+self.port+' after %g ms. Carrying on anyway.'%self.ready_timeout)
+
+        self._task = loop.create_task(self._dispatch())
+
+    async def _handshake(self):
+        """
+        Waits for the READY banner or, failing that, for an answer to a
+        get_mode probe (see pid_api.handshake()). Returns True if the
+        arduino answered within ready_timeout.
+        """
+        loop       = _asyncio.get_running_loop()
+        t0         = loop.time()
+        deadline   = t0 + self.ready_timeout/1000
+        probe_time = t0 + (_api._boot_time if self.reset else 0)
+        probes     = 0 # Probes not answered yet
+
+        while loop.time() < deadline:
+
+            # Probe if the banner is late
+            if loop.time() >= probe_time:
+                self._writer((_api._serial_left_marker+'get_mode'+_api._serial_right_marker).encode())
+                probes    += 1
+                probe_time = loop.time() + _api._probe_interval
+
+            # Wait for a line, until the next probe at most
+            try:    line = await _asyncio.wait_for(self._reader.readuntil(b'\n'), max(0, min(probe_time, deadline)-loop.time()))
+            except _asyncio.TimeoutError: continue
+
+            line = line.decode(errors='replace').strip()
+            if line not in [_api._ready_banner, 'OPEN_LOOP', 'CLOSED_LOOP']: continue
+
+            _api._debug('Arduino ready after %.0f ms (%s).'%(1000*(loop.time()-t0), line))
+
+            # Collect the answers to any other probes still on their way
+            if line != _api._ready_banner: probes -= 1
+            try:
+                while probes > 0:
+                    await _asyncio.wait_for(self._reader.readuntil(b'\n'), _api._probe_interval)
+                    probes -= 1
+            except _asyncio.TimeoutError: pass
+            return True
+
+        return False
+
+    async def disconnect(self):
+        """
+        Disconnects, failing any commands still waiting for replies.
+        """
+        if self.simulation: return
+
+        if self._task is not None:
+            self._task.cancel()
+            try:                              await self._task
+            except _asyncio.CancelledError:   pass
+            self._task = None
+
+        self._fail_pending(ConnectionError('Disconnected.'))
+
+        if self.serial is not None:
+            _asyncio.get_running_loop().remove_reader(self.serial.fileno())
+            self.serial.close()
+            self.serial = None
+
+        elif self._stream_writer is not None:
+            self._stream_writer.close()
+            self._stream_writer = None
+
+        _api._debug('Serial port closed.')
+
+    def _serial_readable(self):
+        """
+        Called by the event loop when the serial port has data.
+        """
+        data = self.serial.read(self.serial.in_waiting or 1)
+        if len(data): self._reader.feed_data(data)
+
+    def _fail_pending(self, exception):
+        """
+        Fails every command still waiting for a reply, and frees the window.
+        """
+        for future, binary, size in self._pending.values():
+            if not future.done(): future.set_exception(exception)
+        self._pending.clear()
+        self._in_flight = 0
+
+    async def _release(self, tag):
+        """
+        Frees the window share of the command tagged tag, which the arduino
+        has answered, and of the abandoned (timed out or cancelled) commands
+        sent before it, which it must have read by now.
+        """
+        async with self._window:
+            for t in list(self._pending):
+                future, binary, size = self._pending[t]
+                if t != tag and not future.done(): continue
+                del self._pending[t]
+                self._in_flight -= size
+                if t == tag: break
+            self._window.notify_all()
+
+    async def _dispatch(self):
+        """
+        Reads tagged replies forever and hands them to their callers. If 
+        reading fails, the error is kept in self._error and every pending 
+        (and later) command fails with it.
+        """
+        try:
+            while True:
+                raw = await self._reader.readuntil(b';')
+
+                # Untagged lines are strays
+                tag = _api._parse_tag(raw)
+                if tag is None or tag not in self._pending: continue
+
+                future, binary, size = self._pending[tag]
+                try:
+                    if binary: reply = await self._read_frame()
+                    else:      reply = (await self._reader.readuntil(b'\r\n')).decode().strip('\r\n')
+                except (_asyncio.IncompleteReadError, _asyncio.LimitOverrunError, ConnectionError): raise
+                except Exception as e:
+                    if not future.done(): future.set_exception(e)
+                    await self._release(tag)
+                    continue
+
+                if not future.done(): future.set_result(reply)
+                await self._release(tag)
+
+        except Exception as e:
+            _api._debug('Reading replies from %s failed.'%self.port, e)
+            self._error = e
+            async with self._window:
+                self._fail_pending(e)
+                self._window.notify_all()
+
+    async def _read_frame(self):
+        """
+        Reads one binary frame and checks its CRC (see pid_api.read_frame()).
+        """
+        while (await self._reader.readexactly(1))[0] != _api._frame_start: pass
+
+        header = await self._reader.readexactly(1)
+        body   = await self._reader.readexactly(header[0]+1)
+        if _api._crc8(header+body[:-1]) != body[-1]: raise Exception('Binary frame failed its CRC check.')
+        return body[:-1]
+
+    async def query(self, command, parser=None, binary=False, timeout=None):
+        """
+        Sends one tagged command and waits for its reply.
+
+        Parameters
+        ----------
+        command : str
+            Raw command string.
+
+        parser=None : function or None
+            Converts the reply. If None, the raw reply is returned.
+
+        binary=False : bool
+            Whether the reply is a binary frame.
+
+        timeout=None : None or number
+            How long to wait for the reply (ms). None means self.timeout.
+
+        Returns
+        -------
+        The (parsed) reply.
+        """
+        if timeout is None: timeout = self.timeout
+
+        future = _asyncio.get_running_loop().create_future()
+        async with self._window:
+            if self._error is not None: raise self._error
+
+            self._tag = (self._tag+1) % 1000
+            tag  = self._tag
+            data = (_api._serial_left_marker+'#%d;'%tag+command+_api._serial_right_marker).encode()
+
+            # Keep the arduino's receive buffer from overflowing. Once only
+            # abandoned commands are left, one more is sent to resynchronize.
+            await self._window.wait_for(lambda: self._error is not None or self._in_flight+len(data) <= _api._rx_window
+                                                or all(f.done() for f, b, n in self._pending.values()))
+            if self._error is not None: raise self._error
+
+            self._pending[tag] = (future, binary, len(data))
+            self._in_flight   += len(data)
+            self._writer(data)
+
+        try:
+            reply = await _asyncio.wait_for(future, timeout/1000)
+
+        except _asyncio.TimeoutError:
+            raise TimeoutError('Timed out waiting for a reply to %s.'%command)
+
+        # On timeout or cancellation, the command stays in self._pending 
+        # (abandoned) until _dispatch() sees it has been read
+        finally:
+            if not future.done(): future.cancel()
+
+        return reply if parser is None else parser(reply)
+
+    async def get_dac(self, timeout=None):
+        """
+        Gets the current output level of the dac.
+        """
+        if self.simulation: return self.simulator.get_dac()
+        return await self.query('get_dac', int, timeout=timeout)
+
+    async def get_temperature(self, timeout=None):
+        """
+        Gets the current temperature in Celcius.
+        """
+        if self.simulation: return round(self.simulator.get_temperature(), 2)
+        return await self.query('get_temperature', float, timeout=timeout)
+
+    async def get_temperature_setpoint(self, timeout=None):
+        """
+        Gets the current temperature setpoint in Celcius.
+        """
+        if self.simulation: return self.simulator.get_setpoint()
+        return await self.query('get_setpoint', float, timeout=timeout)
+
+    async def get_parameters(self, timeout=None):
+        """
+        Gets the PID control parameters (band, t_i, t_d).
+        """
+        if self.simulation: return self.simulator.get_parameters()
+        return await self.query('get_parameters', _api._parse_floats, timeout=timeout)
+
+    async def get_mode(self, timeout=None):
+        """
+        Gets the current operating mode ('OPEN_LOOP' or 'CLOSED_LOOP').
+        """
+        if self.simulation: return self.simulator.get_mode()
+        return await self.query('get_mode', timeout=timeout)
+
+    async def get_period(self, timeout=None):
+        """
+        Gets the control loop period (ms).
+        """
+        if self.simulation: return self.simulator.get_period()
+        return await self.query('get_period', int, timeout=timeout)
+
+    async def get_all_variables(self, timeout=None):
+        """
+        Gets (temperature, setpoint, dac, band, t_i, t_d, period, time_recent)
+        in one shot, see pid_api.get_all_variables().
+        """
+        if self.simulation: return self.simulator.get_all_variables()
+        if self.telemetry_format == 'BINARY':
+            return await self.query('get_all_variables', _api._parse_frame, True, timeout=timeout)
+        return await self.query('get_all_variables', _api._parse_all_variables, timeout=timeout)
+
+    async def set_telemetry_format(self, telemetry_format='BINARY', timeout=None):
+        """
+        Selects 'BINARY' or 'ASCII' get_all_variables() replies (see
+        pid_api.set_telemetry_format()). Returns the format now in use.
+        """
+        if self.simulation: return self.telemetry_format
+
+        reply = await self.query('set_format,%s'%telemetry_format, timeout=timeout)
+        if reply in ['BINARY', 'ASCII']: self.telemetry_format = reply
+        return self.telemetry_format
+
+    async def set_dac(self, level, timeout=None):
+        """
+        Sets the DAC output. Returns True if the arduino accepted it (it
+        must be in OPEN_LOOP mode).
+        """
+        if self.simulation:
+            if self.simulator.get_mode() != 'OPEN_LOOP': return False
+            self.simulator.set_dac(level)
+            return True
+        return await self.query('set_dac, '+str(level), _api._parse_ack, timeout=timeout)
+
+    async def set_temperature_setpoint(self, T=20.0, temperature_limit=None, timeout=None):
+        """
+        Sets the temperature setpoint (C). Returns False without doing
+        anything if T is above the temperature limit.
+        """
+        if temperature_limit is None: temperature_limit = self._temperature_limit
+
+        if T > temperature_limit:
+            print('Setpoint above the limit! Doing nothing.')
+            return False
+
+        if self.simulation:
+            self.simulator.set_setpoint(T)
+            return True
+        return await self.query('set_setpoint,'+str(T), _api._parse_ack, timeout=timeout)
+
+    async def set_parameters(self, band, t_i, t_d, timeout=None):
+        """
+        Sets the PID control parameters.
+        """
+        if self.simulation:
+            self.simulator.set_parameters(band, t_i, t_d)
+            return True
+        return await self.query('set_parameters,%.4f,%.4f,%.4f'%(band,t_i,t_d), _api._parse_ack, timeout=timeout)
+
+    async def set_mode(self, mode, timeout=None):
+        """
+        Sets the operating mode ('OPEN_LOOP' or 'CLOSED_LOOP').
+        """
+        if mode not in ['OPEN_LOOP', 'CLOSED_LOOP']:
+            print("Controller mode has not been changed. %s is not a vaild mode."%mode)
+            return False
+
+        if self.simulation:
+            self.simulator.set_mode(mode)
+            return True
+        return await self.query('set_mode,%s'%mode, _api._parse_ack, timeout=timeout)
+
+    async def set_period(self, period, timeout=None):
+        """
+        Sets the control loop period (ms).
+        """
+        if self.simulation:
+            self.simulator.set_period(period)
+            return True
+        return await self.query('set_period,%d'%(period), _api._parse_ack, timeout=timeout)
@@ -0,0 +1,181 @@
+import numpy as _n
+import time  as _time
+
+import pid_controller_api as _api
+
+_dac_max = 4095 # Full scale of the 12-bit MCP4725
+
+
+class relay_autotune():
+    """
+    Relay-feedback (Astrom-Hagglund) autotuner. In OPEN_LOOP mode, the dac
+    is switched between two levels whenever the temperature crosses the
+    setpoint (with some hysteresis), which makes it oscillate around the
+    setpoint at the plant's ultimate period Pu. From the oscillation
+    amplitude a, the relay amplitude d and the hysteresis h, the ultimate
+    gain is
+
+        Ku = 4 d / (pi sqrt(a**2 - h**2))     (dac counts per C)
+
+    and the Ziegler-Nichols PID settings are Kp = 0.6 Ku, t_i = Pu/2 and
+    t_d = Pu/8, i.e. a proportional band of 4095/Kp.
+
+    A positive dac output cools, so the high level is applied while the
+    temperature is above the setpoint. The setpoint must therefore be
+    reachable with the dac levels used (below ambient for the default 0
+    and 4095).
+
+    Works with anything that has the pid_api interface. In simulation mode
+    it runs on the simulator's clock, so a fast simulation_speed makes a
+    tuning run take seconds:
+
+        api  = pid_api('Simulation', simulation_speed=1000)
+        tune = relay_autotune(api, setpoint=18)
+        tune.run()
+        tune.push()
+
+    Parameters
+    ----------
+    api : pid_api
+        Connected controller.
+
+    setpoint=None : float or None
+        Temperature to oscillate around (C). None means the controller's
+        current setpoint.
+
+    low=0, high=4095 : int
+        Dac levels of the relay.
+
+    hysteresis=0.1 : float
+        Distance the temperature must go past the setpoint before the relay
+        switches (C). Should be a few times the sensor noise.
+
+    cycles=3 : int
+        Number of oscillation periods to analyze.
+
+    settle=2 : int
+        Number of oscillation periods to let pass first.
+
+    rate=10 : float
+        Polling rate (Hz, in simulated time when simulating).
+
+    timeout=3600 : float
+        Give up after this long (s, in simulated time when simulating).
+    """
+    def __init__(self, api, setpoint=None, low=0, high=_dac_max, hysteresis=0.1, cycles=3, settle=2, rate=10, timeout=3600):
+
+        self.api        = api
+        self.setpoint   = setpoint
+        self.low        = low
+        self.high       = high
+        self.hysteresis = hysteresis
+        self.cycles     = cycles
+        self.settle     = settle
+        self.rate       = rate
+        self.timeout    = timeout
+
+        self.running = False
+        self._stop   = False
+
+        # Results (see run())
+        self.data = None
+        self.ku   = self.pu = self.amplitude = None
+        self.band = self.t_i = self.t_d = None
+
+    def _time(self):
+        return self.api.simulator.time() if self.api.simulation else _time.monotonic()
+
+    def _sleep(self, seconds):
+        if self.api.simulation: self.api.simulator.sleep(seconds)
+        else:                   _time.sleep(seconds)
+
+    def stop(self):
+        """
+        Asks a run() in progress (e.g. in another thread) to give up.
+        """
+        self._stop = True
+
+    def run(self):
+        """
+        Runs the relay experiment until enough oscillation periods have been
+        recorded, then computes the tuning (see analyze()). The dac is set
+        back to 0 at the end, whatever happens.
+
+        Returns
+        -------
+        tuple
+            The new (band, t_i, t_d), in C, ms and ms.
+        """
+        api = self.api
+        if self.setpoint is None: self.setpoint = api.get_temperature_setpoint()
+
+        api.set_mode('OPEN_LOOP')
+        self.running = True
+        self._stop   = False
+
+        data     = [] # (time, temperature, dac)
+        switches = [] # Times at which the relay switched to high
+        dac      = None
+        t0       = self._time()
+        _api._debug('Autotune: relay %d/%d around %g C.'%(self.low, self.high, self.setpoint))
+
+        try:
+            while len(switches) < self.settle+self.cycles+1:
+
+                if self._stop:                          raise Exception('Autotune stopped.')
+                if self._time()-t0 > self.timeout:      raise Exception('Autotune timed out without a steady oscillation.')
+
+                t = self._time()-t0
+                T = api.get_all_variables()[0]
+
+                # Relay with hysteresis; high (cooling) above the setpoint
+                if   T > self.setpoint+self.hysteresis and dac != self.high:
+                    dac = self.high
+                    api.set_dac(dac)
+                    switches.append(t)
+                elif T < self.setpoint-self.hysteresis and dac != self.low:
+                    dac = self.low
+                    api.set_dac(dac)
+                elif dac is None:
+                    dac = self.low
+                    api.set_dac(dac)
+
+                data.append((t, T, dac))
+                self._sleep(1.0/self.rate)
+
+        finally:
+            api.set_dac(0)
+            self.running = False
+
+        self.data = _n.array(data)
+        return self.analyze(switches[self.settle:])
+
+    def analyze(self, switches):
+        """
+        Computes Pu, Ku and the tuning from the data recorded between the
+        supplied relay switch times (s).
+        """
+        t, T = self.data[:,0], self.data[:,1]
+        use  = (t >= switches[0]) & (t < switches[-1])
+
+        self.pu        = float(_n.diff(switches).mean())
+        self.amplitude = float(0.5*(T[use].max()-T[use].min()))
+
+        d = 0.5*(self.high-self.low)
+        a = max(self.amplitude, 1.01*self.hysteresis)
+        self.ku = float(4*d/(_n.pi*_n.sqrt(a**2-self.hysteresis**2)))
+
+        self.band = _dac_max/(0.6*self.ku)
+        self.t_i  = 1000*self.pu/2
+        self.t_d  = 1000*self.pu/8
+
+        _api._debug('Autotune: Pu = %.2f s, a = %.3f C, Ku = %.1f counts/C -> band %.4f C, t_i %.1f ms, t_d %.1f ms'
+                    %(self.pu, self.amplitude, self.ku, self.band, self.t_i, self.t_d))
+        return self.band, self.t_i, self.t_d
+
+    def push(self):
+        """
+        Sends the computed parameters to the controller with set_parameters().
+        """
+        if self.band is None: raise Exception('Run the autotune first.')
+        return self.api.set_parameters(self.band, self.t_i, self.t_d)
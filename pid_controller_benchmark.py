@@ -0,0 +1,341 @@
+import sys      as _sys
+import json     as _json
+import time     as _time
+import timeit   as _timeit
+import platform as _platform
+import numpy    as _n
+
+import pid_controller_api      as _api
+import pid_controller_emulator as _emulator
+
+# Latency histogram bins (s): 10 per decade from 10 us to 10 s
+_histogram_edges = 10**_n.linspace(-5, 1, 61)
+
+# Commands timed by pid_benchmark: name, telemetry format, commands per call, function of the api
+_commands = [
+    ('get_temperature',          'ASCII',  1, lambda api: api.get_temperature()),
+    ('get_setpoint',             'ASCII',  1, lambda api: api.get_temperature_setpoint()),
+    ('get_parameters',           'ASCII',  1, lambda api: api.get_parameters()),
+    ('get_mode',                 'ASCII',  1, lambda api: api.get_mode()),
+    ('get_period',               'ASCII',  1, lambda api: api.get_period()),
+    ('get_dac',                  'ASCII',  1, lambda api: api.get_dac()),
+    ('set_dac',                  'ASCII',  1, lambda api: api.set_dac(0)),
+    ('get_all_variables',        'ASCII',  1, lambda api: api.get_all_variables()),
+    ('get_all_variables_binary', 'BINARY', 1, lambda api: api.get_all_variables()),
+    ('transaction_6_getters',    'ASCII',  6, lambda api: api.transaction().get_temperature().get_temperature_setpoint()
+                                                              .get_parameters().get_mode().get_period().get_dac().execute()),
+]
+
+
+def _latency_stats(latencies, commands=1):
+    """
+    Summarizes the durations (s) of repeated calls that each carry the
+    supplied number of commands. Times in the result are in ms.
+    """
+    x = _n.asarray(latencies)
+    return dict(
+        calls      = len(x),
+        mean       = 1000*float(x.mean()),
+        p50        = 1000*float(_n.percentile(x, 50)),
+        p90        = 1000*float(_n.percentile(x, 90)),
+        p99        = 1000*float(_n.percentile(x, 99)),
+        max        = 1000*float(x.max()),
+        throughput = commands*len(x)/float(x.sum()), # Commands per second
+        histogram  = _n.histogram(x, _histogram_edges)[0].tolist())
+
+
+def parse_overhead(number=20000):
+    """
+    Times the host-side decoding of one get_all_variables() reply, ASCII
+    (_parse_all_variables) and binary (CRC check and struct unpack).
+
+    Returns
+    -------
+    dict
+        Microseconds per reply for 'ascii' and 'binary'.
+    """
+    ascii   = '22.50,20.0000,0,1.0000,1000.0000,1.0000,800,123456789'
+    payload = _api._telemetry_struct.pack(22.5, 20.0, 0, 1.0, 1000.0, 1.0, 800, 123456789)
+    frame   = bytes([len(payload)]) + payload
+
+    def binary():
+        _api._crc8(frame)
+        _api._parse_frame(payload)
+
+    return dict(ascii  = 1e6*min(_timeit.repeat(lambda: _api._parse_all_variables(ascii), number=number, repeat=3))/number,
+                binary = 1e6*min(_timeit.repeat(binary,                             number=number, repeat=3))/number)
+
+
+
+class pid_benchmark():
+    """
+    Measures how fast pid_api talks to a controller: the round-trip
+    latency and throughput of each command, the host-side parsing cost of
+    telemetry replies, and the timing jitter of the streaming thread.
+    Runs against a pid_controller_emulator.firmware_emulator emulating
+    each baud rate, or against a real port.
+
+        bench = pid_benchmark(baudrates=[9600, 115200])
+        bench.run()
+        bench.report()
+        bench.save('before.json')
+
+    and later, to check a change for regressions,
+
+        compare(load_results('before.json'), bench.results)
+
+    Parameters
+    ----------
+    baudrates=[9600, 115200] : list
+        Baud rates to emulate (or, with a real port, to connect at).
+
+    reply_delay=0 : number
+        Processing time of the emulated arduino per command (ms).
+
+    repeats=100 : int
+        Number of timed calls of each command.
+
+    stream_rate=20, stream_duration=5 : float
+        Rate (Hz) and length (s) of the streaming jitter test. A
+        stream_duration of 0 skips it.
+
+    port=None : str or None
+        Real serial port to benchmark instead of the emulator.
+        Opened without resetting the arduino.
+    """
+    def __init__(self, baudrates=[9600, 115200], reply_delay=0, repeats=100, stream_rate=20, stream_duration=5, port=None):
+
+        self.baudrates       = list(baudrates)
+        self.reply_delay     = reply_delay
+        self.repeats         = repeats
+        self.stream_rate     = stream_rate
+        self.stream_duration = stream_duration
+        self.port            = port
+
+        self.results = None
+
+    def _time_commands(self, api):
+        """
+        Times every command in _commands, returning their _latency_stats().
+        """
+        results = dict()
+        for name, telemetry_format, commands, f in _commands:
+
+            if api.telemetry_format != telemetry_format and api.set_telemetry_format(telemetry_format) != telemetry_format:
+                _api._debug('Benchmark: skipping %s, %s telemetry not supported.'%(name, telemetry_format))
+                continue
+
+            for n in range(3): f(api) # Warm up
+
+            latencies = []
+            for n in range(self.repeats):
+                t0 = _time.perf_counter()
+                f(api)
+                latencies.append(_time.perf_counter()-t0)
+
+            results[name] = _latency_stats(latencies, commands)
+            _api._debug('Benchmark: %-25s p50 %7.3f ms, p99 %7.3f ms, %7.1f commands/s'
+                        %(name, results[name]['p50'], results[name]['p99'], results[name]['throughput']))
+
+        if api.telemetry_format != 'ASCII': api.set_telemetry_format('ASCII')
+        return results
+
+    def _time_streaming(self, api):
+        """
+        Streams for stream_duration and returns statistics of the intervals
+        between samples, in ms.
+        """
+        times = []
+        def listener(x): times.append(_time.perf_counter())
+
+        api.add_listener(listener)
+        errors = api.stream_errors
+        api.start_streaming(self.stream_rate)
+        _time.sleep(self.stream_duration)
+        api.stop_streaming()
+        api.remove_listener(listener)
+        api.get_samples()
+
+        intervals = _n.diff(times)
+        if len(intervals) < 2: return dict(samples=len(times), errors=api.stream_errors-errors)
+
+        jitter = intervals - 1.0/self.stream_rate
+        return dict(
+            samples       = len(times),
+            errors        = api.stream_errors-errors,
+            mean_interval = 1000*float(intervals.mean()),
+            std           = 1000*float(jitter.std()),
+            p99           = 1000*float(_n.percentile(_n.abs(jitter), 99)),
+            max           = 1000*float(_n.abs(jitter).max()))
+
+    def run(self):
+        """
+        Runs every benchmark at every baud rate and fills self.results.
+
+        Returns
+        -------
+        dict
+            JSON-ready results: the settings, the machine, parse overhead
+            (us per reply), and for each baud rate the statistics of each
+            command (latencies in ms, throughput in commands/s, histogram
+            counts over histogram_edges in ms) and of the streaming ticks.
+        """
+        results = dict(
+            time            = _time.time(),
+            python          = _sys.version.split()[0],
+            platform        = _platform.platform(),
+            port            = self.port or 'emulator',
+            reply_delay     = self.reply_delay,
+            repeats         = self.repeats,
+            stream_rate     = self.stream_rate,
+            histogram_edges = (1000*_histogram_edges).tolist(),
+            parse           = parse_overhead(),
+            baudrates       = dict())
+
+        for baudrate in self.baudrates:
+            _api._debug('Benchmark: %d baud'%baudrate)
+
+            device = None if self.port else _emulator.firmware_emulator(baudrate=baudrate, reply_delay=self.reply_delay, banner=False)
+            api    = _api.pid_api(self.port or device.port, baudrate, reset=False, ready_timeout=3000)
+            if api.simulation:
+                if device: device.close()
+                raise Exception('Could not connect to '+(self.port or device.port)+'.')
+
+            try:
+                r = dict(commands=self._time_commands(api))
+                if self.stream_duration: r['streaming'] = self._time_streaming(api)
+                results['baudrates'][str(baudrate)] = r
+
+            finally:
+                api.disconnect()
+                if device: device.close()
+
+        self.results = results
+        return results
+
+    def report(self):
+        """
+        Prints a table of the results.
+        """
+        if self.results is None: raise Exception('Run the benchmark first.')
+        print(format_results(self.results))
+
+    def save(self, path):
+        """
+        Writes the results to a JSON file (see load_results() and compare()).
+        """
+        if self.results is None: raise Exception('Run the benchmark first.')
+        with open(path, 'w') as f: _json.dump(self.results, f, indent=1)
+
+
+
+def load_results(path):
+    """
+    Reads results saved by pid_benchmark.save().
+    """
+    with open(path) as f: return _json.load(f)
+
+
+def format_results(results, histograms=False):
+    """
+    Returns the results of a pid_benchmark as a text table. If histograms
+    is True, the latency histogram of each command is included.
+    """
+    lines = ['Parse overhead per get_all_variables reply: ASCII %.2f us, binary %.2f us'
+             %(results['parse']['ascii'], results['parse']['binary'])]
+    edges = results['histogram_edges']
+
+    for baudrate, r in results['baudrates'].items():
+        lines += ['', '%s baud, reply delay %g ms'%(baudrate, results['reply_delay']),
+                  '%-25s %6s %9s %9s %9s %9s %11s'%('command', 'calls', 'mean ms', 'p50 ms', 'p99 ms', 'max ms', 'commands/s')]
+
+        for name, c in r['commands'].items():
+            lines.append('%-25s %6d %9.3f %9.3f %9.3f %9.3f %11.1f'%(name, c['calls'], c['mean'], c['p50'], c['p99'], c['max'], c['throughput']))
+
+            if histograms:
+                peak = max(c['histogram'])
+                for n, count in enumerate(c['histogram']):
+                    if count: lines.append('    %9.3f-%9.3f ms %6d %s'%(edges[n], edges[n+1], count, '#'*int(round(40*count/peak))))
+
+        s = r.get('streaming')
+        if s and 'std' in s:
+            lines.append('streaming at %g Hz: %d samples, %d errors, interval %.2f ms, jitter std %.3f ms, p99 %.3f ms, max %.3f ms'
+                         %(results['stream_rate'], s['samples'], s['errors'], s['mean_interval'], s['std'], s['p99'], s['max']))
+
+    return '\n'.join(lines)
+
+
+def compare(old, new, tolerance=0.1):
+    """
+    Compares two sets of pid_benchmark results, e.g. from before and after
+    a change, for every baud rate and command they have in common.
+
+    Parameters
+    ----------
+    old, new : dict
+        Results (see pid_benchmark.run() and load_results()).
+
+    tolerance=0.1 : float
+        Relative change below which differences are ignored.
+
+    Returns
+    -------
+    list
+        One (baudrate, command, metric, old value, new value) tuple for
+        each p50 or p99 latency that grew, or throughput that dropped, by
+        more than the tolerance.
+    """
+    regressions = []
+    for baudrate, r in new['baudrates'].items():
+        if baudrate not in old['baudrates']: continue
+
+        for name, c in r['commands'].items():
+            o = old['baudrates'][baudrate]['commands'].get(name)
+            if o is None: continue
+
+            for metric in ['p50', 'p99']:
+                if c[metric] > o[metric]*(1+tolerance): regressions.append((baudrate, name, metric, o[metric], c[metric]))
+            if c['throughput'] < o['throughput']*(1-tolerance):
+                regressions.append((baudrate, name, 'throughput', o['throughput'], c['throughput']))
+
+    for kind in ['ascii', 'binary']:
+        if new['parse'][kind] > old['parse'][kind]*(1+tolerance):
+            regressions.append((None, 'parse', kind, old['parse'][kind], new['parse'][kind]))
+
+    return regressions
+
+
+
+if __name__ == '__main__':
+
+    # e.g. python pid_controller_benchmark.py --baudrates 9600 115200 --save before.json
+    import argparse as _argparse
+
+    parser = _argparse.ArgumentParser(description='Benchmarks pid_api against the firmware emulator (or a real port).')
+    parser.add_argument('--baudrates',       type=int,   nargs='+', default=[9600, 115200], help='Baud rates to emulate (default 9600 115200).')
+    parser.add_argument('--reply-delay',     type=float, default=0,    help='Processing time per command of the emulated arduino in ms (default 0).')
+    parser.add_argument('--repeats',         type=int,   default=100,  help='Timed calls of each command (default 100).')
+    parser.add_argument('--stream-rate',     type=float, default=20,   help='Streaming rate for the jitter test in Hz (default 20).')
+    parser.add_argument('--stream-duration', type=float, default=5,    help='Length of the jitter test in s, 0 to skip (default 5).')
+    parser.add_argument('--port',                        default=None, help='Benchmark a real port instead of the emulator.')
+    parser.add_argument('--histograms',      action='store_true',      help='Print the latency histograms.')
+    parser.add_argument('--save',                        default=None, help='Save the results to this JSON file.')
+    parser.add_argument('--compare',                     default=None, help='Compare with results saved earlier, exit status 1 on regressions.')
+    parser.add_argument('--tolerance',       type=float, default=0.1,  help='Relative change allowed by --compare (default 0.1).')
+    parser.add_argument('--verbose',         action='store_true',      help='Print debug messages.')
+    args = parser.parse_args()
+
+    _api._debug_enabled = args.verbose
+
+    bench = pid_benchmark(args.baudrates, args.reply_delay, args.repeats, args.stream_rate, args.stream_duration, args.port)
+    bench.run()
+    print(format_results(bench.results, args.histograms))
+    if args.save: bench.save(args.save)
+
+    if args.compare:
+        regressions = compare(load_results(args.compare), bench.results, args.tolerance)
+        print()
+        for baudrate, name, metric, old, new in regressions:
+            print('Regression: %s %s %s %.4g -> %.4g'%(baudrate or '', name, metric, old, new))
+        print('%d regressions against %s.'%(len(regressions), args.compare))
+        _sys.exit(1 if len(regressions) else 0)
@@ -0,0 +1,327 @@
+import numpy as _n
+
+
+class ring_buffer():
+    """
+    Fixed-capacity, columnar buffer of float rows with O(1) appends.
+
+    Every row is written twice, at slot i and slot i+capacity of an array
+    twice the capacity, so the most recent rows are always one contiguous
+    slice of memory. view() and column access therefore return views,
+    never copies, however often the buffer has wrapped around.
+
+    Rows about to be overwritten can be spilled to a CSV file, in chunks,
+    so long runs keep their full history on disk while memory stays fixed.
+
+    The whole history is also summarized in a minmax_pyramid, so
+    plot_data() can return a fixed number of points for any time window,
+    at full resolution when the window is small and in memory.
+
+    Parameters
+    ----------
+    columns : list
+        Column names.
+
+    capacity=100000 : int
+        Number of rows kept in memory.
+
+    spill_path=None : str or None
+        If not None, rows are appended to this CSV file before they are
+        overwritten. The file is only created once the buffer first fills up.
+
+    spill_chunk=1000 : int
+        Number of rows written to the spill file at a time.
+
+    decimate=True : bool
+        Whether to keep a minmax_pyramid of the history for plot_data().
+        The first column must then be time (or anything non-decreasing).
+
+    history=None : function or None
+        Optional source of full-resolution rows that are no longer in
+        memory, e.g. a session file being replayed. Called by plot_data()
+        as history(t0, t1, points), it should return the rows in the time
+        window [t0, t1], or None if there are more than points of them.
+    """
+    def __init__(self, columns, capacity=100000, spill_path=None, spill_chunk=1000, decimate=True, history=None):
+
+        self.columns     = list(columns)
+        self.capacity    = capacity
+        self.spill_path  = spill_path
+        self.spill_chunk = min(spill_chunk, capacity)
+
+        self._data       = _n.zeros((2*capacity, len(self.columns)))
+        self._header     = True # Whether the spill file still needs its header
+        self.count       = 0    # Rows appended since the last clear()
+        self.spilled     = 0    # Of those, rows written to the spill file
+        self.pyramid     = minmax_pyramid(len(self.columns)) if decimate else None
+        self.history     = history
+
+    def clear(self):
+        """
+        Spills any rows not yet on disk, then forgets every row.
+        """
+        self.flush()
+        self.count   = 0
+        self.spilled = 0
+        if self.pyramid is not None: self.pyramid.clear()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, row):
+        """
+        Appends one row (one value per column).
+        """
+        # Spill the oldest rows before the first of them is overwritten
+        if self.spill_path is not None and self.count-self.capacity >= self.spilled: self._spill()
+
+        i = self.count % self.capacity
+        self._data[i]               = row
+        self._data[i+self.capacity] = row
+        self.count += 1
+
+        if self.pyramid is not None: self.pyramid.append(self._data[i])
+
+    def extend(self, rows):
+        """
+        Appends many rows (a 2D array) at once, e.g. when loading a saved
+        session. Equivalent to append()ing them one by one, but vectorized.
+        """
+        rows = _n.asarray(rows, dtype=float).reshape(-1, len(self.columns))
+
+        for start in range(0, len(rows), self.spill_chunk):
+            chunk = rows[start:start+self.spill_chunk]
+            m     = len(chunk)
+
+            # Spill the oldest rows before any of them is overwritten
+            while self.spill_path is not None and self.count+m-self.capacity > self.spilled:
+                self._spill(min(self.spill_chunk, self.count-self.spilled))
+
+            # Write both copies, wrapping around the end if needed
+            i     = self.count % self.capacity
+            first = min(m, self.capacity-i)
+            for offset in [0, self.capacity]:
+                self._data[offset+i:offset+i+first] = chunk[:first]
+                self._data[offset  :offset+m-first] = chunk[first:]
+            self.count += m
+
+            if self.pyramid is not None: self.pyramid.extend(chunk)
+
+    def _spill(self, rows=None):
+        """
+        Appends the oldest rows not yet on disk (default: spill_chunk of
+        them) to the spill file.
+        """
+        if rows is None: rows = self.spill_chunk
+
+        start = self.spilled % self.capacity
+        data  = self._data[start:start+rows]
+
+        with open(self.spill_path, 'a') as f:
+            _n.savetxt(f, data, delimiter=',', header=','.join(self.columns) if self._header else '', comments='')
+        self._header = False
+
+        self.spilled += len(data)
+
+    def view(self):
+        """
+        Returns the rows in memory, oldest first, as a (rows, columns) view.
+        """
+        n     = len(self)
+        start = (self.count-n) % self.capacity
+        return self._data[start:start+n]
+
+    def __getitem__(self, key):
+        """
+        Returns a view of one column, by name or index, oldest first.
+        """
+        if type(key) is str: key = self.columns.index(key)
+        return self.view()[:,key]
+
+    def flush(self):
+        """
+        Spills every row still in memory that is not yet on disk, e.g.
+        at the end of a run.
+        """
+        if self.spill_path is None: return
+        while self.spilled < self.count: self._spill(min(self.spill_chunk, self.count-self.spilled))
+
+    def plot_data(self, t0=None, t1=None, points=2000):
+        """
+        Returns at most about points rows covering the time window [t0, t1],
+        whatever the length of the history.
+
+        If the window is in memory (or available from history) and holds no
+        more than points rows, they are returned at full resolution. Otherwise the history is
+        drawn from the coarsest minmax_pyramid level that still has enough
+        buckets, each bucket becoming two rows (its minima and its maxima,
+        both at the middle of the bucket), followed by the newest rows that
+        have not been summarized yet.
+
+        Parameters
+        ----------
+        t0=None, t1=None : float or None
+            Time window. None means the start or end of the history.
+
+        points=2000 : int
+            Maximum number of rows to return, e.g. the plot width in pixels.
+
+        Returns
+        -------
+        array
+            Rows (with the same columns as the buffer), oldest first.
+        """
+        if t0 is None: t0 = -_n.inf
+        if t1 is None: t1 =  _n.inf
+
+        view = self.view()
+        t    = view[:,0]
+
+        # Full resolution if we have everything in the window
+        if self.pyramid is None or (len(view) and (self.count <= self.capacity or t0 >= t[0])):
+            i0 = _n.searchsorted(t, t0)
+            i1 = _n.searchsorted(t, t1, 'right')
+            if self.pyramid is None or i1-i0 <= points: return view[i0:i1]
+
+        # Otherwise full resolution from the history, if it has few enough rows
+        elif self.history is not None:
+            rows = self.history(t0, t1, points)
+            if rows is not None: return rows
+
+        nc      = len(self.columns)
+        buckets = self.pyramid.buckets(t0, t1, points//2)
+
+        rows = _n.zeros((2*len(buckets), nc))
+        rows[0::2] = buckets[:,:nc]
+        rows[1::2] = buckets[:,nc:]
+        rows[0::2,0] = rows[1::2,0] = 0.5*(buckets[:,0]+buckets[:,nc])
+
+        # Rows not yet in a pyramid bucket
+        tail = view[len(view)-self.pyramid.partial:]
+        tail = tail[(tail[:,0] >= t0) & (tail[:,0] <= t1)]
+
+        return _n.concatenate([rows, tail])
+
+
+
+class minmax_pyramid():
+    """
+    Running min/max summary of a growing series of rows, at several
+    resolutions. Level 0 holds the minima and maxima of every bucket rows,
+    and each level above combines factor buckets of the one below, so
+    appending is O(1) amortized and the whole structure is about
+    1/bucket the size of the data.
+
+    Parameters
+    ----------
+    columns : int
+        Number of values per row. The first must be non-decreasing (time);
+        it is used to find the buckets in a time window.
+
+    bucket=64 : int
+        Rows per level-0 bucket.
+
+    factor=4 : int
+        Buckets combined into one at each level up.
+    """
+    def __init__(self, columns, bucket=64, factor=4):
+
+        self.columns = columns
+        self.bucket  = bucket
+        self.factor  = factor
+        self.clear()
+
+    def clear(self):
+        """
+        Forgets everything.
+        """
+        self._levels = [] # Per level, array of [minima, maxima] rows (grown by doubling)
+        self._counts = [] # Per level, number of rows in use
+        self.partial = 0  # Rows in the level-0 bucket being filled
+
+    def append(self, row):
+        """
+        Adds one row.
+        """
+        if self.partial == 0:
+            self._min = _n.array(row, dtype=float)
+            self._max = _n.array(row, dtype=float)
+        else:
+            _n.minimum(self._min, row, out=self._min)
+            _n.maximum(self._max, row, out=self._max)
+
+        self.partial += 1
+        if self.partial == self.bucket:
+            self._push(0, _n.concatenate([self._min, self._max])[None])
+            self.partial = 0
+
+    def extend(self, rows):
+        """
+        Adds many rows (a 2D array) at once; whole buckets are summarized
+        in a few vectorized operations.
+        """
+        rows = _n.asarray(rows, dtype=float)
+
+        # Finish the bucket being filled
+        n = min(len(rows), (self.bucket-self.partial) % self.bucket)
+        for row in rows[:n]: self.append(row)
+
+        # Whole buckets
+        k = (len(rows)-n) // self.bucket
+        if k:
+            b = rows[n:n+k*self.bucket].reshape(k, self.bucket, self.columns)
+            self._push(0, _n.concatenate([b.min(axis=1), b.max(axis=1)], axis=1))
+
+        # Start of the next bucket
+        for row in rows[n+k*self.bucket:]: self.append(row)
+
+    def _push(self, level, entries):
+        """
+        Adds finished buckets (rows of [minima, maxima]) to a level, and
+        combines every complete group of factor of them into the level above.
+        """
+        if level == len(self._levels):
+            self._levels.append(_n.zeros((16, 2*self.columns)))
+            self._counts.append(0)
+
+        n0 = self._counts[level]
+        n1 = n0+len(entries)
+        while n1 > len(self._levels[level]):
+            self._levels[level] = _n.concatenate([self._levels[level], _n.zeros_like(self._levels[level])])
+
+        self._levels[level][n0:n1] = entries
+        self._counts[level]        = n1
+
+        # Groups completed by these entries
+        g0, g1 = n0//self.factor, n1//self.factor
+        if g1 > g0:
+            group = self._levels[level][g0*self.factor:g1*self.factor].reshape(g1-g0, self.factor, 2*self.columns)
+            self._push(level+1, _n.concatenate([group[:,:,:self.columns].min(axis=1), group[:,:,self.columns:].max(axis=1)], axis=1))
+
+    def level(self, n):
+        """
+        Returns the finished buckets of level n as rows of [minima, maxima].
+        """
+        return self._levels[n][:self._counts[n]]
+
+    def buckets(self, t0, t1, max_buckets):
+        """
+        Returns the finished buckets overlapping [t0, t1] from the finest
+        level that needs no more than max_buckets of them, followed by the
+        newer buckets of the finer levels that it does not cover yet.
+        """
+        nc = self.columns
+        if not len(self._levels): return _n.zeros((0, 2*nc))
+
+        for n in range(len(self._levels)):
+            a  = self.level(n)
+            i0 = _n.searchsorted(a[:,nc], t0)          # First bucket ending at or after t0
+            i1 = _n.searchsorted(a[:,0],  t1, 'right') # Last bucket starting at or before t1
+            if i1-i0 <= max_buckets: break
+
+        parts = [a[i0:i1]]
+        for m in range(n-1, -1, -1):
+            tail = self.level(m)[self._counts[m+1]*self.factor:]
+            parts.append(tail[(tail[:,nc] >= t0) & (tail[:,0] <= t1)])
+
+        return _n.concatenate(parts)
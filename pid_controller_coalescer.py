@@ -0,0 +1,189 @@
+import time      as _time
+import threading as _threading
+
+import pid_controller_api as _api
+
+
+class pid_coalescer():
+    """
+    Write-coalescing layer between the GUI and a pid_api. Setters only
+    record the latest value per command, and a background thread sends
+    whatever is pending as one tagged transaction (see pid_api.execute()),
+    at most rate times per second. Dragging a spin box therefore costs a
+    few writes rather than one per step, and telemetry polls are not
+    stuck behind a queue of stale parameters.
+
+    Writes equal to the last state the arduino acknowledged are skipped.
+    That state comes from the acknowledgements of earlier writes and from
+    refresh(); forget() drops it, e.g. when the arduino may have changed a
+    value by itself.
+
+    Parameters
+    ----------
+    api : pid_api
+        Api to send the commands through.
+
+    rate=10 : float
+        Most flushes per second (Hz). The first change after a quiet spell
+        is sent right away.
+    """
+    def __init__(self, api, rate=10):
+
+        self.api  = api
+        self.rate = rate
+
+        self._lock         = _threading.Lock()
+        self._pending      = dict() # command: value waiting to be sent
+        self._acknowledged = dict() # command: value last accepted by the arduino
+        self._last_flush   = None
+
+        # Counters (see get_stats())
+        self.sent      = 0
+        self.coalesced = 0
+        self.skipped   = 0
+        self.errors    = 0
+
+        self._wake   = _threading.Event()
+        self._stop   = _threading.Event()
+        self._thread = _threading.Thread(target=self._run, name='pid_coalescer', daemon=True)
+        self._thread.start()
+
+    def _queue(self, command, value):
+        """
+        Records value as the next one to send for command.
+        """
+        with self._lock:
+            if command in self._pending: self.coalesced += 1
+            self._pending[command] = value
+        self._wake.set()
+
+    def set_temperature_setpoint(self, T=20.0):
+        """
+        Queues a new temperature setpoint (C). Values above the api's
+        temperature limit are refused, as in pid_api.
+        """
+        if T > self.api._temperature_limit:
+            print('Setpoint above the limit! Doing nothing.')
+            return
+        self._queue('set_setpoint', float(T))
+
+    def set_parameters(self, band, t_i, t_d):
+        """
+        Queues new control parameters. They are compared at the 4 decimals
+        that are sent to the arduino.
+        """
+        self._queue('set_parameters', (round(band, 4), round(t_i, 4), round(t_d, 4)))
+
+    def set_period(self, period):
+        """
+        Queues a new control period (ms).
+        """
+        self._queue('set_period', int(period))
+
+    def set_dac(self, level):
+        """
+        Queues a new dac level. The arduino only accepts it in OPEN_LOOP
+        mode; refused levels are not acknowledged.
+        """
+        self._queue('set_dac', int(level))
+
+    def refresh(self, values=None):
+        """
+        Records the arduino's current state as acknowledged.
+
+        Parameters
+        ----------
+        values=None : list or None
+            The output of pid_api.get_all_variables(), if already at hand.
+            If None, it is queried.
+        """
+        if values is None: values = self.api.get_all_variables()
+        T, S, dac, band, t_i, t_d, period = values[:7]
+        with self._lock:
+            self._acknowledged.update({'set_setpoint'  : float(S),
+                                       'set_parameters': (round(band, 4), round(t_i, 4), round(t_d, 4)),
+                                       'set_period'    : int(period),
+                                       'set_dac'       : int(dac)})
+
+    def forget(self, command=None):
+        """
+        Drops the acknowledged state of command (e.g. 'set_dac' after a
+        mode change), or of every command if None, so the next write is
+        sent whatever its value.
+        """
+        with self._lock:
+            if command is None: self._acknowledged.clear()
+            else:               self._acknowledged.pop(command, None)
+
+    def flush(self):
+        """
+        Sends the pending writes now, in one transaction, skipping those
+        equal to the acknowledged state.
+
+        Returns
+        -------
+        int
+            Number of commands sent.
+        """
+        with self._lock:
+            pending       = self._pending
+            self._pending = dict()
+            commands      = [c for c in pending if self._acknowledged.get(c) != pending[c]]
+            self.skipped += len(pending)-len(commands)
+        self._last_flush = _time.monotonic()
+        if not len(commands): return 0
+
+        transaction = self.api.transaction()
+        for c in commands:
+            v = pending[c]
+            if   c == 'set_setpoint'  : transaction.set_temperature_setpoint(v)
+            elif c == 'set_parameters': transaction.set_parameters(*v)
+            elif c == 'set_period'    : transaction.set_period(v)
+            elif c == 'set_dac'       : transaction.set_dac(v)
+
+        try: results = transaction.execute()
+        except Exception as e:
+            _api._debug('Coalescer: could not send '+', '.join(commands), e)
+            results = [False]*len(commands)
+            self.errors += 1
+
+        with self._lock:
+            for c, accepted in zip(commands, results):
+                if accepted: self._acknowledged[c] = pending[c]
+                else:        self._acknowledged.pop(c, None)
+        self.sent += len(commands)
+        return len(commands)
+
+    def get_stats(self):
+        """
+        Returns a dictionary with the number of commands sent, coalesced
+        (replaced by a newer value before being sent), skipped (equal to
+        the acknowledged state), and of failed flushes.
+        """
+        return dict(sent=self.sent, coalesced=self.coalesced, skipped=self.skipped, errors=self.errors)
+
+    def close(self):
+        """
+        Stops the background thread, then sends anything still pending.
+        """
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        """
+        Background thread: waits for pending writes, then flushes them no
+        sooner than 1/rate after the previous flush.
+        """
+        while True:
+            self._wake.wait()
+            if self._stop.is_set(): return
+
+            if self._last_flush is not None:
+                delay = self._last_flush + 1.0/self.rate - _time.monotonic()
+                if delay > 0 and self._stop.wait(delay): return
+
+            self._wake.clear()
+            try: self.flush()
+            except Exception as e: _api._debug('Coalescer error', e)
@@ -0,0 +1,491 @@
+import json        as _json
+import time        as _time
+import base64      as _base64
+import socket      as _socket
+import struct      as _struct
+import threading   as _threading
+import collections as _collections
+import numpy       as _n
+
+import pid_controller_api     as _api
+import pid_controller_session as _session
+
+# Address the daemon listens on, and clients connect to, by default
+_default_address = ('127.0.0.1', 7757)
+
+# Every message is a header (type, payload length) followed by the payload.
+# Requests and replies are JSON; telemetry is a batch of session records
+# (pid_controller_session.record_dtype, 48 bytes per sample).
+_header  = _struct.Struct('<BI')
+_request = 1 # [id, method, args, kwargs]
+_reply   = 2 # [id, result, error]
+_samples = 3 # Records
+
+# Most telemetry messages waiting for a slow subscriber before new ones are dropped
+_backlog = 1000
+
+# pid_api methods clients may call
+_methods = ['get_dac', 'get_temperature', 'get_temperature_setpoint', 'get_parameters', 'get_mode', 'get_period',
+            'get_all_variables', 'get_history', 'get_state', 'set_dac', 'set_temperature_setpoint', 'set_parameters',
+            'set_mode', 'set_period', 'set_telemetry_format', 'enable_stats', 'get_stats', 'reset_stats']
+
+# pid_transaction methods clients may queue
+_transaction_methods = ['get_dac', 'get_temperature', 'get_temperature_setpoint', 'get_parameters', 'get_mode', 'get_period',
+                        'get_all_variables', 'set_dac', 'set_temperature_setpoint', 'set_parameters', 'set_mode', 'set_period']
+
+
+def _encode(x):
+    """
+    Makes a result JSON-friendly. Arrays (e.g. from get_history()) are
+    sent as their raw bytes, and tuples are marked so they come back as
+    tuples rather than lists, as from pid_api.
+    """
+    if isinstance(x, _n.ndarray): return {'__ndarray__': x.dtype.descr if x.dtype.names else x.dtype.str, 'data': _base64.b64encode(x.tobytes()).decode()}
+    if isinstance(x, _n.generic): return x.item()
+    if isinstance(x, tuple):      return {'__tuple__': [_encode(v) for v in x]}
+    if isinstance(x, list):       return [_encode(v) for v in x]
+    if isinstance(x, dict):       return {k: _encode(v) for k, v in x.items()}
+    return x
+
+def _decode(x):
+    """
+    Undoes _encode().
+    """
+    if isinstance(x, dict) and '__ndarray__' in x:
+        dtype = x['__ndarray__']
+        dtype = _n.dtype([tuple(f) for f in dtype] if isinstance(dtype, list) else dtype)
+        return _n.frombuffer(_base64.b64decode(x['data']), dtype).copy()
+    if isinstance(x, dict) and '__tuple__' in x: return tuple(_decode(v) for v in x['__tuple__'])
+    if isinstance(x, list): return [_decode(v) for v in x]
+    if isinstance(x, dict): return {k: _decode(v) for k, v in x.items()}
+    return x
+
+def _recv_exactly(sock, size):
+    """
+    Reads size bytes from a socket, or returns None if it closed.
+    """
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size-len(data))
+        if not len(chunk): return None
+        data += chunk
+    return data
+
+def _recv_message(sock):
+    """
+    Reads one message. Returns (type, payload), or None if the socket closed.
+    """
+    header = _recv_exactly(sock, _header.size)
+    if header is None: return None
+    kind, size = _header.unpack(header)
+    payload = _recv_exactly(sock, size)
+    if payload is None: return None
+    return kind, payload
+
+def _message(kind, payload):
+    return _header.pack(kind, len(payload)) + payload
+
+
+
+class _daemon_client():
+    """
+    One client connection of a pid_daemon: a thread running its requests
+    in order, and a thread sending its replies and telemetry. Telemetry
+    waiting to be sent is batched into one message, and dropped (counted
+    in self.dropped) if the client falls more than _backlog messages
+    behind.
+    """
+    def __init__(self, daemon, sock, address):
+        self.daemon  = daemon
+        self.sock    = sock
+        self.address = address
+        self.rate    = None # Streaming rate asked for, if subscribed
+        self.dropped = 0
+
+        self._outbox    = _collections.deque() # (kind, payload)
+        self._condition = _threading.Condition()
+        self._closed    = False
+
+        self._reader = _threading.Thread(target=self._read_loop, daemon=True)
+        self._sender = _threading.Thread(target=self._send_loop, daemon=True)
+        self._reader.start()
+        self._sender.start()
+
+    def send(self, kind, payload):
+        """
+        Queues a message. Telemetry is dropped if the client is too far behind.
+        """
+        with self._condition:
+            if kind == _samples and len(self._outbox) >= _backlog:
+                self.dropped += 1
+                return
+            self._outbox.append((kind, payload))
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            if self._closed: return
+            self._closed = True
+            self._condition.notify()
+        try:    self.sock.shutdown(_socket.SHUT_RDWR)
+        except: pass
+        self.sock.close()
+        self.daemon._remove(self)
+
+    def _read_loop(self):
+        """
+        Runs the client's requests, one at a time.
+        """
+        try:
+            while True:
+                message = _recv_message(self.sock)
+                if message is None: break
+
+                n, method, args, kwargs = _json.loads(message[1])
+                args, kwargs = _decode(args), _decode(kwargs)
+                try:                   result, error = _encode(self.daemon._call(self, method, args, kwargs)), None
+                except Exception as e: result, error = None, '%s: %s'%(type(e).__name__, e)
+                self.send(_reply, _json.dumps([n, result, error]).encode())
+        except (OSError, ValueError) as e: _api._debug('Daemon: dropping client %s:%d'%self.address, e)
+        finally: self.close()
+
+    def _send_loop(self):
+        """
+        Sends queued messages, merging consecutive telemetry batches.
+        """
+        while True:
+            with self._condition:
+                while not len(self._outbox) and not self._closed: self._condition.wait()
+                if self._closed: return
+
+                kind, payload = self._outbox.popleft()
+                if kind == _samples:
+                    while len(self._outbox) and self._outbox[0][0] == _samples: payload += self._outbox.popleft()[1]
+
+            try: self.sock.sendall(_message(kind, payload))
+            except OSError: return self.close()
+
+
+
+class pid_daemon():
+    """
+    Owns the pid_api connection to one controller and shares it with any
+    number of local clients (see pid_daemon_client), so e.g. the GUI, a
+    logger and a notebook can all use the same bench. Requests from all
+    clients go through the one pid_api, whose lock serializes them on the
+    serial line. Telemetry is polled once by the api's streaming thread
+    and each sample is sent to every subscriber, so more subscribers do
+    not mean more serial traffic.
+
+    Parameters
+    ----------
+    port : str
+        Serial port of the controller (or 'Simulation').
+
+    baudrate=115200 : int
+        Baud rate, see pid_api.
+
+    address=_default_address : tuple
+        (host, port) to listen on. Keep the host local: the protocol has
+        no authentication.
+
+    rate=None : float or None
+        Telemetry rate (Hz). None means the fastest rate any subscriber
+        asks for, and no polling while nobody is subscribed.
+
+    api_class=pid_api : class
+        Class used to talk to the controller.
+
+    **kwargs
+        Sent to api_class, e.g. timeout or reset.
+    """
+    def __init__(self, port, baudrate=115200, address=_default_address, rate=None, api_class=_api.pid_api, **kwargs):
+
+        self.port    = port
+        self.rate    = rate
+        self.clients = []
+        self._lock   = _threading.Lock()
+
+        self._stream_rate = rate # Rate the api is streaming at
+
+        self.api = api_class(port=port, baudrate=baudrate, **kwargs)
+        self.api.add_listener(self._publish)
+        if rate is not None: self.api.start_streaming(rate)
+
+        self._server = _socket.create_server(address)
+        self.address = self._server.getsockname()[:2]
+        self._thread = _threading.Thread(target=self._accept_loop, daemon=True)
+        self._thread.start()
+        _api._debug('Daemon for %s listening on %s:%d.'%((port,)+self.address))
+
+    def close(self):
+        """
+        Disconnects every client and the controller.
+        """
+        self._server.close()
+        for client in list(self.clients): client.close()
+        self.api.disconnect()
+
+    def _accept_loop(self):
+        while True:
+            try:    sock, address = self._server.accept()
+            except OSError: return
+            sock.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, 1)
+            with self._lock: self.clients.append(_daemon_client(self, sock, address[:2]))
+
+    def _remove(self, client):
+        with self._lock:
+            if client in self.clients: self.clients.remove(client)
+        self._update_streaming()
+
+    def _update_streaming(self):
+        """
+        Polls at the fastest rate any subscriber wants (unless self.rate is set).
+        """
+        if self.rate is not None: return
+        with self._lock: rates = [c.rate for c in self.clients if c.rate is not None]
+
+        if not len(rates): self.api.stop_streaming()
+        elif not self.api.is_streaming() or self._stream_rate != max(rates):
+            self._stream_rate = max(rates)
+            self.api.start_streaming(self._stream_rate)
+
+    def _publish(self, sample):
+        """
+        api listener: sends a sample to every subscriber, encoded once.
+        """
+        payload = _session.to_records([sample]).tobytes()
+        with self._lock: subscribers = [c for c in self.clients if c.rate is not None]
+        for client in subscribers: client.send(_samples, payload)
+
+    def _call(self, client, method, args, kwargs):
+        """
+        Runs one client request.
+        """
+        if method in _methods: return getattr(self.api, method)(*args, **kwargs)
+
+        if method == 'transaction':
+            transaction = self.api.transaction()
+            for name, a in args[0]:
+                if name not in _transaction_methods: raise Exception('%s cannot be used in a transaction.'%name)
+                getattr(transaction, name)(*a)
+            return transaction.execute()
+
+        if method == 'subscribe':
+            client.rate = args[0]
+            self._update_streaming()
+            return True
+
+        if method == 'unsubscribe':
+            client.rate = None
+            self._update_streaming()
+            return True
+
+        if method == 'info':
+            return dict(port=self.port, simulation=self.api.simulation, baudrate=self.api.baudrate, telemetry_format=self.api.telemetry_format,
+                        temperature_limit=self.api._temperature_limit, missed_ticks=self.api.missed_ticks, stream_errors=self.api.stream_errors,
+                        clients=len(self.clients), dropped=client.dropped)
+
+        raise Exception('Unknown method %s.'%method)
+
+
+
+class pid_daemon_transaction():
+    """
+    pid_transaction for a pid_daemon_client: the queued calls are sent in
+    one request and run as one pid_transaction by the daemon.
+    """
+    def __init__(self, client):
+        self.client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        if name not in _transaction_methods: raise AttributeError(name)
+        def queue(*args):
+            self._calls.append((name, args))
+            return self
+        return queue
+
+    def execute(self):
+        return list(self.client.call('transaction', self._calls))
+
+
+
+class pid_daemon_client():
+    """
+    Client of a pid_daemon, with the interface of pid_api, so it can be
+    used as the GUI's api_class or anywhere else a pid_api is expected.
+    Commands are sent to the daemon, and streaming subscribes to the
+    daemon's telemetry instead of polling: start_streaming(),
+    get_samples(), add_listener() etc. work as for pid_api.
+
+    Parameters
+    ----------
+    port=None : str or None
+        Address of the daemon as 'host:port'. Anything else, e.g. the
+        serial port name the GUI passes, means _default_address.
+
+    baudrate=None, temperature_limit=None, **kwargs
+        Ignored; the daemon's pid_api has its own settings.
+
+    timeout=3000 : number
+        How long to wait for replies from the daemon (ms).
+    """
+    def __init__(self, port=None, baudrate=None, timeout=3000, temperature_limit=None, **kwargs):
+
+        host, _, number = str(port).rpartition(':')
+        address = (host, int(number)) if len(host) and number.isdigit() else _default_address
+
+        self.timeout    = timeout
+        self.simulation = False # The serial side is the daemon's business
+
+        self._lock     = _threading.Lock()
+        self._n        = 0
+        self._pending  = dict() # request id: [event, result, error]
+
+        # Streaming (see start_streaming())
+        self._stream_samples = _collections.deque()
+        self._listeners      = []
+        self._streaming      = False
+        self.stream_errors   = 0
+        self.missed_ticks    = 0
+
+        self.sock = _socket.create_connection(address, timeout/1000)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, 1)
+        self._thread = _threading.Thread(target=self._read_loop, daemon=True)
+        self._thread.start()
+
+        info = self.call('info')
+        self.port               = info['port']
+        self.daemon_simulation  = info['simulation']
+        self.baudrate           = info['baudrate']
+        self.telemetry_format   = info['telemetry_format']
+        self._temperature_limit = info['temperature_limit']
+        _api._debug('Connected to the daemon for %s at %s:%d.'%((self.port,)+address))
+
+    def __getattr__(self, name):
+        if name not in _methods: raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def call(self, method, *args, **kwargs):
+        """
+        Runs a pid_api method on the daemon and returns its result.
+        """
+        with self._lock:
+            self._n += 1
+            n = self._n
+            waiter = self._pending[n] = [_threading.Event(), None, None]
+            self.sock.sendall(_message(_request, _json.dumps([n, method, _encode(list(args)), _encode(kwargs)]).encode()))
+
+        if not waiter[0].wait(self.timeout/1000):
+            with self._lock: self._pending.pop(n, None)
+            raise Exception('Timed out waiting for the daemon to answer %s.'%method)
+        if waiter[2] is not None: raise Exception('Daemon: '+waiter[2])
+        return waiter[1]
+
+    def _read_loop(self):
+        """
+        Receives replies and telemetry.
+        """
+        while True:
+            try: message = _recv_message(self.sock)
+            except OSError: message = None
+            if message is None:
+                with self._lock: waiters = list(self._pending.values())
+                for waiter in waiters: waiter[2] = 'connection closed.'; waiter[0].set()
+                return
+
+            kind, payload = message
+            if kind == _reply:
+                n, result, error = _json.loads(payload)
+                with self._lock: waiter = self._pending.pop(n, None)
+                if waiter is not None:
+                    waiter[1], waiter[2] = _decode(result), error
+                    waiter[0].set()
+
+            elif kind == _samples and self._streaming:
+                for r in _n.frombuffer(payload, _session.record_dtype).tolist():
+                    sample = _api.sample(*r)
+                    self.missed_ticks += sample.missed
+                    self._stream_samples.append(sample)
+                    for f in list(self._listeners):
+                        try:                   f(sample)
+                        except Exception as e: _api._debug('Listener error', e)
+
+    def disconnect(self):
+        """
+        Disconnects from the daemon (which stays connected to the controller).
+        """
+        self._streaming = False
+        try:    self.sock.shutdown(_socket.SHUT_RDWR)
+        except: pass
+        self.sock.close()
+
+    def transaction(self):
+        """
+        Returns a new, empty pid_daemon_transaction.
+        """
+        return pid_daemon_transaction(self)
+
+    def set_telemetry_format(self, telemetry_format='BINARY'):
+        self.telemetry_format = self.call('set_telemetry_format', telemetry_format)
+        return self.telemetry_format
+
+    def start_streaming(self, rate=20, buffer_size=100000, catch_up=False):
+        """
+        Subscribes to the daemon's telemetry. rate is the rate asked for;
+        the daemon polls at the fastest rate any client asks for (or its
+        own fixed rate), and every client gets every sample.
+        """
+        self._stream_samples = _collections.deque(maxlen=buffer_size)
+        self._streaming      = True
+        self.call('subscribe', rate)
+
+    def stop_streaming(self):
+        """
+        Unsubscribes from the daemon's telemetry.
+        """
+        if not self._streaming: return
+        self._streaming = False
+        self.call('unsubscribe')
+
+    def is_streaming(self):
+        return self._streaming
+
+    def get_samples(self):
+        """
+        Returns (and removes) every sample received since the last call.
+        """
+        samples = []
+        while True:
+            try:               samples.append(self._stream_samples.popleft())
+            except IndexError: return samples
+
+    def add_listener(self, f):
+        if f not in self._listeners: self._listeners.append(f)
+
+    def remove_listener(self, f):
+        if f in self._listeners: self._listeners.remove(f)
+
+
+
+if __name__ == '__main__':
+
+    # e.g. python pid_controller_daemon.py COM3, then pid_controller(api_class=pid_daemon_client)
+    import argparse as _argparse
+
+    parser = _argparse.ArgumentParser(description='Shares one PID temperature controller with several local clients.')
+    parser.add_argument('port', nargs='?', default='Simulation', help="Serial port, or 'Simulation' (default).")
+    parser.add_argument('--baudrate', type=int,   default=115200,                 help='Baud rate (default 115200).')
+    parser.add_argument('--address',  type=str,   default='%s:%d'%_default_address, help='host:port to listen on (default %s:%d).'%_default_address)
+    parser.add_argument('--rate',     type=float, default=None,                   help='Fixed telemetry rate in Hz (default: the fastest any client asks for).')
+    args = parser.parse_args()
+
+    host, _, number = args.address.rpartition(':')
+    daemon = pid_daemon(args.port, args.baudrate, (host, int(number)), args.rate)
+
+    try:
+        while True: _time.sleep(1)
+    except KeyboardInterrupt: pass
+    finally: daemon.close()
@@ -0,0 +1,140 @@
+import os                 as _os
+import json               as _json
+import time               as _time
+import concurrent.futures as _futures
+
+import pid_controller_api as _api
+
+try:    from serial.tools.list_ports import comports as _comports
+except: _comports = None
+
+
+# Where discovery results are remembered between sessions
+_cache_path = _os.path.join(_os.path.expanduser('~'), '.pid_controller_ports.json')
+
+
+def port_key(info):
+    """
+    Returns 'VID:PID:serial number' identifying the USB device behind a
+    port (a serial.tools.list_ports ListPortInfo), or None if it has no
+    serial number to tell it apart from others of the same model.
+    """
+    if info.vid is None or not info.serial_number: return None
+    return '%04X:%04X:%s'%(info.vid, info.pid, info.serial_number)
+
+
+def probe(port, baudrate=115200, timeout=3000):
+    """
+    Opens a port without resetting the device (DTR low) and checks that
+    it answers like a PID controller (see pid_api.handshake()).
+
+    Parameters
+    ----------
+    port : str
+        Name of the port, e.g. 'COM3' or '/dev/ttyACM0'.
+
+    baudrate=115200 : int
+        Baud rate to try.
+
+    timeout=3000 : number
+        Longest time to wait for an answer (ms). Some operating systems
+        reset the arduino anyway when the port is opened, so this should
+        cover its boot time.
+
+    Returns
+    -------
+    bool
+        True if a controller answered.
+    """
+    try:
+        s = _api._serial.Serial(baudrate=baudrate, timeout=timeout/1000)
+        s.port = port
+        s.dtr  = False
+        s.open()
+    except Exception as e:
+        _api._debug('Discovery: could not open '+port, e)
+        return False
+
+    try:     return _api._handshake(s, timeout, reset=False)
+    finally: s.close()
+
+
+def discover(ports=None, baudrate=115200, timeout=3000, cache_path=_cache_path, refresh=False, usb_only=True, callback=None):
+    """
+    Finds the PID controllers among the serial ports. Every port not
+    already in the cache is probed (see probe()) at the same time, so
+    finding many boards takes about as long as one probe. Results are
+    cached by USB VID:PID:serial number, so known devices are reported
+    instantly, whichever port name they get.
+
+    Parameters
+    ----------
+    ports=None : list or None
+        ListPortInfo objects (from serial.tools.list_ports.comports()) to
+        check. None means every port on the system.
+
+    baudrate=115200 : int
+        Baud rate to probe at. Cached results for other rates are ignored.
+
+    timeout=3000 : number
+        Longest time to wait for each port (ms).
+
+    cache_path=~/.pid_controller_ports.json : str or None
+        Cache file. None disables the cache.
+
+    refresh=False : bool
+        If True, probe every port even if it is in the cache.
+
+    usb_only=True : bool
+        If True, skip ports that are not USB devices (e.g. the many
+        /dev/ttyS* legacy ports on Linux).
+
+    callback=None : function or None
+        Called from the calling thread as callback(device, result) as soon as
+        each port's result is known (cached ones first), e.g. to update a
+        port list while the others are still being probed.
+
+    Returns
+    -------
+    dict
+        For each port name, a dictionary with its 'description', cache
+        'key', whether it is a 'controller', and whether the result was
+        'cached'.
+    """
+    if ports is None: ports = _comports() if _comports else []
+    if usb_only:      ports = [p for p in ports if p.vid is not None]
+
+    # Previous results
+    cache = dict()
+    if cache_path is not None and _os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f: cache = _json.load(f)
+        except Exception as e: _api._debug('Discovery: ignoring unreadable cache '+cache_path, e)
+
+    results = dict()
+    pending = []
+    for p in ports:
+        key = port_key(p)
+        c   = cache.get(key)
+        if not refresh and c is not None and c['baudrate'] == baudrate:
+            results[p.device] = dict(description=p.description, key=key, controller=c['controller'], cached=True)
+            if callback: callback(p.device, results[p.device])
+        else: pending.append(p)
+
+    # Probe the rest all at once
+    if len(pending):
+        with _futures.ThreadPoolExecutor(len(pending)) as pool:
+            futures = {pool.submit(probe, p.device, baudrate, timeout): p for p in pending}
+            for future in _futures.as_completed(futures):
+                p   = futures[future]
+                key = port_key(p)
+                results[p.device] = dict(description=p.description, key=key, controller=future.result(), cached=False)
+                if key is not None: cache[key] = dict(controller=future.result(), baudrate=baudrate, device=p.device, time=_time.time())
+                if callback: callback(p.device, results[p.device])
+
+        if cache_path is not None:
+            try:
+                with open(cache_path, 'w') as f: _json.dump(cache, f, indent=1)
+            except Exception as e: _api._debug('Discovery: could not save cache '+cache_path, e)
+
+    return results
@@ -0,0 +1,481 @@
+import os        as _os
+import re        as _re
+import struct    as _struct
+import time      as _time
+import heapq     as _heapq
+import selectors as _selectors
+import threading as _threading
+
+import pid_controller_api        as _api
+import pid_controller_simulation as _simulation
+
+# Emulators live on pseudo-terminals (Linux, macOS).
+try:    import pty as _pty, tty as _tty, termios as _termios
+except: _pty = None
+
+# Reads the actual baud rate of a tty, including non-standard ones (Linux)
+try:    import fcntl as _fcntl
+except: _fcntl = None
+_TCGETS2 = 0x802C542A
+
+
+# Size of received_data[] in the firmware; longer commands are truncated
+_data_size = 64
+
+# Bits on the wire per byte (start bit, 8 data bits, stop bit)
+_bits_per_byte = 10
+
+# history_sample in the firmware
+_history_struct = _struct.Struct('<Ifh')
+
+# BAUD and BAUD_CONFIRM_TIME in the firmware
+_firmware_baud      = 115200
+_baud_confirm_time  = 1000
+
+_float_pattern = _re.compile(r'\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?')
+_int_pattern   = _re.compile(r'\s*[+-]?\d+')
+
+
+def _atof(s):
+    """
+    C atof(): the number at the start of s, or 0. None stands for the NULL
+    strtok() returns when an argument is missing.
+    """
+    m = _float_pattern.match(s or '')
+    return float(m.group()) if m else 0.0
+
+def _atoi(s):
+    """
+    C atoi() into the arduino's 16-bit int.
+    """
+    m = _int_pattern.match(s or '')
+    x = int(m.group()) if m else 0
+    return (x + 2**15) % 2**16 - 2**15
+
+def _atol(s):
+    """
+    C atol() into the arduino's 32-bit long.
+    """
+    m = _int_pattern.match(s or '')
+    x = int(m.group()) if m else 0
+    return (x + 2**31) % 2**32 - 2**31
+
+def _print_float(x, digits=2):
+    """
+    Serial.print(x, digits).
+    """
+    if x != x:                return 'nan'
+    if abs(x) == float('inf'): return 'inf' if x > 0 else '-inf'
+    if abs(x) > 4294967040:   return 'ovf'
+    return '%.*f'%(digits, x)
+
+
+
+class _emulator_hub():
+    """
+    One thread serving the pseudo-terminals of every firmware_emulator: it
+    waits on all of them with a selector, feeds incoming bytes to their
+    emulator, and sends replies when they are due (see
+    firmware_emulator.baudrate).
+    """
+    def __init__(self):
+        self._selector = _selectors.DefaultSelector()
+        self._lock     = _threading.Lock()
+        self._due      = [] # Heap of (time, sequence number, emulator, reply)
+        self._sequence = 0
+
+        # Pipe to wake the selector when something changes
+        self._wake_r, self._wake_w = _os.pipe()
+        self._selector.register(self._wake_r, _selectors.EVENT_READ)
+
+        self._thread = _threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _wake(self):
+        _os.write(self._wake_w, b'\0')
+
+    def add(self, emulator):
+        with self._lock: self._selector.register(emulator._master, _selectors.EVENT_READ, emulator)
+        self._wake()
+
+    def remove(self, emulator):
+        with self._lock:
+            try:             self._selector.unregister(emulator._master)
+            except KeyError: pass
+            self._due = [x for x in self._due if x[2] is not emulator]
+            _heapq.heapify(self._due)
+        self._wake()
+
+    def send(self, emulator, reply, due=None):
+        """
+        Queues a reply to go out at monotonic time due (None means now).
+        """
+        if due is None: return self._write(emulator, reply)
+        with self._lock:
+            self._sequence += 1
+            _heapq.heappush(self._due, (due, self._sequence, emulator, reply))
+        self._wake()
+
+    def _write(self, emulator, data):
+        """
+        Writes to an emulator's pty without ever blocking the hub; whatever
+        does not fit waits in the emulator until the pty is writable.
+        """
+        if emulator._closed: return
+        emulator._out += data
+        try:    n = _os.write(emulator._master, emulator._out)
+        except (BlockingIOError, InterruptedError): n = 0
+        except OSError: return
+        emulator._out = emulator._out[n:]
+
+        with self._lock:
+            events = _selectors.EVENT_READ | (_selectors.EVENT_WRITE if len(emulator._out) else 0)
+            try:             self._selector.modify(emulator._master, events, emulator)
+            except KeyError: pass
+
+    def _run(self):
+        while True:
+
+            # Send the replies that are due, then wait for the next one at most
+            now = _time.monotonic()
+            due = []
+            with self._lock:
+                while len(self._due) and self._due[0][0] <= now: due.append(_heapq.heappop(self._due))
+                timeout = self._due[0][0]-now if len(self._due) else None
+            for t, n, emulator, reply in due: self._write(emulator, reply)
+
+            for key, events in self._selector.select(timeout):
+
+                if key.fileobj == self._wake_r:
+                    _os.read(self._wake_r, 4096)
+                    continue
+
+                emulator = key.data
+                if events & _selectors.EVENT_WRITE: self._write(emulator, b'')
+                if events & _selectors.EVENT_READ:
+                    try:    data = _os.read(emulator._master, 4096)
+                    except (BlockingIOError, InterruptedError): continue
+                    except OSError: data = b''
+                    if len(data): emulator._receive(data, _time.monotonic())
+                    else:         self.remove(emulator)
+
+_hub      = None
+_hub_lock = _threading.Lock()
+
+def _get_hub():
+    global _hub
+    with _hub_lock:
+        if _hub is None: _hub = _emulator_hub()
+        return _hub
+
+
+
+class firmware_emulator():
+    """
+    Python copy of the arduino firmware on a local pseudo-terminal, so the
+    unmodified serial path of pid_api (or anything else) can be exercised
+    without a board:
+
+        emulator = firmware_emulator()
+        api      = pid_api(emulator.port, 115200, reset=False)
+
+    The bytes are handled like the firmware does: receive_data()'s '<'/'>'
+    framing, including truncation of commands at 63 characters,
+    begin_command()'s sequence tags, every command of parseData() with its
+    replies, formats and quirks (strtok(), atoi()/atof(), the OPEN_LOOP
+    rule of set_dac, binary frames), and end_command()'s acknowledgements.
+    The temperature, the RTD read cycle and the timer-driven control() run
+    in a pid_controller_simulation.pid_simulator.
+
+    Commands are answered as soon as they arrive (or after the emulated
+    line and reply delays), rather than between RTD reads as on the
+    arduino.
+
+    A pty has no DTR line, so opening the port does not restart the 
+    emulator: connect with reset=False, and call reset() to start over.
+
+    Any number of emulators can run at once, e.g. for load testing a
+    fleet; they all share one selector thread.
+
+    Parameters
+    ----------
+    speed=1 : float
+        Simulated seconds per wall-clock second (see pid_simulator).
+
+    plant=None : thermal_plant or None
+        Plant to simulate. None means the default thermal_plant.
+
+    baudrate=None : int or None
+        Baud rate to emulate: replies are held back as long as the command
+        and reply would take on a real serial line. None means full speed.
+
+    reply_delay=0 : number
+        Extra time taken to process each command (ms), e.g. to mimic the
+        main loop being busy reading the RTD.
+
+    banner=True : bool
+        Whether to print READY at the end of setup(), like the firmware.
+        Opening the port discards it if it is already waiting.
+
+    baud=None : int or None
+        Baud rate the emulated firmware starts at (BAUD), changed with the
+        set_baud command. If set, what the host sends with its port at 
+        another rate is lost, as if garbled on a real line (where the host
+        rate can be read, e.g. Linux). None accepts any host rate.
+
+    Attributes
+    ----------
+    port : str
+        Name of the device to open, e.g. '/dev/pts/3'.
+
+    simulator : pid_simulator
+        The simulated arduino state and plant.
+
+    commands : int
+        Number of commands processed.
+    """
+    def __init__(self, speed=1, plant=None, baudrate=None, reply_delay=0, banner=True, baud=None):
+
+        if _pty is None: raise Exception('The firmware emulator needs pseudo-terminals, which this system does not have.')
+
+        self.speed       = speed
+        self.plant       = plant
+        self.baudrate    = baudrate
+        self.reply_delay = reply_delay
+        self.banner      = banner
+        self.commands    = 0
+        self._check_baud = baud is not None
+        self._boot_baud  = baud or _firmware_baud
+
+        self._master, self._slave = _pty.openpty()
+        _tty.setraw(self._master)
+        _tty.setraw(self._slave)
+        _os.set_blocking(self._master, False)
+        self.port = _os.ttyname(self._slave)
+
+        self._out    = b''
+        self._closed = False
+        self._hub    = _get_hub()
+        self._lock   = _threading.Lock()
+
+        self.reset()
+        self._hub.add(self)
+
+    def reset(self):
+        """
+        Restarts the firmware: setup() with a fresh simulator, as after the
+        auto-reset of opening the port.
+        """
+        with self._lock:
+
+            # receive_data() state
+            self._recv_in_progress = False
+            self._received         = bytearray()
+
+            # Emulated line: when it finishes receiving / sending what it has
+            self._rx_done = self._tx_done = 0
+
+            self.simulator = _simulation.pid_simulator(plant=self.plant, speed=self.speed)
+            self.binary_telemetry = False
+
+            # Baud rate in use, and the one to go back to if it is not confirmed
+            self.baud           = self._boot_baud
+            self._baud_previous = None
+            self._baud_time     = 0
+
+        if self.banner: self._hub.send(self, b'READY\r\n', _time.monotonic())
+
+    def close(self):
+        """
+        Closes the pseudo-terminal.
+        """
+        if self._closed: return
+        self._hub.remove(self)
+        self._closed = True
+        _os.close(self._slave)
+        _os.close(self._master)
+
+    def _set_baud(self, baud):
+        """
+        set_baud(). With an emulated line, replies follow the new rate.
+        """
+        self.baud = baud
+        if self.baudrate: self.baudrate = baud
+
+    def _wire_time(self, size):
+        return 0 if not self.baudrate else size*_bits_per_byte/self.baudrate
+
+    def _send(self, reply, ready):
+        """
+        Sends a reply, after the line has finished sending the previous one.
+        ready is when the reply is ready to go (monotonic s).
+        """
+        if not self.baudrate and not self.reply_delay: return self._hub.send(self, reply)
+
+        self._tx_done = max(self._tx_done, ready) + self._wire_time(len(reply))
+        self._hub.send(self, reply, self._tx_done)
+
+    def _host_baud(self):
+        """
+        Baud rate the host set on its end of the pty, or None if unknown.
+        """
+        if _fcntl is not None:
+            try:    return _struct.unpack('4I 20B 2I', _fcntl.ioctl(self._master, _TCGETS2, bytes(44)))[-1]
+            except: pass
+
+        speed = _termios.tcgetattr(self._master)[5]
+        for name in dir(_termios):
+            if name.startswith('B') and name[1:].isdigit() and getattr(_termios, name) == speed: return int(name[1:])
+        return None
+
+    def _receive(self, data, arrival):
+        """
+        receive_data(): collects the characters between '<' and '>', and
+        runs every complete command.
+        """
+        with self._lock:
+
+            # loop(): go back to the old baud rate if the new one was never confirmed
+            if self._baud_previous is not None and arrival - self._baud_time > _baud_confirm_time/1000:
+                self._set_baud(self._baud_previous)
+                self._baud_previous = None
+
+            # Bytes sent at the wrong rate never make it
+            if self._check_baud and self._host_baud() not in [None, self.baud]: return
+
+            for c in data:
+
+                if self._recv_in_progress:
+                    if c != ord('>'):
+                        # Once received_data[] is full, further characters
+                        # land in the slot the terminator overwrites
+                        if len(self._received) < _data_size-1: self._received.append(c)
+                    else:
+                        self._recv_in_progress = False
+                        self._rx_done = max(self._rx_done, arrival) + self._wire_time(len(self._received)+2)
+                        self._command(self._received.decode('latin-1'), self._rx_done + self.reply_delay/1000)
+                        self._received = bytearray()
+
+                elif c == ord('<'): self._recv_in_progress = True
+
+    def _command(self, temp_data, ready):
+        """
+        begin_command(), parseData() and end_command() for one command.
+        """
+        self.commands += 1
+        self.simulator.update()
+        self._baud_previous = None # A command got through at the current rate
+
+        # begin_command(): strip the sequence tag
+        tag = None
+        if temp_data.startswith('#') and ';' in temp_data:
+            tag       = _atoi(temp_data[1:])
+            temp_data = temp_data[temp_data.index(';')+1:]
+
+        reply = self._parse(temp_data)
+
+        # begin_reply() / end_command()
+        if tag is not None and tag >= 0: reply = b'#%d;'%tag + (reply if reply is not None else b'\r\n')
+        if reply is not None: self._send(reply, ready)
+
+    def _parse(self, temp_data):
+        """
+        parseData(). Returns the reply, or None if there is none.
+        """
+        s = self.simulator
+
+        # strtok() skips empty fields; missing ones are NULL (None)
+        tokens   = [x for x in temp_data.split(',') if len(x)] + [None]*4
+        function = tokens[0] or ''
+        argument = tokens[1]
+
+        def line(text): return text.encode() + b'\r\n'
+
+        if function == 'set_parameters':
+            s.set_parameters(_atof(tokens[1]), _atof(tokens[2]), _atof(tokens[3]))
+
+        if function == 'set_dac':
+            if s.get_mode() == 'OPEN_LOOP':
+                s.set_dac(_atoi(argument))
+                return None
+            return line('Arduino must be in OPEN_LOOP mode in order to directly manipulate the dac output.')
+
+        if function == 'set_mode':
+            if   argument == 'OPEN_LOOP':   s.set_mode('OPEN_LOOP')
+            elif argument == 'CLOSED_LOOP': s.set_mode('CLOSED_LOOP')
+            else: return line('Invaild Mode.')
+
+        if function == 'set_period':   s.set_period(_atoi(argument) % 2**16)
+        if function == 'set_setpoint': s.set_setpoint(_atof(argument))
+
+        if function == 'get_dac':         return line('%d'%s.get_dac())
+        if function == 'get_mode':        return line(s.get_mode())
+        if function == 'get_temperature': return line(_print_float(s.get_temperature(), 2))
+        if function == 'get_setpoint':    return line(_print_float(s.get_setpoint(), 4))
+        if function == 'get_period':      return line('%d'%s.get_period())
+        if function == 'get_parameters':
+            band, t_i, t_d = s.get_parameters()
+            return line(','.join(_print_float(x, 4) for x in [band, t_i, t_d]))
+
+        if function == 'set_baud':
+            baud = _atol(argument)
+            if baud <= 0: return line('%d'%self.baud)
+
+            # Confirm at the old rate, then switch
+            self._baud_previous = self.baud
+            self._baud_time     = _time.monotonic()
+            self._set_baud(baud)
+            return line('%d'%baud)
+
+        if function == 'get_history':
+            first, readings = s.get_history(_atol(argument) % 2**32)
+
+            if self.binary_telemetry:
+                payload = _struct.pack('<I', first) + b''.join(_history_struct.pack(t % 2**32, T, dac) for t, T, dac in readings)
+                header  = bytes([len(payload)])
+                return bytes([_api._frame_start]) + header + payload + bytes([_api._crc8(header+payload)])
+
+            return line(';'.join(['%d'%first] + ['%d,%s,%d'%(t % 2**32, _print_float(T, 2), dac) for t, T, dac in readings]))
+
+        if function == 'set_format':
+            if   argument == 'BINARY': self.binary_telemetry = True
+            elif argument == 'ASCII':  self.binary_telemetry = False
+            return line('BINARY' if self.binary_telemetry else 'ASCII')
+
+        if function == 'get_all_variables':
+            T, setpoint, dac, band, t_i, t_d, period, time_recent = s.get_all_variables()
+
+            if self.binary_telemetry:
+                payload = _api._telemetry_struct.pack(T, setpoint, dac, band, t_i, t_d, period, time_recent % 2**32)
+                header  = bytes([len(payload)])
+                return bytes([_api._frame_start]) + header + payload + bytes([_api._crc8(header+payload)])
+
+            return line(','.join([_print_float(T, 2), _print_float(setpoint, 4), '%d'%dac, _print_float(band, 4),
+                                  _print_float(t_i, 4), _print_float(t_d, 4), '%d'%period, '%d'%(time_recent % 2**32)]))
+
+        return None
+
+
+
+if __name__ == '__main__':
+
+    # e.g. python pid_controller_emulator.py -n 8, then connect to the printed ports
+    import argparse as _argparse
+
+    parser = _argparse.ArgumentParser(description='Runs Python copies of the PID controller firmware on pseudo-terminals.')
+    parser.add_argument('-n',            type=int,   default=1,    help='Number of emulated boards (default 1).')
+    parser.add_argument('--speed',       type=float, default=1,    help='Simulated seconds per second (default 1).')
+    parser.add_argument('--baudrate',    type=int,   default=None, help='Baud rate to emulate (default: full speed).')
+    parser.add_argument('--reply-delay', type=float, default=0,    help='Processing time per command in ms (default 0).')
+    args = parser.parse_args()
+
+    emulators = [firmware_emulator(args.speed, baudrate=args.baudrate, reply_delay=args.reply_delay) for n in range(args.n)]
+    for e in emulators: print(e.port, flush=True)
+
+    try:
+        while True:
+            _time.sleep(10)
+            print('Commands processed:', sum(e.commands for e in emulators), flush=True)
+    except KeyboardInterrupt: pass
+    finally:
+        for e in emulators: e.close()
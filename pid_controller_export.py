@@ -0,0 +1,310 @@
+import os    as _os
+import json  as _json
+import numpy as _n
+
+import pid_controller_api     as _api
+import pid_controller_logger  as _logger
+import pid_controller_session as _session
+
+# Optional columnar formats
+try:    import pyarrow as _pa, pyarrow.parquet as _pq
+except: _pa = _pq = None
+
+try:    import h5py as _h5py
+except: _h5py = None
+
+
+# Columns of exported sessions
+export_dtype = _n.dtype([
+    ('time',        '<f8'), # Host time.time() of the measurement
+    ('temperature', '<f4'),
+    ('setpoint',    '<f4'),
+    ('error',       '<f4'), # temperature - setpoint
+    ('dac',         '<f4'),
+    ('band',        '<f4'),
+    ('t_i',         '<f4'),
+    ('t_d',         '<f4'),
+    ('period',      '<f4')])
+
+
+def to_columns(records):
+    """
+    Converts session records (see pid_controller_session.record_dtype, or
+    to_records() for a list of samples) into an array of export_dtype.
+    """
+    columns = _n.empty(len(records), export_dtype)
+    for name in export_dtype.names:
+        if name != 'error': columns[name] = records[name]
+    columns['error'] = columns['temperature'] - columns['setpoint']
+    return columns
+
+
+
+class parquet_writer():
+    """
+    Writes a session to a Parquet file (needs pyarrow), one compressed row
+    group at a time. Rows are collected until there are row_group_size of
+    them, or until flush() or close(), so the row groups stay large enough
+    to read quickly if flushes are rare.
+
+    Like any Parquet file, it can only be read once closed: the footer 
+    describing the row groups is written last, so a file left by a crash
+    cannot be read, even though flushed row groups are on disk. Log to
+    binary session files (.pidbin) when a log must survive a crash.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file to create.
+
+    metadata=None : dict or None
+        Stored (as JSON) in the file's key-value metadata, e.g. port,
+        baudrate and mode (see load_metadata()).
+
+    row_group_size=100000 : int
+        Rows per row group.
+
+    compression='zstd' : str
+        Parquet compression codec.
+    """
+    def __init__(self, path, metadata=None, row_group_size=100000, compression='zstd'):
+        if _pq is None: raise Exception('Writing Parquet files needs pyarrow.')
+
+        self.path           = path
+        self.row_group_size = row_group_size
+        self.file           = open(path, 'wb')
+
+        self._schema = _pa.schema([(name, _pa.from_numpy_dtype(export_dtype[name])) for name in export_dtype.names],
+                                  metadata={k: _json.dumps(v) for k, v in (metadata or dict()).items()})
+        self._writer = _pq.ParquetWriter(self.file, self._schema, compression=compression)
+        self._chunks = []
+        self._rows   = 0
+
+    def write(self, rows):
+        """
+        Appends samples (see pid_controller_session.to_records()).
+        """
+        self.write_records(_session.to_records(rows))
+
+    def write_records(self, records):
+        """
+        Appends session records (see to_columns()).
+        """
+        self._chunks.append(to_columns(records))
+        self._rows += len(records)
+        if self._rows >= self.row_group_size: self._write_row_group()
+
+    def _write_row_group(self):
+        """
+        Writes the collected rows as one row group.
+        """
+        if not self._rows: return
+        columns = _n.concatenate(self._chunks)
+        self._writer.write_table(_pa.Table.from_arrays([columns[name] for name in export_dtype.names], schema=self._schema),
+                                 row_group_size=len(columns))
+        self._chunks = []
+        self._rows   = 0
+
+    def flush(self):
+        """
+        Writes the collected rows as a row group, then flushes the file.
+        """
+        self._write_row_group()
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self._write_row_group()
+        self._writer.close()
+        self.file.close()
+
+
+
+class hdf5_writer():
+    """
+    Writes a session to an HDF5 file (needs h5py), one chunked, compressed,
+    resizable dataset per column. Every write appends to the datasets, so
+    the file can be read while it grows (after a flush()).
+
+    Parameters
+    ----------
+    path : str
+        Path of the file to create.
+
+    metadata=None : dict or None
+        Stored as attributes of the file, e.g. port, baudrate and mode
+        (see load_metadata()).
+
+    chunk_rows=65536 : int
+        Rows per HDF5 chunk.
+
+    compression='gzip' : str
+        HDF5 compression filter.
+    """
+    def __init__(self, path, metadata=None, chunk_rows=65536, compression='gzip'):
+        if _h5py is None: raise Exception('Writing HDF5 files needs h5py.')
+
+        self.path = path
+        self.file = _h5py.File(path, 'w')
+        for name in export_dtype.names:
+            self.file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=export_dtype[name],
+                                     chunks=(chunk_rows,), compression=compression, shuffle=True)
+        for k, v in (metadata or dict()).items(): self.file.attrs[k] = v
+
+    def write(self, rows):
+        """
+        Appends samples (see pid_controller_session.to_records()).
+        """
+        self.write_records(_session.to_records(rows))
+
+    def write_records(self, records):
+        """
+        Appends session records (see to_columns()).
+        """
+        columns = to_columns(records)
+        n       = len(columns)
+        for name in export_dtype.names:
+            dataset = self.file[name]
+            dataset.resize((len(dataset)+n,))
+            dataset[-n:] = columns[name]
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.id.get_vfd_handle()
+
+    def tell(self):
+        return _os.path.getsize(self.path)
+
+    def close(self):
+        self.file.close()
+
+
+# Writer for each file extension
+_writers = {'.parquet': parquet_writer, '.h5': hdf5_writer, '.hdf5': hdf5_writer}
+
+
+
+class columnar_session_logger(_logger.session_logger):
+    """
+    session_logger writing the columns of export_dtype to Parquet or HDF5
+    files (see parquet_writer and hdf5_writer) instead of CSV, appending a
+    chunk at every flush.
+
+    Each flush makes a Parquet row group, so a longer flush_interval
+    (e.g. 60 s) gives files that read faster. Parquet files only become
+    readable when closed (at rotation or close()), and one open when the
+    program crashes is lost. HDF5 files get every flushed chunk, though
+    a crash during a write can still damage one.
+
+    Parameters
+    ----------
+    path : str
+        Path of the log files, without the index and extension.
+
+    extension='.parquet' : str
+        File format: '.parquet', '.h5' or '.hdf5'.
+
+    metadata=None : dict or None
+        Stored in every file, e.g. dict(port='COM3', baudrate=115200,
+        mode='CLOSED_LOOP').
+
+    **kwargs
+        Sent to session_logger, e.g. rotate_bytes or flush_interval.
+    """
+    def __init__(self, path, extension='.parquet', metadata=None, **kwargs):
+        if extension not in _writers: raise Exception('Unknown export format %s.'%extension)
+
+        self._extension = extension
+        self.metadata   = metadata
+
+        # Fail now rather than in the writer thread if the library is missing
+        if   extension == '.parquet' and _pq   is None: raise Exception('Writing Parquet files needs pyarrow.')
+        elif extension != '.parquet' and _h5py is None: raise Exception('Writing HDF5 files needs h5py.')
+
+        _logger.session_logger.__init__(self, path, **kwargs)
+
+    def _open_file(self, path):
+        self._file = _writers[self._extension](path, self.metadata)
+
+    def _write_rows(self, rows):
+        self._file.write(rows)
+
+    def _file_bytes(self):
+        return self._file.tell()
+
+    def _close_file(self):
+        self._file.close()
+        self._file = None
+
+
+
+def export_session(source, path, metadata=None, chunk_rows=1000000):
+    """
+    Converts a binary session file (.pidbin) to Parquet or HDF5, chosen by
+    the extension of path, a chunk of records at a time.
+
+    Parameters
+    ----------
+    source : str
+        Binary session file to read.
+
+    path : str
+        File to write (.parquet, .h5 or .hdf5).
+
+    metadata=None : dict or None
+        Stored in the file. The start time and the PID parameters from
+        the header of source are always added.
+
+    chunk_rows=1000000 : int
+        Records converted at once.
+    """
+    extension = _os.path.splitext(path)[1]
+    if extension not in _writers: raise Exception('Unknown export format %s.'%extension)
+
+    reader   = _session.session_reader(source)
+    metadata = dict(dict(start_time=reader.start_time, band=reader.band, t_i=reader.t_i, t_d=reader.t_d, period=reader.period), **(metadata or dict()))
+
+    writer = _writers[extension](path, metadata)
+    try:
+        for n in range(0, len(reader), chunk_rows): writer.write_records(reader.records[n:n+chunk_rows])
+    finally: writer.close()
+    _api._debug('Exported %d records to %s.'%(len(reader), path))
+
+
+def load_column(path, name):
+    """
+    Reads one column (see export_dtype) of a Parquet, HDF5 or binary
+    session file, without reading the others.
+    """
+    extension = _os.path.splitext(path)[1]
+
+    if extension == '.parquet':
+        if _pq is None: raise Exception('Reading Parquet files needs pyarrow.')
+        return _pq.read_table(path, columns=[name]).column(0).to_numpy()
+
+    if extension in ['.h5', '.hdf5']:
+        if _h5py is None: raise Exception('Reading HDF5 files needs h5py.')
+        with _h5py.File(path, 'r') as f: return f[name][:]
+
+    r = _session.session_reader(path)
+    if name == 'error': return r['temperature'] - r['setpoint']
+    return _n.array(r[name])
+
+
+def load_metadata(path):
+    """
+    Returns the metadata stored in a Parquet or HDF5 session file.
+    """
+    if _os.path.splitext(path)[1] == '.parquet':
+        if _pq is None: raise Exception('Reading Parquet files needs pyarrow.')
+        return {k.decode(): _json.loads(v) for k, v in (_pq.read_schema(path).metadata or dict()).items() if not k.startswith(b'ARROW')}
+
+    if _h5py is None: raise Exception('Reading HDF5 files needs h5py.')
+    with _h5py.File(path, 'r') as f: return {k: (v.item() if hasattr(v, 'item') else v) for k, v in f.attrs.items()}
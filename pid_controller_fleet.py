@@ -0,0 +1,211 @@
+import numpy              as _n
+import time               as _time
+import threading          as _threading
+import collections        as _collections
+import concurrent.futures as _futures
+
+import pid_controller_api as _api
+
+
+class pid_fleet():
+    """
+    Headless manager for a rack of controllers. Opens one api per port and
+    polls them all on a common, fixed schedule. Every board has its own
+    worker thread, so a slow or unresponsive board only costs its own
+    samples: if its previous poll has not returned by the next tick, that
+    tick is recorded as missed for that board and the others carry on.
+
+    Samples are merged into one time-aligned dataset by tick number (see
+    get_dataset()), and per-board poll statistics are available from
+    get_stats().
+
+    Parameters
+    ----------
+    ports : list
+        Names of the ports to connect to.
+
+    rate=10 : float
+        Polling rate (Hz).
+
+    api_class=pid_api : class
+        Class used to talk to each board.
+
+    **kwargs
+        Sent to api_class along with each port, e.g. baudrate or timeout.
+    """
+    def __init__(self, ports, rate=10, api_class=_api.pid_api, **kwargs):
+
+        self.rate       = rate
+        self._api_class = api_class
+        self._kwargs    = kwargs
+        self._lock      = _threading.Lock()
+
+        self.ports    = []
+        self.apis     = []
+        self._workers = []
+        self._busy    = [] # Tick each board is still busy with, or None
+        self._stats   = []
+        self._samples = _collections.deque() # (tick, board index, sample)
+
+        self._thread  = None
+        self._stop    = _threading.Event()
+        self._tick    = 0
+        self._t0      = None
+
+        # Connect in parallel; each api waits for its arduino to boot.
+        with _futures.ThreadPoolExecutor(max(1, len(ports))) as pool:
+            apis = list(pool.map(lambda port: api_class(port=port, **kwargs), ports))
+        for port, api in zip(ports, apis): self._add(port, api)
+
+    def _add(self, port, api):
+        """
+        Registers a connected api and gives it its own worker.
+        """
+        with self._lock:
+            self.ports   .append(port)
+            self.apis    .append(api)
+            self._workers.append(_futures.ThreadPoolExecutor(1))
+            self._busy   .append(None)
+            self._stats  .append(dict(polls=0, missed=0, errors=0, latency=_collections.deque(maxlen=1000)))
+
+    def add(self, port):
+        """
+        Connects to another board. Polling of the others is not interrupted.
+        """
+        self._add(port, self._api_class(port=port, **self._kwargs))
+
+    def start(self):
+        """
+        Starts polling every board.
+        """
+        if self._thread is not None: return
+
+        self._stop.clear()
+        self._thread = _threading.Thread(target=self._schedule, daemon=True)
+        self._thread.start()
+        _api._debug('Fleet polling %d boards at %g Hz.'%(len(self.apis), self.rate))
+
+    def stop(self):
+        """
+        Stops polling, waiting for polls in progress to finish.
+        """
+        if self._thread is None: return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        for w in self._workers: w.submit(lambda: None).result()
+
+    def disconnect(self):
+        """
+        Stops polling and disconnects every board.
+        """
+        self.stop()
+        for w in self._workers: w.shutdown()
+        for a in self.apis:     a.disconnect()
+
+    def _schedule(self):
+        """
+        Body of the scheduler thread: hands one poll per tick to each idle board.
+        """
+        if self._t0 is None: self._t0 = _time.time() - self._tick/self.rate
+        next_time = _time.monotonic()
+
+        while not self._stop.is_set():
+
+            with self._lock:
+                for n in range(len(self.apis)):
+                    if self._busy[n] is None:
+                        self._busy[n] = self._tick
+                        self._workers[n].submit(self._poll, n, self._tick)
+                    else:
+                        self._stats[n]['missed'] += 1
+                self._tick += 1
+
+            next_time += 1.0/self.rate
+            now = _time.monotonic()
+            if next_time < now:
+                skipped    = int((now-next_time)*self.rate)
+                next_time += skipped/self.rate
+                with self._lock:
+                    for s in self._stats: s['missed'] += skipped
+                    self._tick += skipped
+            self._stop.wait(next_time - _time.monotonic())
+
+    def _poll(self, n, tick):
+        """
+        Runs on board n's worker: one get_all_variables() for the supplied tick.
+        """
+        t = _time.perf_counter()
+        try:
+            values = self.apis[n].get_all_variables()
+            x      = self.apis[n].make_sample(values)
+        except Exception as e:
+            x = None
+            _api._debug('Fleet: %s poll failed:'%self.ports[n], e)
+        latency = _time.perf_counter()-t
+
+        with self._lock:
+            s = self._stats[n]
+            s['polls'] += 1
+            s['latency'].append(latency)
+            if x is None: s['errors'] += 1
+            else:         self._samples.append((tick, n, x))
+            self._busy[n] = None
+
+    def get_dataset(self):
+        """
+        Removes and returns the samples of every tick that all boards are
+        done with, aligned on a common time axis.
+
+        Returns
+        -------
+        dict
+            'time' holds the scheduled time of each tick (time.time()
+            units) and 'tick' its number. Each port holds an array of
+            shape (ticks, 10) with the columns of pid_controller_api.sample
+            (time, temperature, setpoint, dac, band, t_i, t_d, period,
+            device_time, missed), where time is the host time.time() of
+            the measurement, mapped from device_time with the board's
+            clock; ticks a board missed are NaN.
+        """
+        with self._lock:
+
+            # Ticks up to (not including) the oldest one still being polled
+            busy = [b for b in self._busy if b is not None]
+            done = min(busy) if len(busy) else self._tick
+
+            # Samples from later ticks that finished early wait for the next call
+            samples       = [x for x in self._samples if x[0] <  done]
+            self._samples = _collections.deque([x for x in self._samples if x[0] >= done])
+            ports         = list(self.ports)
+
+        if not len(samples):
+            data = dict(time=_n.zeros(0), tick=_n.zeros(0, dtype=int))
+            for p in ports: data[p] = _n.zeros((0, len(_api.sample._fields)))
+            return data
+
+        ticks = _n.array([x[0] for x in samples])
+        first = ticks.min()
+        tick  = _n.arange(first, ticks.max()+1)
+
+        data = dict(time=self._t0 + tick/self.rate, tick=tick)
+        for p in ports: data[p] = _n.full((len(tick), len(_api.sample._fields)), _n.nan)
+        for t, n, x in samples: data[ports[n]][t-first] = x
+        return data
+
+    def get_stats(self):
+        """
+        Returns a dictionary of per-port poll statistics: number of polls,
+        missed ticks, errors, and the mean, median, 99th percentile and
+        maximum poll latency (s) over the last 1000 polls.
+        """
+        stats = dict()
+        with self._lock:
+            for port, s in zip(self.ports, self._stats):
+                latency = _n.array(s['latency'])
+                stats[port] = dict(polls=s['polls'], missed=s['missed'], errors=s['errors'])
+                if len(latency):
+                    stats[port].update(latency_mean=latency.mean(), latency_p50=_n.percentile(latency, 50),
+                                       latency_p99=_n.percentile(latency, 99), latency_max=latency.max())
+        return stats
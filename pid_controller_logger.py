@@ -0,0 +1,131 @@
+import os          as _os
+import time        as _time
+import queue       as _queue
+import threading   as _threading
+
+import pid_controller_api as _api
+
+
+class session_logger():
+    """
+    Streams samples to disk as they are acquired. log() only puts the
+    sample in a queue, so it never waits on the disk; a background thread
+    writes whatever has accumulated every flush_interval, then flushes and
+    fsyncs the file, so a crash loses at most one flush interval.
+
+    Files are rotated by size and/or age and named path_0000.csv,
+    path_0001.csv, ..., each with its own header line.
+
+    Add the logger to a pid_api with api.add_listener(logger.log) to log
+    every streamed sample.
+
+    Parameters
+    ----------
+    path : str
+        Path of the log files, without the index and extension.
+
+    columns=pid_controller_api.sample._fields : list
+        Names of the values in each sample.
+
+    rotate_bytes=100e6 : float or None
+        Start a new file once the current one is this big (bytes).
+
+    rotate_seconds=None : float or None
+        Start a new file once the current one is this old (s).
+
+    flush_interval=1.0 : float
+        Time between writes to disk (s).
+
+    queue_size=100000 : int
+        Most samples waiting to be written. If the disk falls this far
+        behind, new samples are dropped (and counted in self.dropped)
+        rather than stalling acquisition.
+    """
+    def __init__(self, path, columns=_api.sample._fields, rotate_bytes=100e6, rotate_seconds=None, flush_interval=1.0, queue_size=100000):
+
+        self.path           = path
+        self.columns        = list(columns)
+        self.rotate_bytes   = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.flush_interval = flush_interval
+
+        self.dropped = 0  # Samples lost because the queue was full
+        self.written = 0  # Samples written so far
+        self.files   = [] # Paths of every file written so far
+
+        self._queue  = _queue.Queue(queue_size)
+        self._file   = None
+        self._stop   = _threading.Event()
+        self._thread = _threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def log(self, x):
+        """
+        Queues one sample (a sequence with one value per column) for writing.
+        Never blocks.
+        """
+        try:               self._queue.put_nowait(x)
+        except _queue.Full: self.dropped += 1
+
+    def close(self):
+        """
+        Writes everything still queued and closes the current file.
+        """
+        self._stop.set()
+        self._thread.join()
+
+    def _write_loop(self):
+        """
+        Body of the writer thread.
+        """
+        while not self._stop.is_set():
+            self._stop.wait(self.flush_interval)
+            self._write_queued()
+
+        if self._file is not None: self._close_file()
+
+    def _write_queued(self):
+        """
+        Writes every queued sample, then flushes and syncs the file.
+        """
+        rows = []
+        while True:
+            try:                 rows.append(self._queue.get_nowait())
+            except _queue.Empty: break
+        if not len(rows): return
+
+        # Start a new file if the current one is too big or too old
+        if self._file is not None:
+            if (self.rotate_bytes   is not None and self._file_bytes()                  >= self.rotate_bytes) or \
+               (self.rotate_seconds is not None and _time.time()-self._file_opened >= self.rotate_seconds):
+                self._close_file()
+
+        if self._file is None:
+            path = self.path+'_%04d'%len(self.files)+self._extension
+            self._open_file(path)
+            self._file_opened = _time.time()
+            self.files.append(path)
+            _api._debug('Logging to '+path)
+
+        self._write_rows(rows)
+        self.written += len(rows)
+
+        self._file.flush()
+        _os.fsync(self._file.fileno())
+
+    # File format. Override these (and _extension) to write something else.
+    _extension = '.csv'
+
+    def _open_file(self, path):
+        self._file = open(path, 'w', buffering=1<<16)
+        self._file.write(','.join(self.columns)+'\n')
+
+    def _write_rows(self, rows):
+        self._file.write(''.join(','.join(repr(float(v)) for v in x)+'\n' for x in rows))
+
+    def _file_bytes(self):
+        return self._file.tell()
+
+    def _close_file(self):
+        self._file.close()
+        self._file = None
@@ -0,0 +1,171 @@
+import os     as _os
+import numpy  as _n
+import struct as _struct
+
+import pid_controller_logger as _logger
+
+
+# Binary session files: a 64-byte header followed by fixed-size records,
+# one per sample, all little-endian.
+_magic         = b'PIDSESS\0'
+_version       = 2
+_header_size   = 64
+_header_struct = _struct.Struct('<8sHHIdffff') # magic, version, header size, record size, start time, band, t_i, t_d, period
+
+record_dtype = _n.dtype([
+    ('time',        '<f8'), # Host time.time() of the measurement
+    ('temperature', '<f4'),
+    ('setpoint',    '<f4'),
+    ('dac',         '<f4'),
+    ('band',        '<f4'),
+    ('t_i',         '<f4'),
+    ('t_d',         '<f4'),
+    ('period',      '<f4'),
+    ('device_time', '<f8'), # Arduino millis() of the measurement
+    ('missed',      '<u4')])# Polls skipped before this sample
+
+# Records of each file version
+_record_dtypes = {1: _n.dtype(record_dtype.descr[:8]), 2: record_dtype}
+
+
+def to_records(rows):
+    """
+    Converts a list of samples (or a 2D array with the columns of
+    pid_controller_api.sample) into an array of record_dtype.
+    """
+    rows    = _n.asarray(rows, dtype=float).reshape(-1, len(record_dtype.names))
+    records = _n.empty(len(rows), record_dtype)
+    for n, name in enumerate(record_dtype.names): records[name] = rows[:,n]
+    return records
+
+
+
+class session_writer():
+    """
+    Writes a binary session file: a small header with the PID parameters
+    and control period at the start of the session, then one fixed-size
+    record (see record_dtype) per sample.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file to create.
+
+    start_time : float
+        Host time.time() at the start of the session.
+
+    band, t_i, t_d, period : float
+        PID parameters and control period at the start of the session.
+    """
+    def __init__(self, path, start_time, band, t_i, t_d, period):
+
+        self.path = path
+        self.file = open(path, 'wb', buffering=1<<16)
+        self.file.write(_header_struct.pack(_magic, _version, _header_size, record_dtype.itemsize,
+                                            start_time, band, t_i, t_d, period).ljust(_header_size, b'\0'))
+
+    def write(self, rows):
+        """
+        Appends samples (see to_records()).
+        """
+        self.file.write(to_records(rows).tobytes())
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+
+class session_reader():
+    """
+    Memory-maps a binary session file. Columns are returned as zero-copy
+    NumPy views into the file, so opening a session is instant whatever
+    its size, and only the parts actually used are read from disk. A
+    partly written last record (e.g. after a crash) is ignored. Files from
+    before device timestamps (version 1) have no device_time and missed
+    columns.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file to open.
+
+    Attributes
+    ----------
+    start_time, band, t_i, t_d, period : float
+        Values from the header.
+
+    records : numpy.memmap
+        All records, with the fields of record_dtype (or the first 8 of
+        them for version 1 files).
+    """
+    def __init__(self, path):
+
+        self.path = path
+        with open(path, 'rb') as f: header = f.read(_header_size)
+
+        magic, version, header_size, record_size, self.start_time, self.band, self.t_i, self.t_d, self.period = \
+            _header_struct.unpack(header[:_header_struct.size])
+
+        dtype = _record_dtypes.get(version)
+        if magic != _magic:                                  raise Exception(path+' is not a PID session file.')
+        if dtype is None or record_size != dtype.itemsize:   raise Exception(path+' has an unsupported record size (version %d).'%version)
+
+        n = (_os.path.getsize(path) - header_size) // record_size
+        self.records = _n.memmap(path, dtype=dtype, mode='r', offset=header_size, shape=(n,)) if n else _n.zeros(0, dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, key):
+        """
+        Returns one column (e.g. 'temperature') as a view into the file.
+        """
+        return self.records[key]
+
+    def index(self, t):
+        """
+        Returns the index of the first record at or after time t, by
+        binary search on the time column.
+        """
+        return int(_n.searchsorted(self.records['time'], t))
+
+    def slice(self, t0=None, t1=None):
+        """
+        Returns the records between times t0 and t1 (inclusive) as a view.
+        None means the start or end of the session.
+        """
+        i0 = 0         if t0 is None else self.index(t0)
+        i1 = len(self) if t1 is None else int(_n.searchsorted(self.records['time'], t1, 'right'))
+        return self.records[i0:i1]
+
+
+
+class binary_session_logger(_logger.session_logger):
+    """
+    session_logger writing binary session files (see session_writer)
+    instead of CSV. The header of each file is taken from its first sample.
+    Takes the same arguments as session_logger.
+    """
+    _extension = '.pidbin'
+
+    def _open_file(self, path):
+        self._path = path
+
+    def _write_rows(self, rows):
+        if self._file is None:
+            x = rows[0]
+            self._file = session_writer(self._path, x[0], *x[4:8])
+        self._file.write(rows)
+
+    def _file_bytes(self):
+        return self._file.file.tell()
+
+    def _close_file(self):
+        self._file.close()
+        self._file = None
@@ -0,0 +1,513 @@
+import numpy       as _n
+import time        as _time
+import collections as _collections
+import threading   as _threading
+
+
+_dac_max = 4095 # Full scale of the 12-bit MCP4725
+
+# HISTORY_SIZE and HISTORY_REPLY in the firmware (see pid_simulator.get_history())
+_history_size  = 32
+_history_reply = 25
+
+
+def firmware_control(error, band, dac):
+    """
+    Vectorized copy of the firmware's control() function.
+
+    Parameters
+    ----------
+    error : float or array
+        Most recently measured temperature minus the setpoint (C).
+    band : float or array
+        Proportional band (C).
+    dac : int or array
+        Current dac output.
+
+    Returns
+    -------
+    int or array
+        The new dac output.
+    """
+    dac = _n.where(error >= band/2,     _dac_max, dac)
+    dac = _n.where(error < -1*band/2,   0,        dac)
+    return dac
+
+
+def _expm(M):
+    """
+    Matrix exponential by scaling and squaring of a Taylor series. Plenty
+    for the small, well-conditioned matrices used here.
+    """
+    norm = _n.abs(M).sum(axis=1).max()
+    s    = max(0, int(_n.ceil(_n.log2(norm)))+1) if norm > 0 else 0
+
+    A    = M/2**s
+    E    = _n.eye(len(M))
+    term = _n.eye(len(M))
+    for k in range(1, 18):
+        term = term @ A / k
+        E    = E + term
+
+    for k in range(s): E = E @ E
+    return E
+
+
+
+class thermal_plant():
+    """
+    Lumped thermal model of the Peltier stage: a plate (holding the sample
+    and the RTD) and a heat sink, coupled through the Peltier module and
+    both leaking to ambient, plus a first-order lag for the RTD itself.
+
+    A positive dac output pumps heat from the plate into the heat sink
+    (cooling, as in the firmware's control()), a negative one pumps it the
+    other way. Joule heating in the module is split between both sides.
+    The dac output reaches the plate after a transport delay.
+
+    Between dac changes the model is linear with a constant input, so it
+    is advanced exactly with cached matrix exponentials rather than by
+    small Euler steps. Several independent plants can be stepped together
+    by setting n; all state and inputs are then arrays of length n.
+
+    Parameters
+    ----------
+    n=1 : int
+        Number of plants stepped together.
+
+    dt=0.01 : float
+        Time resolution (s). Delays and dac changes are rounded to it.
+
+    ambient=22.0 : float
+        Ambient temperature (C). The plants start in equilibrium with it.
+
+    plate_capacity=40.0 : float
+        Heat capacity of the plate and sample (J/K).
+
+    sink_capacity=400.0 : float
+        Heat capacity of the heat sink (J/K).
+
+    peltier_pump=12.0 : float
+        Heat pumped through the Peltier module at full dac output (W).
+
+    peltier_joule=6.0 : float
+        Joule heat generated in the Peltier module at full dac output (W).
+
+    peltier_conductance=0.25 : float
+        Thermal conductance of the Peltier module (W/K).
+
+    plate_loss=0.08 : float
+        Thermal conductance from the plate to ambient (W/K).
+
+    sink_loss=1.5 : float
+        Thermal conductance from the heat sink to ambient (W/K).
+
+    sensor_tau=1.5 : float
+        Time constant of the RTD (s).
+
+    delay=1.0 : float
+        Transport delay between the dac output and heat reaching the plate (s).
+
+    noise=0.02 : float
+        Standard deviation of the RTD reading noise (C).
+
+    seed=None : None or int
+        Seed for the noise generator.
+    """
+    def __init__(self, n=1, dt=0.01, ambient=22.0,
+                 plate_capacity=40.0, sink_capacity=400.0,
+                 peltier_pump=12.0, peltier_joule=6.0, peltier_conductance=0.25,
+                 plate_loss=0.08, sink_loss=1.5, sensor_tau=1.5,
+                 delay=1.0, noise=0.02, seed=None):
+
+        self.n       = n
+        self.dt      = dt
+        self.ambient = ambient
+        self.noise   = noise
+        self._random = _n.random.default_rng(seed)
+
+        Cp, Ch, K = plate_capacity, sink_capacity, peltier_conductance
+
+        # State is [plate, sink, sensor] temperature; input is [f, f**2, 1]
+        # with f the dac output as a fraction of full scale.
+        A = _n.array([
+            [-(K+plate_loss)/Cp,  K/Cp,               0          ],
+            [ K/Ch,              -(K+sink_loss)/Ch,   0          ],
+            [ 1/sensor_tau,       0,                 -1/sensor_tau]])
+        B = _n.array([
+            [-peltier_pump/Cp,    0.5*peltier_joule/Cp,  plate_loss*ambient/Cp],
+            [ peltier_pump/Ch,    0.5*peltier_joule/Ch,  sink_loss *ambient/Ch],
+            [ 0,                  0,                     0                    ]])
+
+        # Augmented one-step propagator [[Phi, Gamma], [0, I]] for a constant input.
+        M = _n.zeros((6,6))
+        M[:3,:3] = A*dt
+        M[:3,3:] = B*dt
+        self._propagators = [_expm(M)] # Propagator for 2**j steps at index j
+
+        self._delay_steps = int(round(delay/dt))
+        self.reset()
+
+    def reset(self, temperature=None):
+        """
+        Puts every plant back in equilibrium at the supplied temperature
+        (default: ambient) with the dac output off.
+        """
+        if temperature is None: temperature = self.ambient
+
+        self.x        = _n.full((self.n, 3), temperature, dtype=float)
+        self.steps    = 0
+        self._dac     = _n.zeros(self.n)
+        self._pending = _collections.deque() # (step at which it takes effect, dac)
+
+    @property
+    def time(self):
+        """
+        Simulated time since the last reset (s).
+        """
+        return self.steps*self.dt
+
+    def set_dac(self, dac):
+        """
+        Commands a new dac output, which reaches the plate after the delay.
+
+        Parameters
+        ----------
+        dac : int or array
+            Signed dac output, -4095 to 4095.
+        """
+        self._pending.append((self.steps+self._delay_steps, _n.broadcast_to(_n.asarray(dac, dtype=float), (self.n,)).copy()))
+
+    def advance(self, steps=1):
+        """
+        Advances every plant by the supplied number of time steps.
+        """
+        target = self.steps + int(steps)
+        while self.steps < target:
+
+            # Apply dac changes that have made it through the delay
+            while len(self._pending) and self._pending[0][0] <= self.steps:
+                self._dac = self._pending.popleft()[1]
+
+            # Advance with a constant input up to the next change
+            stop = min(target, self._pending[0][0]) if len(self._pending) else target
+            self._propagate(stop - self.steps)
+            self.steps = stop
+
+    def _propagate(self, steps):
+        """
+        Advances by the supplied number of steps with the current dac
+        output, one power-of-two propagator at a time.
+        """
+        f = _n.clip(self._dac/_dac_max, -1, 1)
+        v = _n.stack([f, f*f, _n.ones(self.n)], axis=1)
+
+        j = 0
+        while steps:
+            if j == len(self._propagators): self._propagators.append(self._propagators[-1] @ self._propagators[-1])
+            if steps & 1:
+                P = self._propagators[j]
+                self.x = self.x @ P[:3,:3].T + v @ P[:3,3:].T
+            steps >>= 1
+            j      += 1
+
+    def read(self):
+        """
+        Returns the RTD reading of every plant, including noise (C).
+        """
+        return self.x[:,2] + self.noise*self._random.standard_normal(self.n)
+
+
+
+class fopdt_plant():
+    """
+    First-order-plus-dead-time model of the stage, as fitted by
+    pid_controller_sysid: the RTD reading relaxes with time constant tau
+    towards offset + gain*f, where f is the dac output as a fraction of
+    full scale, applied after a transport delay. Has the same interface
+    as thermal_plant, so it can stand in for it in pid_simulator and
+    pid_controller_sweep.
+
+    Parameters
+    ----------
+    n=1 : int
+        Number of plants stepped together.
+
+    dt=0.01 : float
+        Time resolution (s).
+
+    gain=-8.0 : float
+        Steady-state change of the reading at full dac output (C). Negative,
+        since a positive dac output cools.
+
+    tau=60.0 : float
+        Time constant (s).
+
+    delay=3.0 : float
+        Dead time (s).
+
+    offset=22.0 : float
+        Reading with the dac output off (C), i.e. ambient.
+
+    noise=0.02 : float
+        Standard deviation of the reading noise (C).
+
+    seed=None : None or int
+        Seed for the noise generator.
+    """
+    def __init__(self, n=1, dt=0.01, gain=-8.0, tau=60.0, delay=3.0, offset=22.0, noise=0.02, seed=None):
+
+        self.n       = n
+        self.dt      = dt
+        self.gain    = gain
+        self.tau     = tau
+        self.ambient = offset
+        self.noise   = noise
+        self._random = _n.random.default_rng(seed)
+
+        self._decay       = _n.exp(-dt/tau) # Per step
+        self._delay_steps = int(round(delay/dt))
+        self.reset()
+
+    def reset(self, temperature=None):
+        """
+        Puts every plant at the supplied temperature (default: offset)
+        with the dac output off.
+        """
+        if temperature is None: temperature = self.ambient
+
+        self.y        = _n.full(self.n, temperature, dtype=float)
+        self.steps    = 0
+        self._dac     = _n.zeros(self.n)
+        self._pending = _collections.deque() # (step at which it takes effect, dac)
+
+    @property
+    def time(self):
+        """
+        Simulated time since the last reset (s).
+        """
+        return self.steps*self.dt
+
+    def set_dac(self, dac):
+        """
+        Commands a new dac output, which takes effect after the delay.
+        """
+        self._pending.append((self.steps+self._delay_steps, _n.broadcast_to(_n.asarray(dac, dtype=float), (self.n,)).copy()))
+
+    def advance(self, steps=1):
+        """
+        Advances every plant by the supplied number of time steps, exactly.
+        """
+        target = self.steps + int(steps)
+        while self.steps < target:
+
+            while len(self._pending) and self._pending[0][0] <= self.steps:
+                self._dac = self._pending.popleft()[1]
+
+            stop   = min(target, self._pending[0][0]) if len(self._pending) else target
+            final  = self.ambient + self.gain*_n.clip(self._dac/_dac_max, -1, 1)
+            self.y = final + (self.y-final)*self._decay**(stop-self.steps)
+            self.steps = stop
+
+    def read(self):
+        """
+        Returns the reading of every plant, including noise (C).
+        """
+        return self.y + self.noise*self._random.standard_normal(self.n)
+
+
+
+class pid_simulator():
+    """
+    Emulates the arduino firmware driving a simulated thermal plant: the
+    RTD is read back-to-back in loop(), and control() is called from the
+    timer interrupt every control period while in CLOSED_LOOP mode.
+
+    Method names and initial values follow the firmware.
+
+    Parameters
+    ----------
+    plant=None : thermal_plant or None
+        Plant to control (must have n=1). If None, uses thermal_plant().
+
+    speed=1.0 : float
+        Simulated seconds per wall-clock second when realtime=True.
+
+    realtime=True : bool
+        If True, simulated time follows the wall clock (scaled by speed)
+        and catches up whenever the simulator is queried. If False,
+        time only advances through run() and sleep(), as fast as possible.
+
+    read_time=0.12 : float
+        How long one RTD measurement takes on the arduino (s).
+    """
+    def __init__(self, plant=None, speed=1.0, realtime=True, read_time=0.12):
+
+        self.plant    = thermal_plant() if plant is None else plant
+        self.speed    = speed
+        self.realtime = realtime
+
+        self._lock       = _threading.RLock() # The api may query from several threads
+        self._read_steps = max(1, int(round(read_time/self.plant.dt)))
+        self._wall0      = _time.monotonic()
+        self._time0      = self.plant.time
+
+        # Recent RTD readings (time_recent, temperature, dac_output), and how many there have been
+        self.history       = _collections.deque(maxlen=_history_size)
+        self.history_count = 0
+
+        # Firmware initialize()
+        self.mode = 'OPEN_LOOP'
+        self.set_setpoint(24.50)
+        self.set_parameters(1.0, 1000.0, 1.0)
+        self.set_period(800)
+        self.set_dac(0)
+
+        self.read_temperature()
+        self.time_control = self.time_recent
+
+    def millis(self):
+        """
+        Simulated arduino uptime (ms).
+        """
+        return int(self.plant.time*1000)
+
+    def time(self):
+        """
+        Returns the simulated time (s), catching up first if realtime.
+        """
+        self.update()
+        return self.plant.time
+
+    def sleep(self, seconds):
+        """
+        Lets the supplied amount of simulated time pass (s).
+        """
+        if self.realtime: _time.sleep(seconds/self.speed)
+        else:             self.run(seconds)
+
+    def update(self):
+        """
+        If realtime, advances the simulation to the current wall-clock time.
+        """
+        if self.realtime: self.run_until(self._time0 + (_time.monotonic()-self._wall0)*self.speed)
+
+    def run(self, seconds):
+        """
+        Advances the simulation by the supplied amount of time (s).
+        """
+        self.run_until(self.plant.time + seconds)
+
+    def run_until(self, t):
+        """
+        Advances the simulation to the supplied time (s), processing RTD
+        readings and control interrupts along the way.
+        """
+        target = int(t/self.plant.dt)
+        with self._lock:
+            while True:
+                step = min(self._next_read, self._next_control)
+                if step > target: break
+
+                self.plant.advance(step - self.plant.steps)
+
+                if step == self._next_read:
+                    self.read_temperature()
+
+                if step == self._next_control:
+                    self._timer_interrupt()
+                    self._next_control += self._period_steps
+
+            if target > self.plant.steps: self.plant.advance(target - self.plant.steps)
+
+    def read_temperature(self):
+        """
+        Measures the RTD temperature and updates the error and measurement time.
+        """
+        self.temperature = float(self.plant.read()[0])
+        self.error       = self.temperature - self.setpoint
+        self.time_recent = self.millis()
+        self._next_read  = self.plant.steps + self._read_steps
+
+        self.history.append((self.time_recent, self.temperature, self.dac_output))
+        self.history_count += 1
+
+    def _timer_interrupt(self):
+        """
+        Timer1 compare interrupt.
+        """
+        if self.mode == 'CLOSED_LOOP':
+            self.dt           = self.time_recent - self.time_control
+            self.time_control = self.time_recent
+            self.control()
+
+    def control(self):
+        """
+        The firmware's control function.
+        """
+        self.set_dac(int(firmware_control(self.error, self.band, self.dac_output)))
+
+    def set_period(self, period):
+        """
+        Sets the time between calls to control() (ms) and restarts the timer.
+        """
+        with self._lock:
+            self.period         = int(period)
+            self._period_steps  = max(1, int(round(self.period/1000/self.plant.dt)))
+            self._next_control  = self.plant.steps + self._period_steps
+
+    def set_parameters(self, band, t_integral, t_derivative):
+        self.band         = float(band)
+        self.t_integral   = float(t_integral)
+        self.t_derivative = float(t_derivative)
+
+    def set_dac(self, voltage_12bit):
+        with self._lock:
+            self.dac_output = int(voltage_12bit)
+            self.plant.set_dac(self.dac_output)
+
+    def set_mode(self, mode):
+        self.mode = mode
+
+    def set_setpoint(self, setpoint):
+        self.setpoint = float(setpoint)
+
+    def get_dac(self):
+        self.update()
+        return self.dac_output
+
+    def get_mode(self):
+        return self.mode
+
+    def get_temperature(self):
+        self.update()
+        return self.temperature
+
+    def get_setpoint(self):
+        return self.setpoint
+
+    def get_period(self):
+        return self.period
+
+    def get_parameters(self):
+        return self.band, self.t_integral, self.t_derivative
+
+    def get_history(self, first):
+        """
+        Like the firmware's get_history reply: returns the sequence number 
+        of the first reading sent (later than first if the readings were 
+        overwritten) and a list of at most _history_reply readings 
+        (time_recent, temperature, dac_output) from there on.
+        """
+        self.update()
+        with self._lock:
+            first = min(max(first, self.history_count-_history_size), self.history_count)
+            start = len(self.history) - (self.history_count-first)
+            return first, [self.history[n] for n in range(start, min(start+_history_reply, len(self.history)))]
+
+    def get_all_variables(self):
+        """
+        Same values, in the same order, as the firmware's get_all_variables reply.
+        """
+        self.update()
+        return self.temperature, self.setpoint, self.dac_output, self.band, self.t_integral, self.t_derivative, self.period, self.time_recent
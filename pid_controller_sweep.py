@@ -0,0 +1,241 @@
+import numpy              as _n
+import itertools          as _itertools
+import concurrent.futures as _futures
+
+import pid_controller_api        as _api
+import pid_controller_simulation as _simulation
+
+# Columns of pid_sweep.results
+_result_dtype = _n.dtype([
+    ('band',          float), # C
+    ('t_i',           float), # ms
+    ('t_d',           float), # ms
+    ('period',        float), # ms
+    ('overshoot',     float), # Largest excursion past the setpoint (C)
+    ('settling_time', float), # Time after which the reading stays within tolerance (s), nan if not by 90% of the run
+    ('ise',           float)])# Integral of the squared error (C^2 s)
+
+
+def _simulate(candidates, setpoint, duration, tolerance, control, plant_class, plant_kwargs, read_time, seed):
+    """
+    Runs one shard of a sweep: every candidate controller in lock-step on
+    its own copy of the plant. Module-level so it can run in a process pool.
+
+    Returns the overshoot, settling time and ISE of each candidate.
+    """
+    band, t_i, t_d, period = _n.array(candidates, dtype=float).T
+    n = len(band)
+
+    plant = plant_class(n=n, seed=seed, **plant_kwargs)
+    dt    = plant.dt
+
+    # Firmware timing: RTD reads back to back, control() every period from
+    # each candidate's own timer, both rounded to the plant's resolution.
+    read_steps   = max(1, int(round(read_time/dt)))
+    period_steps = _n.maximum(1, _n.round(period/1000/dt)).astype(int)
+    next_control = period_steps.copy()
+    next_read    = 0
+    last_step    = int(round(duration/dt))
+
+    dac       = _n.zeros(n)
+    direction = None # Which way the setpoint step goes, from the first reading
+
+    # Textbook PID state
+    integral  = _n.zeros(n)
+    T_control = None # Reading used at each candidate's last control()
+
+    # Metrics
+    overshoot    = _n.zeros(n)
+    ise          = _n.zeros(n)
+    last_outside = _n.zeros(n)
+
+    while True:
+        step = min(next_read, next_control.min())
+        if step > last_step: break
+        plant.advance(step - plant.steps)
+        t = step*dt
+
+        # Back-to-back RTD readings
+        if step == next_read:
+            T          = plant.read()
+            e          = T - setpoint
+            if direction is None: direction, T_control = -_n.sign(e), T.copy()
+            ise       += e*e*read_steps*dt
+            overshoot  = _n.maximum(overshoot, direction*e)
+            last_outside[_n.abs(e) > tolerance] = t
+            next_read += read_steps
+
+        # Timer interrupts due now
+        due = next_control == step
+        if due.any():
+            e = T[due] - setpoint
+
+            if control == 'firmware':
+                new = _simulation.firmware_control(e, band[due], dac[due])
+
+            else:
+                # Reverse acting (a positive dac cools), proportional band in C
+                h    = period_steps[due]*dt
+                kp   = _simulation._dac_max/band[due]
+                ti   = t_i[due]/1000
+                i    = integral[due] + _n.where(ti > 0, e*h/_n.where(ti > 0, ti, 1), 0)
+                d    = t_d[due]/1000*(T[due]-T_control[due])/h
+                u    = kp*(e + i + d)
+                new  = _n.clip(u, 0, _simulation._dac_max)
+
+                # Stop integrating while saturated (anti-windup)
+                integral[due]  = _n.where(new == u, i, integral[due])
+                T_control[due] = T[due]
+
+            if (new != dac[due]).any():
+                dac[due] = _n.round(new)
+                plant.set_dac(dac.copy())
+            next_control[due] += period_steps[due]
+
+    # Only count as settled if it stayed in tolerance for the last tenth of the run
+    settling_time = _n.where(last_outside <= 0.9*duration, last_outside, _n.nan)
+    return overshoot, settling_time, ise
+
+
+
+class pid_sweep():
+    """
+    Evaluates every combination of the supplied band, t_i, t_d and period
+    values against a simulated thermal plant, all at once. Each candidate
+    gets its own copy of the plant (stepped together as NumPy arrays, see
+    pid_controller_simulation.thermal_plant with n > 1), starting in
+    equilibrium at ambient with the setpoint stepped to setpoint. As on
+    the arduino, the RTD is read back to back and control() runs from a
+    timer every candidate's own period.
+
+    Large grids can be split into shards run in a process pool (see run()).
+
+        sweep = pid_sweep(band=[0.2, 0.5, 1, 2], period=[100, 200, 400, 800])
+        sweep.run()
+        sweep.best()
+        sweep.push(api)
+
+    Parameters
+    ----------
+    band=[1.0], t_i=[1000.0], t_d=[1.0], period=[800] : list
+        Values to combine (C, ms, ms, ms).
+
+    setpoint=18.0 : float
+        Setpoint (C). A positive dac cools, so with the default plant it
+        should be below ambient.
+
+    duration=600 : float
+        Simulated time per candidate (s).
+
+    tolerance=0.2 : float
+        Settling band around the setpoint (C).
+
+    control='firmware' : str
+        'firmware' runs the firmware's control() (bang-bang with a
+        hysteresis of band, see pid_controller_simulation.firmware_control).
+        'pid' runs a textbook positional PID on the same timing, with
+        gain 4095/band per C, t_i and t_d, for comparison.
+
+    plant_class=thermal_plant : class
+        Plant model; must take n and seed and have the thermal_plant
+        interface, e.g. a model fitted by pid_controller_sysid.
+
+    plant_kwargs=None : dict or None
+        Other arguments for plant_class.
+
+    read_time=0.12 : float
+        How long one RTD measurement takes on the arduino (s).
+
+    seed=0 : int
+        Seed for the sensor noise (shard k uses seed+k).
+    """
+    def __init__(self, band=[1.0], t_i=[1000.0], t_d=[1.0], period=[800], setpoint=18.0, duration=600, tolerance=0.2,
+                 control='firmware', plant_class=_simulation.thermal_plant, plant_kwargs=None, read_time=0.12, seed=0):
+
+        if control not in ['firmware', 'pid']: raise Exception("control must be 'firmware' or 'pid'.")
+
+        self.candidates   = _n.array(list(_itertools.product(band, t_i, t_d, period)), dtype=float)
+        self.setpoint     = setpoint
+        self.duration     = duration
+        self.tolerance    = tolerance
+        self.control      = control
+        self.plant_class  = plant_class
+        self.plant_kwargs = dict() if plant_kwargs is None else dict(plant_kwargs)
+        self.read_time    = read_time
+        self.seed         = seed
+
+        self.results = None
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def run(self, processes=None, shard_size=2000):
+        """
+        Simulates every candidate and fills self.results.
+
+        Parameters
+        ----------
+        processes=None : int or None
+            Number of worker processes. None means one per CPU, 1 runs
+            everything in this process.
+
+        shard_size=2000 : int
+            Most candidates simulated together in one process.
+
+        Returns
+        -------
+        numpy structured array
+            One row per candidate with its parameters, overshoot (C),
+            settling_time (s, nan if it has not settled by 90% of the
+            duration) and ise (C^2 s).
+        """
+        shards = [self.candidates[n:n+shard_size] for n in range(0, len(self), shard_size)]
+        args   = [(s, self.setpoint, self.duration, self.tolerance, self.control, self.plant_class,
+                   self.plant_kwargs, self.read_time, self.seed+k) for k, s in enumerate(shards)]
+
+        if processes == 1 or len(shards) == 1:
+            outputs = [_simulate(*a) for a in args]
+        else:
+            with _futures.ProcessPoolExecutor(processes) as pool:
+                outputs = list(pool.map(_simulate, *zip(*args)))
+
+        results = _n.zeros(len(self), _result_dtype)
+        for n, name in enumerate(['band', 't_i', 't_d', 'period']): results[name] = self.candidates[:,n]
+        results['overshoot']     = _n.concatenate([o[0] for o in outputs])
+        results['settling_time'] = _n.concatenate([o[1] for o in outputs])
+        results['ise']           = _n.concatenate([o[2] for o in outputs])
+
+        _api._debug('Sweep: simulated %d candidates in %d shards.'%(len(self), len(shards)))
+        self.results = results
+        return results
+
+    def best(self, by='ise'):
+        """
+        Returns the results row of the best candidate: the lowest value of
+        the supplied column ('ise', 'overshoot' or 'settling_time'), among
+        the candidates that settle if any do.
+        """
+        if self.results is None: raise Exception('Run the sweep first.')
+
+        r       = self.results
+        settled = ~_n.isnan(r['settling_time'])
+        score   = _n.where(_n.isnan(r[by]), _n.inf, r[by])
+        return r[_n.lexsort([score, ~settled])[0]]
+
+    def push(self, api, candidate=None, by='ise'):
+        """
+        Sends a candidate's parameters and period to a controller with
+        set_parameters() and set_period().
+
+        Parameters
+        ----------
+        api : pid_api
+            Controller to configure.
+
+        candidate=None : results row or None
+            Candidate to send. None means best(by).
+        """
+        if candidate is None: candidate = self.best(by)
+        api.set_parameters(float(candidate['band']), float(candidate['t_i']), float(candidate['t_d']))
+        api.set_period(int(candidate['period']))
+        return candidate
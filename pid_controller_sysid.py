@@ -0,0 +1,260 @@
+import os                 as _os
+import numpy              as _n
+import concurrent.futures as _futures
+
+import pid_controller_api        as _api
+import pid_controller_simulation as _simulation
+import pid_controller_session    as _session
+
+_dac_max = 4095 # Full scale of the 12-bit MCP4725
+
+
+def load_session(path):
+    """
+    Loads the time, temperature and dac output of a logged session.
+    Understands binary session files (.pidbin), the GUI's CSV files
+    (Time (s), Temperature (C), Temperature Error (C), DAC Voltage (%), ...)
+    and the session logger's CSV files (time, temperature, setpoint, dac, ...).
+
+    Returns
+    -------
+    t, T, f : arrays
+        Time (s, from the start of the file), temperature (C) and dac output
+        as a fraction of full scale.
+    """
+    if path.endswith('.pidbin'):
+        r = _session.session_reader(path)
+        return r['time']-r.start_time, _n.array(r['temperature'], dtype=float), r['dac']/_dac_max
+
+    with open(path) as f: names = f.readline().strip().split(',')
+    data = _n.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+
+    if 'DAC Voltage (%)' in names:
+        t = data[:,names.index('Time (s)')]
+        T = data[:,names.index('Temperature (C)')]
+        f = data[:,names.index('DAC Voltage (%)')]/100
+    else:
+        t = data[:,names.index('time')]
+        T = data[:,names.index('temperature')]
+        f = data[:,names.index('dac')]/_dac_max
+
+    return t-t[0], T, f
+
+
+def _resample(t, T, f, dt):
+    """
+    Puts a run on a uniform time grid, averaging the samples in each
+    interval dt (s). Averaging over intervals longer than the sample
+    spacing keeps sensor noise from biasing the fits. Intervals without
+    samples are interpolated.
+    """
+    dt    = max(dt, float(_n.median(_n.diff(t))))
+    k     = ((t-t[0])/dt).astype(int)
+    count = _n.bincount(k)
+    have  = count > 0
+    grid  = _n.arange(len(count))
+
+    T = _n.bincount(k, T)[have]/count[have]
+    f = _n.bincount(k, f)[have]/count[have]
+    return dt, _n.interp(grid, grid[have], T), _n.interp(grid, grid[have], f)
+
+
+
+class fopdt_fit():
+    """
+    First-order-plus-dead-time model of a run,
+
+        tau dT/dt = offset + gain f(t - delay) - T
+
+    with f the dac output as a fraction of full scale. Fitted as the
+    discrete model T[k+1] = a T[k] + b f[k-d] + c by linear least squares
+    for every candidate delay d at once (normal equations solved as one
+    batch), keeping the delay with the smallest residual.
+
+    Parameters
+    ----------
+    t, T, f : arrays
+        Time (s), temperature (C) and dac fraction, e.g. from load_session().
+
+    max_delay=30 : float
+        Longest delay to consider (s).
+
+    dt=1.0 : float
+        Resampling interval (s), see _resample(). Also the resolution of the
+        delay.
+
+    Attributes
+    ----------
+    gain : float
+        Steady-state temperature change at full dac output (C).
+
+    tau, delay : float
+        Time constant and dead time (s).
+
+    offset : float
+        Temperature with the dac off (C).
+
+    rmse : float
+        Root-mean-square one-step prediction error (C).
+    """
+    def __init__(self, t, T, f, max_delay=30, dt=1.0):
+
+        self.dt, y, u = _resample(_n.asarray(t, dtype=float), _n.asarray(T, dtype=float), _n.asarray(f, dtype=float), dt)
+
+        D  = max(0, min(int(max_delay/self.dt), len(y)//2))
+        yk = y[D:-1] # Regressors and targets over the same samples for every delay,
+        yn = y[D+1:] # so the residuals can be compared
+        m  = len(yk)
+        if m < 10: raise Exception('Not enough data to fit.')
+
+        # Normal equations for each delay d, with regressors [T[k], f[k-d], 1]
+        G = _n.zeros((D+1, 3, 3))
+        h = _n.zeros((D+1, 3))
+        for d in range(D+1):
+            ud = u[D-d:len(u)-1-d]
+            G[d] = [[yk@yk, yk@ud, yk.sum()],
+                    [yk@ud, ud@ud, ud.sum()],
+                    [yk.sum(), ud.sum(), m ]]
+            h[d] = [yk@yn, ud@yn, yn.sum()]
+
+        theta = (_n.linalg.pinv(G) @ h[:,:,None])[:,:,0]
+        rss   = yn@yn - 2*(theta*h).sum(axis=1) + _n.einsum('di,dij,dj->d', theta, G, theta)
+
+        d       = int(_n.argmin(rss))
+        a, b, c = theta[d]
+        self.theta  = theta[d]
+        self.rmse   = float(_n.sqrt(max(rss[d], 0)/m))
+        self.delay  = d*self.dt
+        self.tau    = float(-self.dt/_n.log(a)) if 0 < a < 1 else _n.inf
+        self.gain   = float(b/(1-a))
+        self.offset = float(c/(1-a))
+
+    def __repr__(self):
+        return 'fopdt_fit(gain=%.4g C, tau=%.4g s, delay=%.4g s, offset=%.4g C, rmse=%.3g C)'%(self.gain, self.tau, self.delay, self.offset, self.rmse)
+
+    def plant_kwargs(self):
+        """
+        Returns the arguments of a pid_controller_simulation.fopdt_plant
+        with this model, e.g. for pid_sweep(plant_class=fopdt_plant,
+        plant_kwargs=fit.plant_kwargs()).
+        """
+        return dict(gain=self.gain, tau=self.tau, delay=self.delay, offset=self.offset, noise=self.rmse)
+
+    def plant(self, **kwargs):
+        """
+        Returns a pid_controller_simulation.fopdt_plant with this model, e.g.
+        for pid_simulator(plant=fit.plant()). Keyword arguments override
+        plant_kwargs().
+        """
+        return _simulation.fopdt_plant(**dict(self.plant_kwargs(), **kwargs))
+
+
+
+class arx_fit():
+    """
+    Low-order ARX model of a run,
+
+        T[k] = a_1 T[k-1] + ... + a_na T[k-na] + b_1 f[k-d-1] + ... + b_nb f[k-d-nb] + c
+
+    fitted by linear least squares on the resampled data.
+
+    Parameters
+    ----------
+    t, T, f : arrays
+        Time (s), temperature (C) and dac fraction, e.g. from load_session().
+
+    na=2, nb=2 : int
+        Orders of the model.
+
+    delay=0 : float
+        Dead time d (s), e.g. from an fopdt_fit.
+
+    dt=1.0 : float
+        Resampling interval (s), see _resample().
+
+    Attributes
+    ----------
+    a, b : arrays
+        Coefficients.
+
+    c : float
+        Constant term.
+
+    gain : float
+        Steady-state temperature change at full dac output (C).
+
+    rmse : float
+        Root-mean-square one-step prediction error (C).
+    """
+    def __init__(self, t, T, f, na=2, nb=2, delay=0, dt=1.0):
+
+        self.dt, y, u = _resample(_n.asarray(t, dtype=float), _n.asarray(T, dtype=float), _n.asarray(f, dtype=float), dt)
+        self.delay    = delay
+        d             = int(round(delay/self.dt))
+
+        k0 = max(na, d+nb) # First sample with every regressor available
+        N  = len(y)
+        if N-k0 < 10*(na+nb+1): raise Exception('Not enough data to fit.')
+
+        X = _n.column_stack([y[k0-i:N-i] for i in range(1, na+1)] +
+                            [u[k0-d-j:N-d-j] for j in range(1, nb+1)] +
+                            [_n.ones(N-k0)])
+        theta, rss, rank, sv = _n.linalg.lstsq(X, y[k0:], rcond=None)
+
+        self.a    = theta[:na]
+        self.b    = theta[na:na+nb]
+        self.c    = float(theta[-1])
+        self.rmse = float(_n.sqrt(_n.mean((X@theta-y[k0:])**2)))
+        self.gain = float(self.b.sum()/(1-self.a.sum()))
+
+    def __repr__(self):
+        return 'arx_fit(a=%s, b=%s, gain=%.4g C, rmse=%.3g C)'%(_n.round(self.a, 5), _n.round(self.b, 5), self.gain, self.rmse)
+
+
+
+def fit_session(path, max_delay=30, na=2, nb=2):
+    """
+    Fits an FOPDT and an ARX model (using the FOPDT delay) to one logged
+    session (see load_session()).
+
+    Returns
+    -------
+    dict
+        path, gain (C), tau (s), delay (s), offset (C), rmse (C), and the
+        fopdt_fit and arx_fit objects.
+    """
+    t, T, f = load_session(path)
+    fopdt   = fopdt_fit(t, T, f, max_delay)
+    arx     = arx_fit  (t, T, f, na, nb, fopdt.delay)
+    return dict(path=path, gain=fopdt.gain, tau=fopdt.tau, delay=fopdt.delay, offset=fopdt.offset, rmse=fopdt.rmse,
+                fopdt=fopdt, arx=arx)
+
+
+def fit_sessions(paths, max_delay=30, na=2, nb=2, processes=None):
+    """
+    Runs fit_session() on many files in a process pool. Files that cannot
+    be fitted are reported with an 'error' instead.
+
+    Parameters
+    ----------
+    paths : list
+        Session files.
+
+    processes=None : int or None
+        Number of worker processes. None means one per CPU.
+
+    Returns
+    -------
+    list
+        One dictionary per file (see fit_session()), in the same order.
+    """
+    with _futures.ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(fit_session, p, max_delay, na, nb) for p in paths]
+
+    results = []
+    for p, future in zip(paths, futures):
+        try:                   results.append(future.result())
+        except Exception as e:
+            _api._debug('Sysid: could not fit '+_os.path.basename(p), e)
+            results.append(dict(path=p, error=str(e)))
+    return results